@@ -1,8 +1,46 @@
 import os  # os module is required to manipulate directories and files
+import asyncio  # The asyncio API of the databases
+import base64  # Decoding of the database keys
+import bisect  # Binary search over sorted index entries
+import bz2  # Compression of the tables
+import collections  # Ordered dict for the LRU cache
+import concurrent.futures  # Worker threads of the asyncio API
+import contextlib  # Batched writes as a with block
+import functools  # Locking decorators
+import glob  # Finding all the segments files of a table
+import heapq  # Merging of sorted streams of documents
+import itertools  # Chaining of document streams
 import json  # JSON module helps to manipulate json data
+import lzma  # Compression of the tables
+import marshal  # Binary codec of the tables
+import math  # Costs of the query plans
+import operator  # IN conditions of the SQL queries
+import pickle  # Checking that filters can be sent to worker processes
 import platform # Platform information
 import re  # RegExp support for our app
 import shutil  # This module helps to delete databases
+import struct  # Binary framing for the write-ahead log records
+import threading  # Locking of the shared cache
+import time  # Timing of the background writes
+import weakref  # The write-behind tables of a database
+import zlib  # Compression of the tables
+from cryptography.fernet import Fernet, InvalidToken  # AES encryption of the tables
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+# fcntl is only there on unix, elsewhere tables are only locked within the process
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# msgpack is optional, it is only needed by tables using the msgpack codec
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 banner = """\n\n  \
 ██████╗  ██╗   ██╗ ███╗   ███╗ ██████╗  ██╗  ██╗ ██╗ ███╗   ██╗ \n  \
@@ -138,7 +176,7 @@ def binary_search(arr, key, value):
     l = 0
     u = len(arr) - 1
 
-    while l < u:
+    while l <= u:
         mid = (l + u) // 2
         if arr[mid][key] == value:
             return arr[mid]
@@ -146,79 +184,1025 @@ def binary_search(arr, key, value):
             if arr[mid][key] < value:
                 l = mid + 1
             else:
-                u = mid
+                u = mid - 1
     return False
 
-# This function matches the documents according to the criteria defined in the filters
-# Not only '== matching' but different kinds like !=, >, <, <=, >=
-def matchDocs(doc, filters):
-    # We should apply special match only if
-    # the filter is a dictionary
-    if "dict" in str(type(filters)):
-
-        # Loop through all the defined filters
-        for i in filters.keys():
-            # Check each filter one by one
-            # The not equals filter
-            if i == "__ne":
-                if doc == filters[i]:
-                    return False
-            # The greater than filter
-            elif i == "__gt":
-                if doc <= filters[i]:
-                    return False
-            # The less than filter
-            elif i == "__lt":
-                if doc >= filters[i]:
-                    return False
-            # The less than or equals filter
-            elif i == "__lte":
-                if doc > filters[i]:
-                    return False
-            # The greater than or equals filter
-            elif i == "__gte":
-                if doc < filters[i]:
-                    return False
-            # The Regular Expression filter
-            elif i == "__re":
-                try:
-                    if re.match(filters[i], str(doc)) == None:
-                        return False
-                except:
-                    raise InvalidRegExpError(
-                        f"The given RegExp `{filters[i]}` is not valid. \
-                        Please refer to docs of the `re` module to see\
-                        what a valid Regular Expression is."
-                    )
-            # Custom function filter
-            elif i == "__cf":
+# Cost of checking each kind of filter. Cheap filters run first, so that a
+# document is rejected before the expensive ones are tried.
+FILTER_COST = {
+    "__eq": 0,
+    "__gt": 1,
+    "__lt": 1,
+    "__gte": 1,
+    "__lte": 1,
+    "__ne": 2,
+    "__re": 3,
+    "__cf": 4,
+}
+
+# The share of the documents a filter is guessed to match, when no index over the
+# field tells. Used by table.explain to work out how many documents a query reads.
+FILTER_SELECTIVITY = {
+    "__eq": 0.1,
+    "__gt": 1 / 3,
+    "__lt": 1 / 3,
+    "__gte": 1 / 3,
+    "__lte": 1 / 3,
+    "__ne": 0.9,
+    "__re": 0.5,
+    "__cf": 0.5,
+}
+
+# Stands in for a field that a document does not have
+MISSING = object()
+
+# This function compiles the filter of a single field into a predicate over the field's
+# value. Not only '== matching' but different kinds like !=, >, <, <=, >=, RegExps and
+# custom functions. Invalid filters and RegExps are reported here, before any scan starts.
+# @returns <tuple>: The cost of the predicate and the predicate itself
+def compileFilter(filters):
+    # No custom filter specified, return simple equality check
+    if not isinstance(filters, dict):
+        return FILTER_COST["__eq"], lambda doc: filters == doc
+
+    checks = []
+    # Loop through all the defined filters
+    for i, arg in filters.items():
+        # The not equals filter
+        if i == "__ne":
+            check = lambda doc, arg=arg: not doc == arg
+        # The greater than filter
+        elif i == "__gt":
+            check = lambda doc, arg=arg: not doc <= arg
+        # The less than filter
+        elif i == "__lt":
+            check = lambda doc, arg=arg: not doc >= arg
+        # The less than or equals filter
+        elif i == "__lte":
+            check = lambda doc, arg=arg: not doc > arg
+        # The greater than or equals filter
+        elif i == "__gte":
+            check = lambda doc, arg=arg: not doc < arg
+        # The Regular Expression filter, compiled once for the whole query
+        elif i == "__re":
+            try:
+                pattern = re.compile(arg)
+            except Exception:
+                raise InvalidRegExpError(
+                    f"The given RegExp `{arg}` is not valid. \
+                    Please refer to docs of the `re` module to see\
+                    what a valid Regular Expression is."
+                )
+            check = lambda doc, match=pattern.match: match(str(doc)) is not None
+        # Custom function filter
+        elif i == "__cf":
+            if not callable(arg):
+                raise InvalidFilterError(
+                    f"The provided custom filter `{str(arg)}` is not a function."
+                )
+
+            def check(doc, arg=arg):
                 try:
-                    if not filters[i](doc):
-                        return False
+                    return bool(arg(doc))
                 except Exception as e:
                     raise InvalidFilterError(
-                        f"The provided custom filter `{str(filters[i])}`\
+                        f"The provided custom filter `{str(arg)}`\
                         raised an unhandled exception: {str(e)}`"
                     )
 
-            # Filter does not match any provided filters. Raise Excepion
-            else:
-                raise InvalidFilterError(
-                    f"The provided filter `{i}` is not valid.\
-                     Must be one of __ne, __lt, __gt, __lte, \
-                    __gte, __re, __cf"
-                )
+        # Filter does not match any provided filters. Raise Excepion
+        else:
+            raise InvalidFilterError(
+                f"The provided filter `{i}` is not valid.\
+                 Must be one of __ne, __lt, __gt, __lte, \
+                __gte, __re, __cf"
+            )
+        checks.append((FILTER_COST[i], check))
+
+    # Run the cheap checks first
+    checks.sort(key=lambda c: c[0])
+    cost = checks[-1][0] if checks else 0
+    checks = tuple(c for _, c in checks)
+
+    def predicate(doc):
+        try:
+            for check in checks:
+                if not check(doc):
+                    return False
+
+        # Values of different types, like a number and a string, can't be
+        # compared, so such a document does not match a range filter
+        except TypeError:
+            return False
 
         # The doc passed all the specified filters
         # It passed the test!
         return True
 
-    # No custom filter specified, return simple equality check
+    return cost, predicate
+
+# This function guesses the share of the documents that match the filter of a field
+def filterSelectivity(filters):
+    if not isinstance(filters, dict):
+        return FILTER_SELECTIVITY["__eq"]
+    share = 1.0
+    for i in filters:
+        share *= FILTER_SELECTIVITY.get(i, 1.0)
+    return share
+
+# This function adds up the cost of a query plan: the documents decoded, plus the
+# comparisons of sorting the matches, unless they are read in order from an index
+def sortCost(plan, decoded: int, stop: int = None):
+    matches = max(plan["matches"], 1)
+    if plan["sort"] == "sort":
+        return round(decoded + matches * math.log2(matches + 1))
+    if plan["sort"] == "top-n":
+        return round(decoded + matches * math.log2(min(stop, matches) + 1))
+    return decoded
+
+# This function compiles the filters of a query into a single predicate over whole
+# documents. It is built once per query and then run against every document.
+def compileFilters(filters):
+    fields = []
+    for field, value in filters.items():
+        cost, predicate = compileFilter(value)
+
+        # Plain equality checks are the most common, so they get a check of their own
+        if not isinstance(value, dict):
+            check = lambda doc, field=field, value=value: doc.get(field, MISSING) == value
+        else:
+            check = lambda doc, field=field, predicate=predicate: (
+                doc.get(field, MISSING) is not MISSING and predicate(doc[field])
+            )
+        fields.append((cost, check))
+
+    # The cheapest, and so usually most selective, fields are checked first
+    fields.sort(key=lambda f: f[0])
+    checks = tuple(c for _, c in fields)
+
+    # Its posiible that all documents don't have the keys given in
+    # filter, in which case they don't match
+    if not checks:
+        return lambda doc: True
+    if len(checks) == 1:
+        return checks[0]
+
+    def match(doc):
+        for check in checks:
+            if not check(doc):
+                return False
+        return True
+
+    return match
+
+# This function matches the documents according to the criteria defined in the filters
+# Not only '== matching' but different kinds like !=, >, <, <=, >=
+def matchDocs(doc, filters):
+    return compileFilter(filters)[1](doc)
+
+# This function checks a whole document against all the filters of a query
+def matchFilters(doc, filters):
+    return compileFilters(filters)(doc)
+
+# Header written at the start of every write-ahead log, followed by the log's epoch
+LOG_MAGIC = b"PKLOG1"
+
+# Header written at the start of every export package
+EXPORT_MAGIC = b"PKEXP1"
+
+# Number of documents written to an export package at a time
+EXPORT_BATCH = 1000
+
+# This function frames a blob as a record: a 4 byte big-endian length followed by the blob
+def packRecord(blob):
+    return struct.pack(">I", len(blob)) + blob
+
+# This function yields the records of an open binary file one by one. A record
+# cut short by a crash in the middle of a write is ignored along with the rest.
+def readRecords(f):
+    while True:
+        head = f.read(4)
+        if len(head) < 4:
+            return
+        (size,) = struct.unpack(">I", head)
+        blob = f.read(size)
+        if len(blob) < size:
+            return
+        yield blob
+
+# This function replaces a file with new contents all at once. The contents go to a
+# temporary file first, which is flushed to the drive and then renamed over the old
+# file, so that readers and crashes see either the old or the new file, never a mix.
+# Without 'sync' the operating system decides when the file reaches the drive.
+def replaceFile(path: str, contents, sync: bool = True):
+    temp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp, "wb" if isinstance(contents, bytes) else "w") as f:
+        f.write(contents)
+        f.flush()
+        if sync:
+            os.fsync(f.fileno())
+    os.replace(temp, path)
+
+# Serialization formats of the tables, by name: the tag byte their payloads start
+# with, and the functions that write and read a payload. JSON text never starts with
+# a tag byte, so JSON payloads, the only format of older tables, have no tag.
+CODECS = {
+    "json": (b"", lambda obj: json.dumps(obj).encode(), json.loads),
+    # marshal is the fastest to write and read, but like JSON it
+    # keeps only python's basic types, which is all a document holds
+    # marshal is not meant to be stable between python versions, so the tables are
+    # written with its version 4, which every python since 3.4 reads
+    "marshal": (b"\x01", lambda obj: marshal.dumps(obj, 4), marshal.loads),
+}
+
+if msgpack is not None:
+    CODECS["msgpack"] = (
+        b"\x02",
+        msgpack.packb,
+        lambda blob: msgpack.unpackb(blob, strict_map_key=False),
+    )
+
+# The codec of every tag, including the ones whose module is not installed
+CODEC_TAGS = {b"\x01": "marshal", b"\x02": "msgpack"}
+
+# This function serializes a python object with the given codec
+def encodePayload(obj, codec: str = "json"):
+    tag, dumps, loads = CODECS[codec]
+    return tag + dumps(obj)
+
+# This function reads back a payload written by any of the codecs
+def decodePayload(payload):
+    codec = CODEC_TAGS.get(payload[:1])
+    if codec is None:
+        return json.loads(payload)
+    if codec not in CODECS:
+        raise ValueError(
+            f"The table is stored with the `{codec}` codec, which needs the {codec} module."
+        )
+    return CODECS[codec][2](memoryview(payload)[1:])
+
+# This function makes sure documents hold only values JSON can write. The binary codecs
+# can store more, like bytes, sets or tuple keys, but indexes, sorts and exports write
+# the values as JSON, and would fail on them long after the documents were stored.
+def checkValues(docs):
+    try:
+        json.dumps(docs)
+    except (TypeError, ValueError) as e:
+        raise TypeError(f"A document can only hold values that JSON can store. {e}") from None
+
+# This function makes sure a codec can be used
+def checkCodec(codec: str):
+    if codec not in CODECS:
+        raise ValueError(
+            f"The codec `{codec}` is not valid. Must be one of {', '.join(CODECS)}"
+        )
+
+# Compression methods, by name: the tag byte compressed payloads start with and the
+# module that does the work. The tags are apart from the codec tags and JSON text.
+COMPRESSIONS = {"zlib": (b"\x10", zlib), "bz2": (b"\x11", bz2), "lzma": (b"\x12", lzma)}
+COMPRESSION_TAGS = {tag: module for tag, module in COMPRESSIONS.values()}
+
+# This function compresses a payload before it is encrypted. Without a method, or
+# if compressing does not make the payload smaller, the payload is kept as it is.
+def compressPayload(payload, method: str = None, level: int = None):
+    if method is None:
+        return payload
+
+    tag, module = COMPRESSIONS[method]
+    # The default level of each module is used without a level
+    if level is None:
+        data = module.compress(payload)
+    elif module is lzma:
+        data = lzma.compress(payload, preset=level)
     else:
-        return filters == doc
+        data = module.compress(payload, level)
+
+    return tag + data if len(data) + 1 < len(payload) else payload
+
+# This function undoes compressPayload, whatever the method was
+def decompressPayload(payload):
+    module = COMPRESSION_TAGS.get(payload[:1])
+    if module is None:
+        return payload
+    return module.decompress(memoryview(payload)[1:])
+
+# This function makes sure a compression method and level can be used
+def checkCompression(method: str = None, level: int = None):
+    if method is not None and method not in COMPRESSIONS:
+        raise ValueError(
+            f"The compression `{method}` is not valid. Must be one of {', '.join(COMPRESSIONS)}"
+        )
+    # Let the module judge the level
+    try:
+        compressPayload(b"", method, level)
+    except (ValueError, TypeError, zlib.error, lzma.LZMAError) as exc:
+        raise ValueError(f"The compression level `{level}` is not valid for {method}: {exc}")
+
+# Encryption backends of the databases
+CIPHERS = ("fernet", "aesgcm")
+# AES-GCM blobs start with this byte, Fernet tokens always start with "g"
+AESGCM_TAG = b"\x01"
+
+class tableCipher:
+    def __init__(self, key, backend: str = "fernet"):
+        """
+            Encrypts and decrypts the files of a database with the key of the database.
+            Blobs are written with the 'backend' given and read whatever backend wrote them.
+            "fernet" is AES-CBC with an HMAC, as base64 text. "aesgcm" is AES-256-GCM over
+            raw bytes, which is a lot faster and does not grow the data by a third.
+            @param key <str>: The key of the database, as made by Fernet.generate_key.
+            @param backend <str> [Optional]: "fernet" or "aesgcm". Default: "fernet".
+        """
+        checkCipher(backend)
+        self.backend = backend
+        self.fernet = Fernet(key)
+
+        # The AES-GCM key is derived from the database key, so that no key is shared by two ciphers
+        hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b"PumpkinDB aesgcm")
+        self.aesgcm = AESGCM(hkdf.derive(base64.urlsafe_b64decode(key)))
+
+    # Encrypt some bytes
+    def encrypt(self, data):
+        if self.backend == "aesgcm":
+            # A fresh random nonce for every blob
+            nonce = os.urandom(12)
+            return AESGCM_TAG + nonce + self.aesgcm.encrypt(nonce, data, None)
+        return self.fernet.encrypt(data)
+
+    # Decrypt a blob written by either backend. Raises InvalidToken for the wrong
+    # key or a blob that was tampered with.
+    def decrypt(self, blob):
+        if blob[:1] == AESGCM_TAG:
+            blob = memoryview(blob)
+            try:
+                return self.aesgcm.decrypt(blob[1:13], blob[13:], None)
+            except InvalidTag:
+                raise InvalidToken
+        return self.fernet.decrypt(blob)
+
+# The cipher of every key and backend used by this process
+ciphers = {}
+
+# This function returns the cipher of a key and backend, made just once and shared
+def getCipher(key, backend: str = "fernet"):
+    key = key.decode("utf-8") if isinstance(key, bytes) else key
+    if (key, backend) not in ciphers:
+        ciphers[(key, backend)] = tableCipher(key, backend)
+    return ciphers[(key, backend)]
+
+# This function makes sure an encryption backend can be used
+def checkCipher(backend: str):
+    if backend not in CIPHERS:
+        raise ValueError(
+            f"The cipher `{backend}` is not valid. Must be one of {', '.join(CIPHERS)}"
+        )
+
+# The manifest of a table without any documents
+def emptyManifest():
+    return {
+        "segments": [],  # Offset, length and document count of every segment
+        "garbage": 0,  # Bytes of the .segments file no longer in use
+        "logEpoch": 0,  # Epoch of the next write-ahead log to be folded in
+        "version": 0,  # Bumped on every write, so that indexes can tell if they are stale
+        "nextId": 0,  # The _id the next inserted document gets
+        "file": os.urandom(8).hex(),  # Changes whenever the segments move to a new file
+    }
+
+# This function returns the _id the first document after the stored ones gets. Tables
+# from before document ids number their documents by position until their first write.
+def storedNextId(manifest):
+    if isinstance(manifest, list):
+        return len(manifest)
+    if "nextId" in manifest:
+        return manifest["nextId"]
+    return sum(i["count"] for i in manifest["segments"])
+
+# This function turns a value into the key it is stored under in a hash index.
+# Values that compare equal in python, like 1, 1.0 and True, share the same key.
+def indexKey(value):
+    if isinstance(value, bool):
+        value = int(value)
+    elif isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return json.dumps(value, sort_keys=True)
+
+# This function turns a value into the key it is sorted by. Python can't compare
+# numbers with strings, so values are ordered by type first: numbers, then strings,
+# then everything else (lists, dicts, None) by their JSON text.
+def sortKey(value):
+    if isinstance(value, (int, float)):
+        return [0, value]
+    if isinstance(value, str):
+        return [1, value]
+    return [2, json.dumps(value, sort_keys=True)]
+
+# The key a document is sorted by. Documents without the field come last,
+# whichever way they are sorted.
+def docKey(doc, field, descending: bool = False):
+    if field in doc:
+        return sortKey(doc[field])
+    return [-1] if descending else [3]
+
+# This function sorts documents by a field. Unlike merge_sort it never fails on
+# documents that miss the field or hold values of different types. With a limit
+# only the top documents are kept in a heap instead of sorting all of them.
+def sortDocs(docs, field, descending: bool = False, limit: int = None):
+    key = lambda d: docKey(d, field, descending)
+    if limit is None:
+        return sorted(docs, key=key, reverse=descending)
+    if descending:
+        return heapq.nlargest(limit, docs, key=key)
+    return heapq.nsmallest(limit, docs, key=key)
+
+# This function checks the projection of a query and returns a function that builds
+# the result from a document: only the 'fields' asked for, or every field but the
+# 'exclude' ones. The _id is kept unless it is excluded. Without a projection the
+# result is a plain copy of the document.
+def compileProjection(fields=None, exclude=None):
+    # A single field may be given on its own
+    if isinstance(fields, str):
+        fields = [fields]
+    if isinstance(exclude, str):
+        exclude = [exclude]
+
+    if fields is not None and not all(isinstance(i, str) for i in fields):
+        raise ValueError("The fields of a projection must be strings.")
+    if exclude is not None and not all(isinstance(i, str) for i in exclude):
+        raise ValueError("The excluded fields of a projection must be strings.")
+
+    excluded = frozenset(exclude or ())
+    if fields is not None:
+        # Just the keys asked for are looked up, the rest of the document is never copied
+        keys = [i for i in dict.fromkeys(["_id", *fields]) if i not in excluded]
+        return lambda doc: {i: doc[i] for i in keys if i in doc}
+    if excluded:
+        return lambda doc: {i: v for i, v in doc.items() if i not in excluded}
+    return dict
+
+# This function adds a document's position to an index
+def indexAdd(index, value, position):
+    # Hash indexes map a value to the positions holding it. Values that share a key,
+    # like 1 and True, are told apart by the value of the first document of the key,
+    # which is what the key stands for in distinct and group_by, see indexGroups.
+    if index["kind"] == "hash":
+        key = indexKey(value)
+        positions = index["map"].setdefault(key, [])
+        if not positions or position < positions[0]:
+            index["values"][key] = value
+        bisect.insort(positions, position)
+    # Sorted indexes hold [rank, value, position] entries in order
+    else:
+        bisect.insort(index["entries"], sortKey(value) + [position])
+
+# This function removes a document's position from an index
+def indexRemove(index, value, position):
+    if index["kind"] == "hash":
+        positions = index["map"][indexKey(value)]
+        del positions[bisect.bisect_left(positions, position)]
+        if not positions:
+            del index["map"][indexKey(value)]
+            del index["values"][indexKey(value)]
+    else:
+        entries = index["entries"]
+        del entries[bisect.bisect_left(entries, sortKey(value) + [position])]
+
+# This function moves the positions of an index up past deleted documents
+def indexShift(index, removed):
+    if index["kind"] == "hash":
+        for key, positions in index["map"].items():
+            index["map"][key] = [p - bisect.bisect_left(removed, p) for p in positions]
+    else:
+        # New entries, copies of an index share their entries, see copyIndex
+        index["entries"] = [
+            e[:-1] + [e[-1] - bisect.bisect_left(removed, e[-1])] for e in index["entries"]
+        ]
+
+# This function copies an index, so that a writer can change the copy while
+# readers keep using the original. Entries are shared, but never changed in place.
+def copyIndex(index):
+    if index["kind"] == "hash":
+        return {
+            "kind": "hash",
+            "map": {k: list(v) for k, v in index["map"].items()},
+            "values": dict(index["values"]),
+        }
+    return {"kind": "sorted", "entries": list(index["entries"])}
+
+# This function yields the positions of a whole table of 'total' documents in the
+# order of a sorted index. Documents without the field are not in the index and come
+# after it, they are only looked for once the walk gets there. Queries that stop
+# early, like a get_one, never build the whole list.
+def indexWalk(index, total: int, descending: bool = False):
+    entries = index["entries"]
+    yield from (e[-1] for e in (reversed(entries) if descending else entries))
+    if len(entries) < total:
+        indexed = {e[-1] for e in entries}
+        rest = range(total - 1, -1, -1) if descending else range(total)
+        yield from (p for p in rest if p not in indexed)
+
+# This function finds the positions an index holds for a filter. Returns None if
+# the index can't answer the filter. Sorted indexes return them in value order.
+def indexLookup(index, value):
+    if index["kind"] == "hash":
+        # Only plain equality filters can be answered by a hash index
+        if isinstance(value, dict):
+            return None
+        return index["map"].get(indexKey(value), [])
+
+    entries = index["entries"]
+    inf = float("inf")
+
+    # An equality filter is a range holding just one value
+    if not isinstance(value, dict):
+        key = sortKey(value)
+        lo = bisect.bisect_left(entries, key)
+        hi = bisect.bisect_right(entries, key + [inf])
+        return [e[-1] for e in entries[lo:hi]]
+
+    bounds = {i: value[i] for i in ("__gt", "__gte", "__lt", "__lte") if i in value}
+    ranks = {sortKey(i)[0] for i in bounds.values()}
+
+    # Only numbers and strings have a meaningful order
+    if not bounds or ranks - {0, 1}:
+        return None
+    # Numbers and strings can't be compared, so nothing matches both bounds
+    if len(ranks) > 1:
+        return []
+
+    # Stay within the values of the same type as the bounds
+    rank = ranks.pop()
+    lo = bisect.bisect_left(entries, [rank])
+    hi = bisect.bisect_left(entries, [rank + 1])
+    for op, bound in bounds.items():
+        key = sortKey(bound)
+        if op == "__gt":
+            lo = max(lo, bisect.bisect_right(entries, key + [inf]))
+        elif op == "__gte":
+            lo = max(lo, bisect.bisect_left(entries, key))
+        elif op == "__lt":
+            hi = min(hi, bisect.bisect_left(entries, key))
+        else:
+            hi = min(hi, bisect.bisect_right(entries, key + [inf]))
+    return [e[-1] for e in entries[lo:hi]]
+
+# The metrics table.aggregate can work out
+AGGREGATES = ("count", "sum", "min", "max", "avg")
+
+# This function reads the metrics asked for from table.aggregate into a list of
+# (name, function, field). A metric is "count", or a (function, field) tuple.
+def parseMetrics(metrics):
+    parsed = []
+    for name, metric in metrics.items():
+        function, field = (metric, None) if isinstance(metric, str) else tuple(metric)
+        if function not in AGGREGATES:
+            raise ValueError(
+                f"The metric `{function}` is not valid. Must be one of {', '.join(AGGREGATES)}"
+            )
+        if field is None and function != "count":
+            raise ValueError(f"The metric `{name}` needs a field to work out the {function} of.")
+        parsed.append((name, function, field))
+    return parsed
+
+# The state every metric starts from
+def newMetrics(metrics):
+    state = []
+    for name, function, field in metrics:
+        if function == "avg":
+            # The sum and count of the numbers
+            state.append([0, 0])
+        elif function in ("count", "sum"):
+            state.append(0)
+        else:
+            # Nothing to compare with yet
+            state.append(None)
+    return state
+
+# This function takes a list of documents into the state of the metrics. Each metric
+# goes over the whole list at once, which is a lot faster than document by document.
+# Sums and averages are of the numbers only. Minimums and maximums order values like
+# sortDocs does.
+def foldMetrics(state, metrics, docs):
+    for n, (name, function, field) in enumerate(metrics):
+        if field is None:
+            state[n] += len(docs)
+            continue
+
+        values = [doc[field] for doc in docs if field in doc]
+        if function == "count":
+            state[n] += len(values)
+            continue
+
+        # True and False are not counted as numbers
+        numbers = [i for i in values if type(i) is int or type(i) is float]
+        if function == "sum":
+            state[n] += sum(numbers)
+        elif function == "avg":
+            state[n][0] += sum(numbers)
+            state[n][1] += len(numbers)
+        elif values:
+            pick = min if function == "min" else max
+            # Numbers compare as they are, other values by their sortKey
+            if len(numbers) == len(values):
+                value = pick(numbers)
+                pair = (sortKey(value), value)
+            else:
+                pair = pick(((sortKey(i), i) for i in values), key=lambda p: p[0])
+            state[n] = pickValue(state[n], pair, function)
+
+# This function keeps the smaller or bigger of a (sortKey, value) pair and the
+# pair kept so far, which is None at first
+def pickValue(kept, pair, function: str):
+    if kept is None:
+        return pair
+    if function == "min":
+        return pair if pair[0] < kept[0] else kept
+    return pair if pair[0] > kept[0] else kept
+
+# The results of the metrics, by their names
+def finishMetrics(state, metrics):
+    result = {}
+    for value, (name, function, field) in zip(state, metrics):
+        if function == "avg":
+            value = value[0] / value[1] if value[1] else None
+        elif function in ("min", "max"):
+            value = None if value is None else value[1]
+        result[name] = value
+    return result
+
+# The key a value is grouped by. Values that can't be dict keys, like lists, go by their JSON text.
+def groupKey(value):
+    try:
+        hash(value)
+        return (0, value)
+    except TypeError:
+        return (1, indexKey(value))
+
+# The number of documents an index holds, the ones that have the field
+def indexSize(index):
+    if index["kind"] == "hash":
+        return sum(len(i) for i in index["map"].values())
+    return len(index["entries"])
+
+# This function yields the (value, number of documents) pairs of an index,
+# in the order of the values for sorted indexes
+def indexGroups(index):
+    if index["kind"] == "hash":
+        for key, positions in index["map"].items():
+            yield index["values"][key], len(positions)
+    else:
+        for rank, group in itertools.groupby(index["entries"], lambda e: tuple(e[:2])):
+            yield entryValue(rank), sum(1 for i in group)
+
+# This function turns the [rank, value] of a sorted index entry back into the value
+def entryValue(rank):
+    return json.loads(rank[1]) if rank[0] == 2 else rank[1]
+
+# Tables with fewer stored documents than this are always scanned in one process,
+# starting the work in other processes would take longer than the scan itself
+PARALLEL_THRESHOLD = 20000
+
+# This function matches the documents of some segments of a .segments file against
+# the filters. It runs in the worker processes of a parallel scan, see table.get.
+# @returns <list>: The matching documents, in table order
+def scanSegments(key, path: str, segments, filters, projection=None):
+    cipher = getCipher(key)
+    match = compileFilters(filters)
+    # Fields left out of the result are not sent back to the caller either
+    project = compileProjection(*projection) if projection else None
+    output = []
+    with open(path, "rb") as data:
+        for i in segments:
+            data.seek(i["offset"])
+            docs = decodePayload(decompressPayload(cipher.decrypt(data.read(i["length"]))))
+            docs = (doc for doc in docs if match(doc))
+            output.extend(map(project, docs) if project else docs)
+    return output
+
+# The least bytes the journal of the indexes of a table may grow to before the
+# indexes are written again in full, see table._saveIndexes
+INDEX_LOG_LIMIT = 64 << 10
+
+# The worker processes of the parallel scans, by the number of workers. They are
+# started by the first scan that needs them and kept for the next ones.
+processPools = {}
+processPoolsLock = threading.Lock()
+
+# This function returns the pool of worker processes of the given size
+def processPool(workers: int):
+    with processPoolsLock:
+        if workers not in processPools:
+            processPools[workers] = concurrent.futures.ProcessPoolExecutor(workers)
+        return processPools[workers]
+
+class lruCache:
+    def __init__(self, maxBytes: int = 64 << 20, maxEntries: int = 4096):
+        """
+            A cache that drops its least recently used entries once it holds more than
+            'maxBytes' bytes or 'maxEntries' entries. It is safe to use from many threads.
+            @param maxBytes <int> [Optional]: The most bytes the entries may add up to. Default: 64 MiB.
+            @param maxEntries <int> [Optional]: The most entries to keep. Default: 4096.
+        """
+        self.maxBytes = int(maxBytes)
+        self.maxEntries = int(maxEntries)
+
+        # Entries from the least to the most recently used, with their sizes
+        self.entries = collections.OrderedDict()
+        self.size = 0
+
+        # How often a lookup found its entry, and how often it did not
+        self.hits = 0
+        self.misses = 0
+
+        self.lock = threading.Lock()
+
+    # Get an entry, or None if it is not cached
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    # Add an entry that takes up about 'size' bytes
+    def put(self, key, value, size: int):
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[0]
+            # Entries bigger than the whole cache are not kept at all
+            if size > self.maxBytes:
+                return
+            self.entries[key] = (size, value)
+            self.size += size
+            self._evict()
+
+    # Drop all the entries of one file, keys start with the path of their file
+    def discard(self, path: str):
+        with self.lock:
+            for key in [i for i in self.entries if i[0] == path]:
+                self.size -= self.entries.pop(key)[0]
+
+    # Change the limits of the cache, dropping entries if they are over the new ones
+    def resize(self, maxBytes: int = None, maxEntries: int = None):
+        with self.lock:
+            if maxBytes is not None:
+                self.maxBytes = int(maxBytes)
+            if maxEntries is not None:
+                self.maxEntries = int(maxEntries)
+            self._evict()
+
+    # Drop the least recently used entries until the cache is within its limits
+    def _evict(self):
+        while self.entries and (
+            self.size > self.maxBytes or len(self.entries) > self.maxEntries
+        ):
+            self.size -= self.entries.popitem(last=False)[1][0]
+
+# The decrypted segments of every table opened by this process. The size of a
+# segment is counted as the size of its encrypted blob.
+segmentCache = lruCache()
+
+# Function to set the limits of the decrypted segment cache
+def setCacheLimits(maxBytes: int = None, maxEntries: int = None):
+    """
+        This function sets how much of the decrypted tables are kept in memory and
+        shared by all the table objects of this program. A limit of 0 turns the cache off.
+        @param maxBytes <int> [Optional]: The most bytes of encrypted segments to keep decrypted. Default: 64 MiB.
+        @param maxEntries <int> [Optional]: The most segments to keep decrypted. Default: 4096.
+        @returns None
+    """
+    segmentCache.resize(maxBytes, maxEntries)
+
+# The number of writes this process made to every table, by the path of the table.
+# Preloaded tables compare it with the count they were loaded at to see if they are stale.
+tableWrites = collections.Counter()
+
+# How the writes of a table reach the drive:
+#   "commit": every write is on the drive before it returns
+#   "interval": the files written are flushed to the drive in the background, every few ms
+#   "os": the operating system decides when
+# Programs that crash lose nothing either way, the files are written all the same. But
+# a crash of the whole machine may lose the last writes of a table that does not use
+# "commit", or leave the files of those writes half written.
+DURABILITY = ("commit", "interval", "os")
+
+# This function makes sure a durability policy can be used
+def checkDurability(durability: str, interval: int = None):
+    if durability not in DURABILITY:
+        raise ValueError(
+            f"The durability `{durability}` is not valid. Must be one of {', '.join(DURABILITY)}"
+        )
+    if interval is not None and interval <= 0:
+        raise ValueError("The interval of the durability must be more than 0 ms.")
+
+class syncer:
+    def __init__(self):
+        """
+            Flushes files to the drive in the background, a while after they were written.
+            Used by the tables with the "interval" durability.
+        """
+        self.pending = {}  # Path -> time by which the file has to be flushed
+        self.cond = threading.Condition()
+        self.thread = None  # Only runs while there are files to flush
+
+    # Flush a file to the drive within 'interval' seconds
+    def add(self, path: str, interval: float):
+        with self.cond:
+            deadline = time.monotonic() + interval
+            self.pending[path] = min(self.pending.get(path, deadline), deadline)
+
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self._run, name="PumpkinDB syncer", daemon=True
+                )
+                self.thread.start()
+            self.cond.notify()
+
+    # Flush the files now, all of them or the ones given
+    def flush(self, paths=None):
+        with self.cond:
+            paths = [i for i in (self.pending if paths is None else paths) if i in self.pending]
+            for i in paths:
+                del self.pending[i]
+        self._sync(paths)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                if not self.pending:
+                    self.thread = None
+                    return
+
+                now = time.monotonic()
+                due = [i for i, deadline in self.pending.items() if deadline <= now]
+                if not due:
+                    self.cond.wait(min(self.pending.values()) - now)
+                    continue
+                for i in due:
+                    del self.pending[i]
+            self._sync(due)
+
+    # Flush files to the drive. Files removed in the meantime need no flushing.
+    @staticmethod
+    def _sync(paths):
+        for path in paths:
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except FileNotFoundError:
+                continue
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+# Flushes the files of every table with the "interval" durability
+fileSyncer = syncer()
+
+class writeLock:
+    def __init__(self, path: str = None):
+        """
+            The lock writers of a table take, one writer at a time. Readers never take it,
+            they read a version of the table that writers leave alone, see tableSnapshot.
+            A thread may lock again what it already holds.
+            With a path, an exclusive fcntl lock on that file extends the lock to the
+            writers of the other processes.
+            @param path <str> [Optional]: The lock file. Default: None, only lock within the process.
+        """
+        self.path = path
+        self.fd = None
+
+        self.cond = threading.Condition()
+        self.writer = None  # Thread id of the writer
+        self.writes = 0  # How many times the writer holds the lock
+
+        # How many times the lock was taken, and the seconds spent waiting for it,
+        # the lock file of the other processes included
+        self.acquired = 0
+        self.waited = 0.0
+
+    # A forked child gets a copy of the lock, along with the lock file its parent opened.
+    # flock does not keep apart the holders of the same open file, so the child opens
+    # the lock file again. The threads that held or waited for the lock are not in
+    # the child, it starts with the lock free.
+    def _afterFork(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        self.cond = threading.Condition()
+        self.writer = None
+        self.writes = 0
+        self.acquired = 0
+        self.waited = 0.0
+
+    # Lock or unlock the lock file, while holding self.cond. 'op' is
+    # the name of the flock operation: LOCK_EX or LOCK_UN.
+    def _flock(self, op: str):
+        if self.path is None or fcntl is None:
+            return
+        if self.fd is None:
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(self.fd, getattr(fcntl, op))
+
+    def acquire_write(self):
+        me = threading.get_ident()
+        with self.cond:
+            if self.writer == me:
+                self.writes += 1
+                return
+
+            start = time.perf_counter()
+            while self.writer is not None:
+                self.cond.wait()
+
+            self._flock("LOCK_EX")
+            self.writer, self.writes = me, 1
+            self.acquired += 1
+            self.waited += time.perf_counter() - start
+
+    def release_write(self):
+        with self.cond:
+            self.writes -= 1
+            if self.writes:
+                return
+
+            self.writer = None
+            self._flock("LOCK_UN")
+            self.cond.notify()
+
+    # Hold the lock in a with block
+    @contextlib.contextmanager
+    def writing(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+# Decorator for table methods that write the table files, holding its write lock
+def writes(method):
+    @functools.wraps(method)
+    def locked(self, *args, **kwargs):
+        with self._lock.writing():
+            return method(self, *args, **kwargs)
+    return locked
+
+# The lock of every table opened by this process, by the path of the table
+tableLocks = {}
+tableLocksLock = threading.Lock()
+
+# This function returns the lock of a table, shared by all its table objects
+def getLock(path: str):
+    with tableLocksLock:
+        if path not in tableLocks:
+            tableLocks[path] = writeLock(path[: -len(".tables")] + ".lock")
+        return tableLocks[path]
+
+# Function to get how much the tables of this process waited for their locks
+def lockStats():
+    """
+        This function tells how often the lock of every table opened by this process
+        was taken, and how long it was waited for. Writers wait for each other, and
+        for the writers of other processes through the lock files.
+        @returns <dict>: By the path of the table, a dict of the times the lock was
+        "acquired" and the seconds "waited" for it
+    """
+    with tableLocksLock:
+        locks = list(tableLocks.items())
+    return {path: {"acquired": i.acquired, "waited": i.waited} for path, i in locks}
+
+# This function runs in the child process of a fork. The threads of the parent are
+# not there, so the locks they held are made anew, and the worker processes and the
+# background flushes of the parent are left to the parent.
+def afterFork():
+    global tableLocksLock, processPoolsLock
+    tableLocksLock = threading.Lock()
+    for lock in tableLocks.values():
+        lock._afterFork()
+
+    processPoolsLock = threading.Lock()
+    processPools.clear()
+    segmentCache.lock = threading.Lock()
+    statementCache.lock = threading.Lock()
+    fileSyncer.cond = threading.Condition()
+    fileSyncer.pending = {}
+    fileSyncer.thread = None
+
+# Windows has no fork
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=afterFork)
 
 class table:
-    def __init__(self, name, parent, safeMode: bool = True, preLoad: bool = False):
+    def __init__(
+        self,
+        name,
+        parent,
+        safeMode: bool = True,
+        preLoad: bool = False,
+        logLimit: int = 1 << 20,
+        segmentSize: int = 1000,
+    ):
         """
             The class represents a single data table of the name 'name'.
             @param name <str>: Name of the current table
@@ -227,6 +1211,10 @@ class table:
             @param preLoad <bool>. [Optional]: Whether to preLoad table data or not.
                                                 This speeds up query speeds by loading data into
                                                 memory. Default: False.
+            @param logLimit <int> [Optional]: Size in bytes the write-ahead log may grow to before
+                                                it is folded into the table file. Default: 1 MiB.
+            @param segmentSize <int> [Optional]: Number of documents stored in one encrypted
+                                                segment of the table. Default: 1000.
             WARNING: Using preLoad setting loads data into memory, so if your table is big, then it
             is recommended NOT to use this option. Don't use this also if you are low on memory.
         """
@@ -235,22 +1223,1407 @@ class table:
         self.name = name
         self.safeMode = safeMode
         self.preLoad = preLoad
+        self.logLimit = int(logLimit)
+        self.segmentSize = max(1, int(segmentSize))
 
         # Inherit some things from the parent databse
         self.parent = parent
         self.path = f"{parent.dbPath}/db/{self.parent.name}/{self.name}.tables"
+        self.segPath = f"{parent.dbPath}/db/{self.parent.name}/{self.name}.segments"
+        self.indexPath = f"{parent.dbPath}/db/{self.parent.name}/{self.name}.indexes"
+        self.indexLogPath = f"{parent.dbPath}/db/{self.parent.name}/{self.name}.indexlog"
+        self.logPath = f"{parent.dbPath}/db/{self.parent.name}/{self.name}.log"
         self.key = parent.key
+        # The cipher of the database, shared by all its tables
+        self.cipher = parent.cipher
+        # The codec and compression the table is written with, see db.createTable
+        self.codec = getattr(parent, "codecs", {}).get(name, "json")
+        self.compression = tuple(getattr(parent, "compressions", {}).get(name, (None, None)))
+
+        # The batch of changes each thread is collecting, see table.batch
+        self._local = threading.local()
+
+        # The lock of the table, shared by every table object of the same table
+        self._lock = getLock(self.path)
+
+        # The count of tableWrites the preloaded data was loaded at
+        self._dataVersion = None
+
+        # How the writes reach the drive, see setDurability
+        self.durability = getattr(parent, "durability", "commit")
+        self.syncInterval = getattr(parent, "syncInterval", 1000)
+
+        # The changes waiting to be written in the background, None without
+        # write-behind, see setWriteBehind
+        self._queue = None
+        self._queueCond = threading.Condition()
+        self._committing = threading.Lock()  # Queued changes are written one group at a time
+        self._writer = None  # The thread writing the queue, while there is a queue
+        self._writeError = None  # What went wrong writing the queue in the background
+
+        # Tables of a database with write-behind queue their changes too
+        if getattr(parent, "writeBehind", False):
+            self.setWriteBehind()
 
         # If the preLoad method is enabled
         if preLoad:
             self.fetch_data()
 
+    # Encrypt a python object so that it can be written to the drive
+    def _encode(self, obj):
+        payload = compressPayload(encodePayload(obj, self.codec), *self.compression)
+        return self.cipher.encrypt(payload)
+
+    # Decrypt a blob read from the drive back into a python object. The blob may
+    # have been written with any codec and compression, not just the ones of the table.
+    def _decode(self, blob):
+        return decodePayload(decompressPayload(self.cipher.decrypt(blob)))
+
+    # Read the manifest of the table.
+    # The .tables file holds a small encrypted manifest that records where each
+    # segment of documents lives inside the .segments file. Tables written before
+    # segmented storage hold the whole list of documents instead.
+    def _readManifest(self):
+        with open(self.path, "rb") as f:
+            return self._decode(f.read())
+
+    # Get the manifest of the table ready to be changed. Old single-list
+    # tables are split into segments here, on their first write.
+    def _loadManifest(self):
+        manifest = self._readManifest()
+
+        if isinstance(manifest, list):
+            docs, manifest = manifest, emptyManifest()
+            # Number the documents in table order
+            for i, doc in enumerate(docs):
+                doc["_id"] = i
+            manifest["segments"] = self._writeSegments(manifest, self._chunk(docs))
+            manifest["nextId"] = len(docs)
+
+        # Segments written before document ids are numbered and written again, once
+        elif "nextId" not in manifest:
+            segments = manifest["segments"]
+            manifest["segments"] = []
+            manifest["garbage"] += sum(i["length"] for i in segments)
+            manifest["nextId"] = 0
+            for docs in self._iterStored({"segments": segments}):
+                manifest["segments"] += self._writeSegments(manifest, [docs])
+                manifest["nextId"] += len(docs)
+
+        return manifest
+
+    # Flush a file the table has written to the drive, as its durability asks.
+    # 'f' is the file, still open.
+    def _sync(self, f):
+        f.flush()
+        if self.durability == "commit":
+            os.fsync(f.fileno())
+        elif self.durability == "interval":
+            fileSyncer.add(f.name, self.syncInterval / 1000)
+
+    # Replace a file of the table, see replaceFile
+    def _replaceFile(self, path: str, contents):
+        replaceFile(path, contents, sync=self.durability == "commit")
+        if self.durability == "interval":
+            fileSyncer.add(path, self.syncInterval / 1000)
+
+    # Save the manifest of the table. The new manifest takes the place of the old one
+    # at once, readers get either of the two and the segments both of them point to.
+    def _writeManifest(self, manifest):
+        # Reclaim the space of rewritten segments once it outweighs the live data
+        live = sum(i["length"] for i in manifest["segments"])
+        old = None
+        if manifest["garbage"] > live:
+            old = self._compact(manifest)
+
+        manifest["version"] = manifest.get("version", 0) + 1
+        self._replaceFile(self.path, self._encode(manifest))
+        tableWrites[self.path] += 1
+
+        # Nothing points to the old .segments file anymore. Readers that opened it
+        # keep reading it, the file is gone once they close it.
+        if old is not None:
+            segmentCache.discard(old)
+            try:
+                os.remove(old)
+            # Windows does not remove open files, the next drop of the table does
+            except OSError:
+                pass
+
+    # Split a list of documents into segment sized chunks
+    def _chunk(self, docs):
+        return [
+            docs[i : i + self.segmentSize] for i in range(0, len(docs), self.segmentSize)
+        ]
+
+    # The .segments file holding the segments of a manifest. Compacting a table moves
+    # its segments to a new file, see _compact. Tables that were never compacted
+    # since keep theirs in the file named after the table.
+    def _segmentsPath(self, manifest):
+        if isinstance(manifest, dict) and "segmentsFile" in manifest:
+            return f"{os.path.dirname(self.path)}/{manifest['segmentsFile']}"
+        return self.segPath
+
+    # Append encrypted segments to the .segments file of a manifest. They are flushed
+    # to the drive before any manifest pointing to them is written.
+    def _writeSegments(self, manifest, chunks):
+        # Describe every new segment for the manifest
+        segments = []
+
+        if not chunks:
+            return segments
+
+        with open(self._segmentsPath(manifest), "ab") as data:
+            # New segments go to the end of the file, old ones are never overwritten
+            offset = data.seek(0, os.SEEK_END)
+            for docs in chunks:
+                blob = self._encode(docs)
+                data.write(blob)
+                segments.append(
+                    {
+                        "offset": offset,
+                        "length": len(blob),
+                        "count": len(docs),
+                        # The _id range of the segment, ids grow in table order
+                        "first": docs[0].get("_id"),
+                        "last": docs[-1].get("_id"),
+                    }
+                )
+                offset += len(blob)
+            self._sync(data)
+
+        return segments
+
+    # Read and decrypt one segment from an open .segments file. Decrypted segments
+    # are shared through segmentCache by every table object of the process.
+    # WARNING: The documents returned are shared, they must never be changed in place.
+    def _readSegment(self, data, segment, manifest):
+        # Segments are never changed once written, so a segment is known by its
+        # file and its place in the file
+        key = (self._segmentsPath(manifest), manifest.get("file"), segment["offset"])
+        docs = segmentCache.get(key)
+        if docs is None:
+            data.seek(segment["offset"])
+            docs = self._decode(data.read(segment["length"]))
+            segmentCache.put(key, docs, segment["length"])
+        return docs
+
+    # Copy the segments still in use to a new .segments file. The old file is left as
+    # it is for the readers of older manifests, _writeManifest removes it once the
+    # manifest pointing to the new file is written. Returns the path of the old file.
+    def _compact(self, manifest):
+        old = self._segmentsPath(manifest)
+
+        # The file is named after the table and a random token. Table names have no dots.
+        manifest["file"] = os.urandom(8).hex()
+        manifest["segmentsFile"] = f"{self.name}.{manifest['file']}.segments"
+
+        with open(old, "rb") as data, open(self._segmentsPath(manifest), "wb") as out:
+            # Write them back to back and record their new offsets
+            offset = 0
+            for i in manifest["segments"]:
+                data.seek(i["offset"])
+                out.write(data.read(i["length"]))
+                i["offset"] = offset
+                offset += i["length"]
+            self._sync(out)
+
+        manifest["garbage"] = 0
+        return old
+
+    # Yield the segments written to the table file, without the write-ahead log.
+    # With a batch size, segments are read until they hold that many documents.
+    # 'data' is the .segments file of the manifest, if it was opened already.
+    def _iterStored(self, manifest, batchSize: int = None, data=None):
+        # A table in the old format is a single segment
+        if isinstance(manifest, list):
+            # Its documents are numbered by position until its first write
+            for i, doc in enumerate(manifest):
+                doc["_id"] = i
+            yield manifest
+        elif manifest["segments"]:
+            # So are the documents of segments written before document ids
+            position = None if "nextId" in manifest else 0
+
+            with self._openSegments(manifest, data) as data:
+                batch = []
+                for i in manifest["segments"]:
+                    docs = self._readSegment(data, i, manifest)
+                    if position is not None:
+                        for doc in docs:
+                            doc["_id"] = position
+                            position += 1
+                    batch.extend(docs)
+                    if batchSize is None or len(batch) >= batchSize:
+                        yield batch
+                        batch = []
+                if batch:
+                    yield batch
+
+    # Yield the stored documents at the given positions, decrypting
+    # only the segments that hold one of them
+    def _iterPositions(self, manifest, positions, ordered: bool = False, data=None):
+        # Position of the first document of every segment
+        starts, total = [], 0
+        for i in manifest["segments"]:
+            starts.append(total)
+            total += i["count"]
+
+        if positions:
+            with self._openSegments(manifest, data) as data:
+                # Decrypt each segment just once. Positions in table order need just
+                # the current segment, positions in index order may jump back and forth.
+                cache = {}
+                for position in positions:
+                    n = bisect.bisect_right(starts, position) - 1
+                    if n not in cache:
+                        if not ordered:
+                            cache.clear()
+                        cache[n] = self._readSegment(data, manifest["segments"][n], manifest)
+                    yield cache[n][position - starts[n]]
+
+    # Open the .segments file of a manifest, unless it was opened already
+    def _openSegments(self, manifest, data=None):
+        if data is None:
+            return open(self._segmentsPath(manifest), "rb")
+        return contextlib.nullcontext(data)
+
+    # Get the documents of the write-ahead log that are not part of the table file yet.
+    # 'log' is the epoch and documents of the log, if it was read already.
+    def _liveLog(self, manifest, log=None):
+        epoch, logged = self._readLog() if log is None else log
+        # A log older than the manifest was already folded in before a crash
+        if isinstance(manifest, dict) and epoch < manifest["logEpoch"]:
+            return []
+
+        # Documents logged before document ids are numbered after the stored ones
+        first = storedNextId(manifest)
+        for i, doc in enumerate(logged):
+            doc.setdefault("_id", first + i)
+        return logged
+
+    # Read the indexes of the table. Indexes cover the documents stored in segments,
+    # the few documents still in the write-ahead log are always scanned.
+    # Writers, holding the write lock, get a copy of the indexes to change, and stale
+    # indexes rebuilt. Readers pass rebuild=False and get the indexes shared by the
+    # readers of the table object, which are never changed, or no indexes if they are
+    # stale. The next write to the table rebuilds them.
+    def _loadIndexes(self, manifest, rebuild: bool = True):
+        # The decrypted indexes are kept for as long as the table does not change
+        version = None if isinstance(manifest, list) else manifest.get("version", 0)
+        cached = getattr(self, "_indexCache", None)
+        if cached is not None and cached[0] == version:
+            if rebuild:
+                return {i: copyIndex(index) for i, index in cached[1].items()}
+            return cached[1]
+
+        try:
+            with open(self.indexPath, "rb") as f:
+                d = self._decode(f.read())
+        # The table has no indexes
+        except FileNotFoundError:
+            return {}
+
+        indexes = d["indexes"]
+
+        # Hash indexes written before they kept the values of their keys are rebuilt
+        old = any(i["kind"] == "hash" and "values" not in i for i in indexes.values())
+        stamp = None if old else self._replayIndexLog(d["version"], indexes)
+
+        # The table was changed without updating the indexes, so rebuild them
+        if version is None or stamp != version:
+            if not rebuild:
+                return {}
+            if version is None:
+                manifest = self._loadManifest()
+                self._writeManifest(manifest)
+            indexes = {i: self._buildIndex(manifest, i, indexes[i]["kind"]) for i in indexes}
+            self._saveIndexes(manifest, indexes)
+
+        self._indexCache = (manifest["version"], indexes)
+        if rebuild:
+            return {i: copyIndex(index) for i, index in indexes.items()}
+        return indexes
+
+    # Save the indexes of the table, stamped with the manifest they belong to.
+    # Writes that pass the 'changes' they made to the indexes, see _reindex, and the
+    # documents they 'added', as (position, document), just append those to the
+    # journal of the indexes. The whole file is written again once the journal grows
+    # past a quarter of it, or INDEX_LOG_LIMIT.
+    def _saveIndexes(self, manifest, indexes, changes=None, added=None):
+        self._indexCache = None
+
+        # Dropping the last index removes the files
+        if not indexes:
+            if os.path.exists(self.indexPath):
+                os.remove(self.indexPath)
+            self._resetIndexLog()
+            return
+
+        if changes is not None or added is not None:
+            try:
+                size = os.path.getsize(self.indexLogPath)
+            except FileNotFoundError:
+                size = 0
+            if os.path.exists(self.indexPath) and size < max(
+                os.path.getsize(self.indexPath) // 4, INDEX_LOG_LIMIT
+            ):
+                self._appendIndexLog(manifest, indexes, changes or [], added or [])
+                self._indexCache = (manifest["version"], indexes)
+                return
+
+        self._replaceFile(
+            self.indexPath, self._encode({"version": manifest["version"], "indexes": indexes})
+        )
+        # The journal holds changes up to this version, which are in the file now
+        self._resetIndexLog()
+        self._indexCache = (manifest["version"], indexes)
+
+    # Append the changes a write made to the indexes to their journal. Only the
+    # values of the indexed fields are kept. Every write of the manifest bumps its
+    # version by one, so the changes lead from the version before to this one.
+    def _appendIndexLog(self, manifest, indexes, changes, added):
+        fields = list(indexes)
+        pick = lambda doc: None if doc is None else {i: doc[i] for i in fields if i in doc}
+        record = {
+            "from": manifest["version"] - 1,
+            "version": manifest["version"],
+            "changes": [[position, pick(old), pick(new)] for position, old, new in changes],
+            "added": [[position, pick(doc)] for position, doc in added],
+        }
+        with open(self.indexLogPath, "ab") as f:
+            f.write(packRecord(self._encode(record)))
+            self._sync(f)
+
+    # Apply the journal of the indexes to the indexes read from the file at 'version'.
+    # Returns the version of the manifest the indexes are in step with now. Changes
+    # from before the file was written, left by a crash, don't follow on from its
+    # version and are skipped.
+    # Documents removed move the ones after them up. Rather than moving the whole index
+    # for every write that removed some, the positions are kept as they were numbered
+    # in the file, and moved up once at the end.
+    def _replayIndexLog(self, version, indexes):
+        removed = []  # Positions deleted since the file was written, in its numbering
+
+        # The position in the numbering of the file of the document at 'position' now
+        def original(position):
+            i = position
+            while True:
+                j = position + bisect.bisect_right(removed, i)
+                if i == j:
+                    return i
+                i = j
+
+        try:
+            with open(self.indexLogPath, "rb") as f:
+                for blob in readRecords(f):
+                    record = self._decode(blob)
+                    if record["from"] != version:
+                        continue
+
+                    gone = []
+                    for position, old, new in record["changes"]:
+                        position = original(position)
+                        for field, index in indexes.items():
+                            if field in old:
+                                indexRemove(index, old[field], position)
+                            if new is not None and field in new:
+                                indexAdd(index, new[field], position)
+                        if new is None:
+                            gone.append(position)
+                    for position in gone:
+                        bisect.insort(removed, position)
+
+                    for position, doc in record["added"]:
+                        position = original(position)
+                        for field, index in indexes.items():
+                            if field in doc:
+                                indexAdd(index, doc[field], position)
+                    version = record["version"]
+
+        # Nothing changed since the file was written
+        except FileNotFoundError:
+            pass
+
+        if removed:
+            for index in indexes.values():
+                indexShift(index, removed)
+        return version
+
+    # Empty the journal of the indexes
+    def _resetIndexLog(self):
+        try:
+            os.remove(self.indexLogPath)
+        except FileNotFoundError:
+            pass
+
+    # Build an index over one field from the stored documents
+    def _buildIndex(self, manifest, field, kind):
+        index = {"kind": kind, "entries": []}
+        if kind == "hash":
+            index = {"kind": kind, "map": {}, "values": {}}
+        position = 0
+
+        for docs in self._iterStored(manifest):
+            for doc in docs:
+                if field in doc:
+                    indexAdd(index, doc[field], position)
+                position += 1
+        return index
+
+    # Decide how a query is run. Returns the positions of the stored documents that
+    # can match the filters, or None if the whole table has to be scanned, and
+    # whether those positions are already in the order asked for by 'sortby'.
+    # A descending order walks the sort index backwards. Walks of the whole
+    # table yield the positions as they go, see indexWalk.
+    def _plan(self, manifest, indexes, filters, sortby: str = None, descending: bool = False):
+        best, bestField = None, None
+        for field, value in filters.items():
+            if field not in indexes:
+                continue
+            positions = indexLookup(indexes[field], value)
+            # The most selective index wins
+            if positions is not None and (best is None or len(positions) < len(best)):
+                best, bestField = positions, field
+
+        ordered = sortby in indexes and indexes[sortby]["kind"] == "sorted"
+
+        # Walk the whole table in the order of the sort index
+        if best is None and ordered:
+            total = sum(i["count"] for i in manifest["segments"])
+            if not total:
+                return [], True
+            return indexWalk(indexes[sortby], total, descending), True
+
+        # The candidates came from the sort index, so they are in order already
+        if best is not None and ordered and bestField == sortby:
+            return (best[::-1] if descending else best), True
+
+        # Otherwise read the candidates in table order
+        return (None if best is None else sorted(best)), False
+
+    # Yield the documents that match the filters, in the order asked for by 'sortby'.
+    # Only the documents up to 'offset' + 'limit' are ever looked at or sorted.
+    # Without 'copy' the documents are the shared ones, which must not be changed.
+    def _query(
+        self,
+        filters,
+        sortby: str = None,
+        limit: int = None,
+        offset: int = 0,
+        descending: bool = False,
+        batchSize: int = None,
+        snapshot=None,
+        workers: int = None,
+        copy: bool = True,
+        fields=None,
+        exclude=None,
+    ):
+        # Nothing past this point of the result is needed
+        stop = None if limit is None else offset + limit
+
+        # Compile the filters once, bad filters are reported before the scan starts
+        match = compileFilters(filters)
+
+        # The results are built from the fields asked for, rather than copied whole
+        project = compileProjection(fields, exclude) if copy else None
+
+        # Queued changes are written first, so that they are read as well
+        if snapshot is None:
+            self._readOwnWrites()
+
+        # Inside a batch its copy of the table is read. A snapshot reads the table files.
+        state = None if snapshot is not None else self._activeBatch()
+        if state is not None:
+            source = itertools.chain(
+                (i for n, docs in self._batchSegments(state) for i in docs), state["new"]
+            )
+        # load data from memory if preLoad is enabled
+        elif self.preLoad and snapshot is None:
+            self._refresh()
+            source = self.data
+        else:
+            source = None
+
+        if source is not None:
+            output = (i for i in source if match(i))
+            if sortby:
+                output = sortDocs(output, sortby, descending, stop)
+            # Hand out copies, so that changing a result does not change the cached documents
+            output = itertools.islice(output, offset, stop)
+            yield from map(project, output) if copy else output
+            return
+
+        # Queries read one version of the table, without locking it. Writers
+        # never change the files of a version, so they are not kept waiting.
+        view = tableSnapshot(self, indexes=False) if snapshot is None else snapshot
+        with contextlib.ExitStack() as stack:
+            if snapshot is None:
+                stack.enter_context(view)
+
+            manifest, data = view.manifest, view.data
+            positions, ordered = self._plan(manifest, view.indexes, filters, sortby, descending)
+
+            # No index helps, so scan the whole table. Big tables may be
+            # scanned by worker processes, which match the documents as well.
+            stored = None
+            if positions is None:
+                # Without a sort the first 'stop' matches in table order are enough
+                limit = None if sortby else stop
+                stored = self._scanParallel(
+                    manifest, filters, workers, sortby, fields, exclude, limit
+                )
+            if stored is None and positions is None:
+                stored = (i for docs in self._iterStored(manifest, batchSize, data) for i in docs)
+                stored = (i for i in stored if match(i))
+            elif stored is None:
+                stored = self._iterPositions(manifest, positions, ordered, data)
+                stored = (i for i in stored if match(i))
+            logged = (i for i in view.logged if match(i))
+
+            # Unsorted queries stop reading the table once enough documents matched
+            if not sortby:
+                output = itertools.chain(stored, logged)
+
+            # The write-ahead log is not indexed, so its matches are sorted
+            # and merged into the ordered stream of stored documents
+            elif ordered:
+                key = lambda d: docKey(d, sortby, descending)
+                # Walking the index backwards reverses documents with equal values as
+                # well, turn those back so that they stay in table order like in a sort
+                if descending:
+                    stored = (
+                        i
+                        for _, group in itertools.groupby(stored, key)
+                        for i in reversed(list(group))
+                    )
+                output = heapq.merge(
+                    stored, sortDocs(logged, sortby, descending), key=key, reverse=descending
+                )
+
+            # Otherwise keep just the top documents in a heap rather than sorting all matches
+            else:
+                output = sortDocs(itertools.chain(stored, logged), sortby, descending, stop)
+
+            # Hand out copies, so that changing a result does not change the cached documents
+            output = itertools.islice(output, offset, stop)
+            yield from map(project, output) if copy else output
+
+    # Match the stored documents against the filters in 'workers' processes, each
+    # decrypting and matching a share of the segments. Returns the matching documents
+    # in table order, or None if the table is better scanned in this process. With a
+    # projection the workers send back just those fields, and the one sorted on.
+    # With a 'limit' no more shares are handed out once that many documents matched.
+    def _scanParallel(
+        self,
+        manifest,
+        filters,
+        workers: int = None,
+        sortby: str = None,
+        fields=None,
+        exclude=None,
+        limit: int = None,
+    ):
+        workers = self._parallelWorkers(manifest, filters, workers)
+        if workers is None:
+            return None
+        segments = manifest["segments"]
+
+        # A few shares per worker, so that a worker done early takes another one
+        size = -(-len(segments) // (workers * 4))
+        shares = [segments[i : i + size] for i in range(0, len(segments), size)]
+        path = self._segmentsPath(manifest)
+
+        projection = None
+        if fields is not None or exclude:
+            if isinstance(fields, str):
+                fields = [fields]
+            if isinstance(exclude, str):
+                exclude = [exclude]
+            if sortby and fields is not None:
+                fields = [*fields, sortby]
+            if sortby and exclude:
+                exclude = [i for i in exclude if i != sortby]
+            projection = (fields, exclude)
+
+        pool = processPool(workers)
+        submit = lambda share: pool.submit(scanSegments, self.key, path, share, filters, projection)
+
+        # Two shares per worker are out at a time, and their results are taken in
+        # table order. The next share is handed out as each one comes back.
+        shares = iter(shares)
+        pending = collections.deque()
+        output = []
+        try:
+            pending.extend(map(submit, itertools.islice(shares, workers * 2)))
+            while pending:
+                output.extend(pending.popleft().result())
+                if limit is not None and len(output) >= limit:
+                    break
+                pending.extend(map(submit, itertools.islice(shares, 1)))
+            return output
+
+        # The table was compacted before the workers opened the file, this process
+        # still has it open. A worker that died takes its pool with it.
+        except FileNotFoundError:
+            return None
+        except concurrent.futures.process.BrokenProcessPool:
+            with processPoolsLock:
+                processPools.pop(workers, None)
+            return None
+        # The shares not needed anymore are not scanned
+        finally:
+            for i in pending:
+                i.cancel()
+
+    # The number of processes a scan of the table is run in, or None for this process
+    def _parallelWorkers(self, manifest, filters, workers: int = None):
+        workers = getattr(self.parent, "workers", None) if workers is None else workers
+        if not workers or workers < 2:
+            return None
+
+        # Documents without ids are numbered while they are read, in this process
+        if isinstance(manifest, list) or "nextId" not in manifest:
+            return None
+        if sum(i["count"] for i in manifest["segments"]) < PARALLEL_THRESHOLD:
+            return None
+
+        # The filters are sent to the workers, which can't be done with lambdas and the
+        # like. Custom filters have to be functions defined at the top of a module.
+        try:
+            pickle.dumps(filters)
+        except Exception:
+            return None
+        return workers
+
+    # Keep the indexes in step with documents changed in place or deleted
+    def _reindex(self, indexes, changes):
+        # Documents deleted from the table, the ones after them move up
+        removed = sorted(position for position, old, new in changes if new is None)
+
+        for field, index in indexes.items():
+            for position, old, new in changes:
+                if field in old:
+                    indexRemove(index, old[field], position)
+                if new is not None and field in new:
+                    indexAdd(index, new[field], position)
+
+            if removed:
+                indexShift(index, removed)
+
+    # Method to index a field of the table
+    @writes
+    def create_index(self, field: str, kind: str = "hash"):
+        """
+            This method creates a persistent index over one field of the table.
+            The index is kept up to date by every write.
+            A "hash" index answers equality filters ({field: value}) without scanning
+            the whole table. A "sorted" index answers equality and range filters
+            (__gt, __lt, __gte, __lte), and returns the documents already in order
+            when the query is sorted by the indexed field.
+            @param field <str>: The field to be indexed.
+            @param kind <str> [Optional]: The kind of index, "hash" or "sorted". Default: "hash".
+            @returns None
+        """
+        if kind not in ("hash", "sorted"):
+            raise ValueError(
+                f"The index kind `{kind}` is not valid. Must be one of hash, sorted"
+            )
+
+        # Index all the documents, including the pending inserts
+        self.checkpoint()
+        manifest = self._loadManifest()
+        self._writeManifest(manifest)
+
+        indexes = self._loadIndexes(manifest)
+        indexes[field] = self._buildIndex(manifest, field, kind)
+        self._saveIndexes(manifest, indexes)
+
+    # Method to delete an index of the table
+    @writes
+    def drop_index(self, field: str):
+        """
+            This method deletes the index over the field 'field'.
+            @param field <str>: The indexed field.
+            @returns None
+        """
+        manifest = self._readManifest()
+        indexes = self._loadIndexes(manifest)
+        indexes.pop(field, None)
+        self._saveIndexes(manifest, indexes)
+
+    # Read all the documents waiting in the write-ahead log
+    def _readLog(self):
+        # The log starts with a header holding its epoch. Every record
+        # after it holds one encrypted list of documents
+        docs, epoch = [], 0
+        try:
+            with open(self.logPath, "rb") as f:
+                head = f.read(len(LOG_MAGIC) + 8)
+                if head.startswith(LOG_MAGIC):
+                    (epoch,) = struct.unpack_from(">Q", head, len(LOG_MAGIC))
+                else:
+                    f.seek(0)
+
+                # A record cut short by a crash in the middle of an append
+                # never made it into the table, so it is left out
+                for blob in readRecords(f):
+                    docs.extend(self._decode(blob))
+
+        # No log means nothing has been inserted since the last checkpoint
+        except FileNotFoundError:
+            pass
+
+        return epoch, docs
+
+    # Append a list of documents to the write-ahead log
+    @writes
+    def _appendLog(self, docs):
+        # Inside a batch the documents are kept until the batch is written
+        state = self._activeBatch()
+        if state is not None:
+            for doc in docs:
+                doc["_id"] = state["nextId"]
+                state["nextId"] += 1
+            state["new"].extend(docs)
+            return
+
+        # The next free id is remembered between inserts, for as long as nobody
+        # else has written to the log or checkpointed the table in the meantime
+        state = self._logState()
+        stamp = self._manifestStamp()
+        cached = getattr(self, "_idCache", None)
+        if state is None or cached is None or cached[:2] != (stamp, state):
+            manifest = self._readManifest()
+            # A checkpoint that crashed before removing its log left it behind. Its
+            # documents are in the table already, and the new ones would be ignored
+            # along with it, so the log is started over.
+            stale = state is not None and not isinstance(manifest, list)
+            if stale and state[0] < manifest["logEpoch"]:
+                self._resetLog()
+                state = None
+            first = storedNextId(manifest) + len(self._liveLog(manifest))
+        else:
+            first = cached[2]
+
+        # Give every document the next free id
+        for i, doc in enumerate(docs):
+            doc["_id"] = first + i
+
+        record = packRecord(self._encode(docs))
+
+        # A new log is stamped with the epoch the manifest expects next
+        if state is None:
+            epoch = 0 if isinstance(manifest, list) else manifest["logEpoch"]
+            record = LOG_MAGIC + struct.pack(">Q", epoch) + record
+        else:
+            epoch = state[0]
+
+        with open(self.logPath, "ab") as f:
+            # Length and record are written together so a record is never interleaved
+            f.write(record)
+            self._sync(f)
+            size = f.tell()
+        tableWrites[self.path] += 1
+
+        self._idCache = (stamp, (epoch, size), first + len(docs))
+
+        # Fold the log into the table once it grows too big, so reads stay fast
+        if size > self.logLimit:
+            self.checkpoint()
+
+    # Tell apart the versions of the manifest without reading it. A new
+    # manifest replaces the file, see replaceFile, so the inode changes too.
+    def _manifestStamp(self):
+        try:
+            info = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return info.st_ino, info.st_mtime_ns, info.st_size
+
+    # Get the epoch and size of the write-ahead log, or None if there is no log
+    def _logState(self):
+        try:
+            with open(self.logPath, "rb") as f:
+                head = f.read(len(LOG_MAGIC) + 8)
+                size = f.seek(0, os.SEEK_END)
+        except FileNotFoundError:
+            return None
+
+        if head.startswith(LOG_MAGIC):
+            return struct.unpack_from(">Q", head, len(LOG_MAGIC))[0], size
+        return 0, size
+
+    # Empty the write-ahead log after its documents were written to the table file
+    def _resetLog(self):
+        try:
+            os.remove(self.logPath)
+        except FileNotFoundError:
+            pass
+
+    # Read all the documents of the table, including the ones still in the log
+    def _load(self):
+        with tableSnapshot(self, indexes=False) as view:
+            docs = [doc for docs in self._iterStored(view.manifest, data=view.data) for doc in docs]
+        # The documents still waiting in the write-ahead log come last
+        return docs + view.logged
+
+    # The JSON codec fails on values it can't write by itself, the others are checked
+    # before they are stored, see checkValues
+    def _checkValues(self, docs):
+        if self.codec != "json":
+            checkValues(docs)
+
+    # Method to fold the write-ahead log back into the table file
+    @writes
+    def checkpoint(self):
+        """
+            Inserted documents are first appended to a write-ahead log so that an insert
+            does not have to rewrite the whole table. This method writes the documents
+            in the log into the table file and empties the log. It runs automatically
+            whenever the log grows beyond 'logLimit' bytes.
+            @returns <int>: The number of documents moved from the log into the table.
+        """
+        epoch, logged = self._readLog()
+
+        # Nothing to do
+        if not logged:
+            self._resetLog()
+            return 0
+
+        manifest = self._loadManifest()
+        indexes = self._loadIndexes(manifest)
+
+        # This log was folded in already, a crash just kept it from being removed
+        if epoch < manifest["logEpoch"]:
+            self._resetLog()
+            return 0
+
+        segments = manifest["segments"]
+        folded = len(logged)
+
+        # Documents logged before document ids are numbered after the stored ones
+        for i, doc in enumerate(logged):
+            doc.setdefault("_id", manifest["nextId"] + i)
+        manifest["nextId"] = max(manifest["nextId"], logged[-1]["_id"] + 1)
+
+        # Add the logged documents to the indexes
+        start = sum(i["count"] for i in segments)
+        added = list(enumerate(logged, start))
+        for position, doc in added:
+            for field, index in indexes.items():
+                if field in doc:
+                    indexAdd(index, doc[field], position)
+
+        # Top up the last segment before starting new ones
+        if segments and segments[-1]["count"] < self.segmentSize:
+            tail = segments.pop()
+            with self._openSegments(manifest) as data:
+                logged = self._readSegment(data, tail, manifest) + logged
+            manifest["garbage"] += tail["length"]
+
+        # Write the logged documents as segments
+        segments.extend(self._writeSegments(manifest, self._chunk(logged)))
+        manifest["logEpoch"] = epoch + 1
+        self._writeManifest(manifest)
+        self._saveIndexes(manifest, indexes, added=added)
+
+        # The documents are safe in the table file now
+        self._resetLog()
+        return folded
+
+    # Apply a change to the stored documents that match the filters. Only
+    # the segments holding a matching document are decrypted again and rewritten.
+    @writes
+    def _rewrite(self, filters, change, limit: int = None):
+        # 'change' receives a matching document and returns its new
+        # version, or None if the document should be deleted.
+        # Compile the filters once, bad filters are reported before anything is written
+        match = compileFilters(filters)
+
+        # Inside a batch the change is only made to the batch's copy
+        state = self._activeBatch()
+        if state is not None:
+            return self._batchRewrite(state, match, change, limit)
+
+        # Whether the preloaded data holds all the writes made so far
+        fresh = self.preLoad and self._dataVersion == tableWrites[self.path]
+
+        # Pending inserts are folded in first so that they can be changed too
+        self.checkpoint()
+        manifest = self._loadManifest()
+        indexes = self._loadIndexes(manifest)
+
+        # Positions, old and new versions of the changed documents
+        changes = []
+        segments = []
+        position = 0
+
+        # An empty table has no .segments file yet
+        if not manifest["segments"]:
+            return changes
+
+        # With an index only the segments holding a candidate have to be read
+        candidates, ordered = self._plan(manifest, indexes, filters)
+
+        with self._openSegments(manifest) as data:
+            for i in manifest["segments"]:
+                # Past the limit the remaining segments stay as they are
+                if (limit is not None and len(changes) >= limit) or (
+                    candidates is not None
+                    and bisect.bisect_left(candidates, position)
+                    == bisect.bisect_left(candidates, position + i["count"])
+                ):
+                    segments.append(i)
+                    position += i["count"]
+                    continue
+
+                docs = self._readSegment(data, i, manifest)
+                before = len(changes)
+                out = []
+                for doc in docs:
+                    if (limit is None or len(changes) < limit) and match(doc):
+                        new = change(doc)
+                        changes.append((position, doc, new))
+                        if new is not None:
+                            out.append(new)
+                    else:
+                        out.append(doc)
+                    position += 1
+
+                # Untouched segments are kept
+                if len(changes) == before:
+                    segments.append(i)
+                    continue
+
+                # The old version of the segment is garbage now
+                manifest["garbage"] += i["length"]
+                # And empty segments are dropped altogether
+                if out:
+                    segments.extend(self._writeSegments(manifest, [out]))
+
+        # Nothing matched, so nothing needs to be written
+        if not changes:
+            return changes
+
+        manifest["segments"] = segments
+        self._writeManifest(manifest)
+
+        # Keep the indexes in step as well
+        if indexes:
+            self._reindex(indexes, changes)
+            self._saveIndexes(manifest, indexes, changes)
+
+        # Keep the in-mem cache in step with the data files. Stale
+        # data is loaded again by the next read instead.
+        if fresh:
+            for position, old, new in reversed(changes):
+                if new is None:
+                    del self.data[position]
+                else:
+                    self.data[position] = new
+            self._dataVersion = tableWrites[self.path]
+
+        return changes
+
+    # Get the batch this table is writing to, or None outside of a batch
+    def _activeBatch(self):
+        state = getattr(self._local, "batch", None)
+        if state is not None:
+            return state
+
+        batches = getattr(getattr(self.parent, "_local", None), "batches", None)
+        if batches is None:
+            return None
+
+        # The first use of a table inside db.batch starts its batch,
+        # after writing the changes queued before it
+        if self.name not in batches:
+            self._commit()
+            batches[self.name] = (self, self._beginBatch())
+        return batches[self.name][1]
+
+    # Start collecting changes against one decrypted copy of the table. The batch
+    # holds the write lock of the table until it ends, see _endBatch.
+    def _beginBatch(self):
+        self._lock.acquire_write()
+        try:
+            # Pending inserts are folded in first so that the batch holds all the documents
+            self.checkpoint()
+            manifest = self._loadManifest()
+        except BaseException:
+            self._lock.release_write()
+            raise
+
+        return {
+            "manifest": manifest,  # The manifest the batch started from
+            "docs": {},  # Decrypted segments, by their number in the manifest
+            "old": {},  # The decrypted segments as they were before the batch changed them
+            "new": [],  # Documents inserted by the batch
+            "nextId": manifest["nextId"],  # The _id the next inserted document gets
+        }
+
+    # Yield the number and documents of every segment of a batch, decrypting
+    # each segment the first time it is needed
+    def _batchSegments(self, state):
+        segments = state["manifest"]["segments"]
+        if not segments:
+            return
+
+        with self._openSegments(state["manifest"]) as data:
+            for n, i in enumerate(segments):
+                if n not in state["docs"]:
+                    state["docs"][n] = self._readSegment(data, i, state["manifest"])
+                yield n, state["docs"][n]
+
+    # Apply a change to the documents of a batch that match, like _rewrite does
+    # on the drive. Nothing is written until the batch is flushed.
+    def _batchRewrite(self, state, match, change, limit: int = None):
+        changes = []
+
+        def apply(docs):
+            out = []
+            for doc in docs:
+                if (limit is None or len(changes) < limit) and match(doc):
+                    new = change(doc)
+                    changes.append((None, doc, new))
+                    if new is not None:
+                        out.append(new)
+                else:
+                    out.append(doc)
+            return out
+
+        for n, docs in self._batchSegments(state):
+            if limit is not None and len(changes) >= limit:
+                return changes
+            before = len(changes)
+            out = apply(docs)
+            if len(changes) > before:
+                # Remember the segment as it was stored, for the indexes
+                state["old"].setdefault(n, docs)
+                state["docs"][n] = out
+
+        state["new"] = apply(state["new"])
+        return changes
+
+    # Write everything a batch changed at once: the changed segments, one
+    # manifest and the indexes
+    def _flushBatch(self, state):
+        manifest = state["manifest"]
+
+        # Nothing was changed
+        if not state["old"] and not state["new"]:
+            return
+
+        indexes = self._loadIndexes(manifest)
+
+        # Positions, old and new versions of the changed stored documents
+        changes = []
+        # Numbers of the segments to keep, with the documents of rewritten ones
+        kept = []
+        position = 0
+
+        for n, i in enumerate(manifest["segments"]):
+            if n not in state["old"]:
+                kept.append((n, None))
+                position += i["count"]
+                continue
+
+            # The old version of the segment is garbage now
+            manifest["garbage"] += i["length"]
+
+            # A batch only changes or deletes stored documents in place
+            docs = state["docs"][n]
+            new = {doc["_id"]: doc for doc in docs}
+            for doc in state["old"][n]:
+                if new.get(doc["_id"]) is not doc:
+                    changes.append((position, doc, new.get(doc["_id"])))
+                position += 1
+
+            # And empty segments are dropped altogether
+            if docs:
+                kept.append((n, docs))
+
+        # Top up the last segment with the inserted documents before starting new ones
+        inserted = state["new"]
+        if inserted and kept:
+            n, docs = kept[-1]
+            if docs is None and manifest["segments"][n]["count"] < self.segmentSize:
+                docs = state["docs"].get(n)
+                if docs is None:
+                    with self._openSegments(manifest) as data:
+                        docs = self._readSegment(data, manifest["segments"][n], manifest)
+                manifest["garbage"] += manifest["segments"][n]["length"]
+                kept.pop()
+                inserted = docs + inserted
+            elif docs is not None and len(docs) < self.segmentSize:
+                kept.pop()
+                inserted = docs + inserted
+
+        # Write all the new segments in one go
+        written = iter(
+            self._writeSegments(
+                manifest, [docs for n, docs in kept if docs is not None] + self._chunk(inserted)
+            )
+        )
+        manifest["segments"] = [
+            manifest["segments"][n] if docs is None else next(written) for n, docs in kept
+        ] + list(written)
+        manifest["nextId"] = state["nextId"]
+        self._writeManifest(manifest)
+
+        # Keep the indexes in step as well
+        if indexes:
+            self._reindex(indexes, changes)
+            # The inserted documents come after the stored ones that are left
+            position -= sum(1 for position, old, new in changes if new is None)
+            added = list(enumerate(state["new"], position))
+            for position, doc in added:
+                for field, index in indexes.items():
+                    if field in doc:
+                        indexAdd(index, doc[field], position)
+            self._saveIndexes(manifest, indexes, changes, added)
+
+        # Keep the in-mem cache in step with the data files
+        if self.preLoad:
+            self.fetch_data()
+
+    # Method to collect many changes and write them at once
+    @contextlib.contextmanager
+    def batch(self):
+        """
+            Every insert, update and remove normally writes to the drive on its own.
+            Inside a batch they are applied to one decrypted copy of the table instead,
+            and written with a single rewrite when the batch ends:
+                with table.batch():
+                    for i in range(1000):
+                        table.update({"n": i}, {"seen": True})
+            Reads inside the batch see its changes. If the block raises an exception
+            nothing of the batch is written. Batches inside a batch are part of it.
+            The table is locked for writing until the batch ends, other threads and
+            processes wait to write it. Their reads see the table as it was before the batch.
+            WARNING: The batch holds the decrypted table in memory until it ends.
+            @returns <table>: This table
+        """
+
+        # Inside another batch the changes are simply part of that one
+        if self._activeBatch() is not None:
+            yield self
+            return
+
+        # The changes queued before the batch come first
+        self._commit()
+        self._local.batch = self._beginBatch()
+        try:
+            yield self
+        # Nothing was written yet, so dropping the batch undoes it
+        except BaseException:
+            state, self._local.batch = self._local.batch, None
+            self._endBatch(state, flush=False)
+            raise
+
+        state, self._local.batch = self._local.batch, None
+        self._endBatch(state)
+
+    # End a batch, writing it unless it is dropped, and let go of the write lock
+    def _endBatch(self, state, flush: bool = True):
+        try:
+            if flush:
+                self._flushBatch(state)
+        finally:
+            self._lock.release_write()
+
+    # Whether the thread is inside a batch of this table or its database, without
+    # starting the batch of the table like _activeBatch does
+    def _inBatch(self):
+        batches = getattr(getattr(self.parent, "_local", None), "batches", None)
+        return getattr(self._local, "batch", None) is not None or batches is not None
+
+    # Method to choose how the writes of this table reach the drive
+    def setDurability(self, durability: str = "commit", interval: int = None):
+        """
+            Every write to the table is flushed to the drive before it returns, which is
+            the safest but costs time. This method relaxes that for this table object:
+                "commit": every write is on the drive before it returns.
+                "interval": the files written are flushed in the background every 'interval' ms.
+                "os": the operating system flushes the files when it sees fit.
+            The files are written all the same, so a program that crashes loses nothing.
+            A crash of the machine may lose the writes that were not flushed yet, or leave
+            them half written. flush() flushes everything at once.
+            @param durability <str> [Optional]: "commit", "interval" or "os". Default: "commit".
+            @param interval <int> [Optional]: The most ms a write waits to be flushed with "interval".
+                                                Default: 1000, or what it was set to before.
+            @returns None
+        """
+        checkDurability(durability, interval)
+        self.durability = durability
+        if interval is not None:
+            self.syncInterval = interval
+
+    # Method to queue the changes to this table and write them in the background
+    def setWriteBehind(self, enabled: bool = True, interval: int = 100, size: int = 1000):
+        """
+            With write-behind, insert, insert_many, update, update_one, remove and remove_one
+            queue their change and return right away. A background thread writes the queue
+            'interval' ms after the first change of the queue, or as soon as it holds
+            'size' changes, all at once like a batch does. Callers wait while the
+            queue holds 4 times 'size' changes, until the background thread catches up.
+            Queued changes are written before any read through this table object, so its
+            reads see them. Other table objects and processes see them once written.
+            update and remove return None, the number of documents changed is not known
+            yet. A change that fails is reported by the next flush(): none of the group of
+            changes written with it is written.
+            The queue is written before the program exits, and by flush().
+            @param enabled <bool> [Optional]: Whether to queue the changes. Default: True.
+            @param interval <int> [Optional]: The most ms a change waits in the queue. Default: 100.
+            @param size <int> [Optional]: The number of changes written as soon as they are queued. Default: 1000.
+            @returns None
+        """
+        if not enabled:
+            # Write what is queued first. Whatever is queued in the meantime is
+            # written as well, before the queue goes.
+            while True:
+                self.flush()
+                with self._queueCond:
+                    if not self._queue:
+                        self._queue = None
+                        return
+
+        if interval <= 0 or size <= 0:
+            raise ValueError("The interval and size of the write-behind must be more than 0.")
+
+        with self._queueCond:
+            self._flushInterval, self._flushSize = interval, int(size)
+            if self._queue is None:
+                self._queue = []
+
+        # The database flushes the tables it queues changes for
+        tables = getattr(self.parent, "_writeBehind", None)
+        if tables is not None:
+            tables.add(self)
+
+    # Method to write the queued changes now
+    def flush(self):
+        """
+            Write the changes queued by write-behind and flush every file written
+            to the drive, whatever the durability of the table is. Inside a batch the
+            queue is written when the batch ends instead.
+            Raises the error of a change that failed to be written in the background.
+            @returns None
+        """
+        if not self._inBatch():
+            self._commit()
+
+        # Report what went wrong in the background
+        error, self._writeError = self._writeError, None
+        if error is not None:
+            raise error
+
+        fileSyncer.flush()
+
+    # Queue a change when write-behind is on. Returns False if the
+    # change should be made right away instead.
+    def _enqueue(self, change):
+        if self._queue is None or self._inBatch():
+            return False
+
+        # Bad filters are reported right away, not by the background thread
+        if change[0] == "rewrite":
+            compileFilters(change[1])
+
+        with self._queueCond:
+            # Report what went wrong in the background
+            error, self._writeError = self._writeError, None
+            if error is not None:
+                raise error
+
+            # Wait for the background thread to catch up
+            while self._queue is not None and len(self._queue) >= 4 * self._flushSize:
+                self._queueCond.wait()
+
+            # Write-behind was turned off in the meantime
+            if self._queue is None:
+                return False
+
+            self._queue.append(change)
+
+            # The thread keeps the program running until the queue is written
+            if self._writer is None:
+                self._writer = threading.Thread(
+                    target=self._writeBehind, name=f"PumpkinDB {self.name} writer"
+                )
+                self._writer.start()
+            elif len(self._queue) >= self._flushSize:
+                self._queueCond.notify_all()
+        return True
+
+    # Write the queued changes as one batch, in the order they were queued
+    def _commit(self):
+        with self._committing:
+            with self._queueCond:
+                changes = self._queue
+                if not changes:
+                    return
+                self._queue = []
+                # Let the callers waiting for room go on
+                self._queueCond.notify_all()
+
+            self._local.batch = self._beginBatch()
+            try:
+                for change in changes:
+                    if change[0] == "insert":
+                        self._appendLog(change[1])
+                    else:
+                        self._rewrite(*change[1:])
+            # Nothing was written yet, so none of the changes are
+            except BaseException:
+                state, self._local.batch = self._local.batch, None
+                self._endBatch(state, flush=False)
+                raise
+
+            state, self._local.batch = self._local.batch, None
+            self._endBatch(state)
+
+    # The background thread of write-behind. It waits for the queue to fill up or
+    # for its first change to be old enough, writes it and stops once it is empty.
+    def _writeBehind(self):
+        while True:
+            with self._queueCond:
+                deadline = time.monotonic() + self._flushInterval / 1000
+                while self._queue and len(self._queue) < self._flushSize:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._queueCond.wait(remaining)
+
+                if not self._queue:
+                    self._writer = None
+                    return
+
+            try:
+                self._commit()
+            # The error is reported by the next flush
+            except Exception as exc:
+                self._writeError = exc
+
+    # Write the changes this table object has queued, so that its reads see them
+    def _readOwnWrites(self):
+        if self._queue and not self._inBatch():
+            self._commit()
+
     # Method used to load/refresh data into memory if preload is enabled
     def fetch_data(self):
-        # open the table
-        with open(self.path, "rb") as f:
-            # Read, Decrypt and save the data
-            self.data = json.loads(Fernet(self.key.encode()).decrypt(f.read()))
+        # Writes made while loading make the data stale right away
+        self._dataVersion = tableWrites[self.path]
+        # Read, Decrypt and save the data. Segments decrypted before
+        # by any table object are taken from segmentCache.
+        self.data = self._load()
+
+    # Load the data into memory again if a write was made since it was loaded,
+    # by this or any other table object of the same table
+    def _refresh(self):
+        if self._dataVersion != tableWrites[self.path]:
+            self.fetch_data()
 
     # Method to insert data into the current table
     def insert(self, data: dict = {}, **moreData):
@@ -259,6 +2632,8 @@ class table:
             This can be done in two ways:
                 1. table.insert({'key1': 'value1', 'key2': 'value2'})
                 2. table.insert(key1 = value1, key2 = value2)
+            Every document gets a unique, never reused '_id' number. An '_id' in the
+            given data is replaced.
             @param data: The data to be inserted into the table
             @returns <bool>: True if insertion was succesfull, False otherwise
         """
@@ -266,23 +2641,26 @@ class table:
         data = dict(data)
         # Merge the two types of data provided
         data.update(moreData)
+        self._checkValues([data])
+
+        # With write-behind the insert is queued and written in the background
+        if self._enqueue(("insert", [data])):
+            return True
+
+        # Whether the preloaded data holds all the writes made so far.
+        # A batch loads the data again when it is written.
+        fresh = self.preLoad and self._dataVersion == tableWrites[self.path]
+        fresh = fresh and self._activeBatch() is None
+
+        # Save the data in the write-ahead log, the
+        # table file is only rewritten on checkpoints
+        self._appendLog([data])
+
         # If preLoad is enabled
-        if self.preLoad:
+        if fresh:
             # Change data inplace if preLoad is enabled
             self.data.append(data)
-
-        # Save the data in file
-        with open(self.path, "rb+") as grp:
-            # load the older data
-            d = json.loads(Fernet(self.key).decrypt(grp.read()).decode("utf-8"))
-            # Insert this data
-            d.append(data)
-            # Empty the file now
-            grp.truncate(0)
-            # Get the cursor at zero position
-            grp.seek(0)
-            # Write the new data
-            grp.write(Fernet(self.key.encode()).encrypt(json.dumps(d).encode()))
+            self._dataVersion = tableWrites[self.path]
 
         # Success!
         return True
@@ -292,34 +2670,43 @@ class table:
             This method inserts the given data dictionaries into the current table.
             This can be done in this way:
                 table.insert_many(dict1, dict2, dict3, ...)
+            Every document gets a unique, never reused '_id' number.
             @param data: The data dictionaries to be inserted into the table
             @returns <bool>: True if insertion was succesfull, False otherwise
         """
         # Make sure the data is correct
         data = [dict(d) for d in data]
+        self._checkValues(data)
+
+        # With write-behind the documents are queued and written in the background
+        if self._enqueue(("insert", data)):
+            return True
+
+        # Whether the preloaded data holds all the writes made so far.
+        # A batch loads the data again when it is written.
+        fresh = self.preLoad and self._dataVersion == tableWrites[self.path]
+        fresh = fresh and self._activeBatch() is None
+
+        # Save the data in the write-ahead log as a single record
+        self._appendLog(data)
 
         # If preLoad is enabled
-        if self.preLoad:
+        if fresh:
             # Change data inplace if preLoad is enabled
             self.data.extend(data)
-
-        # Save the data in file
-        with open(self.path, "rb+") as grp:
-            # load the older data
-            d = json.loads(Fernet(self.key).decrypt(grp.read()).decode("utf-8"))
-            # Insert this data
-            d.extend(data)
-            # Empty the file now
-            grp.truncate(0)
-            # Get the cursor at zero position
-            grp.seek(0)
-            # Write the new data
-            grp.write(Fernet(self.key.encode()).encrypt(json.dumps(d).encode()))
+            self._dataVersion = tableWrites[self.path]
 
         return True
 
     # Function to get back prevously saved data
-    def get_one(self, filters: dict, sortby: str = None):
+    def get_one(
+        self,
+        filters: dict,
+        sortby: str = None,
+        descending: bool = False,
+        fields: list = None,
+        exclude: list = None,
+    ):
         """
             This functions returns the first document that match the filters
             defined by the 'filters' dict.
@@ -327,130 +2714,502 @@ class table:
             table that match these filters are returned.
             @param sortby <str> [Optional]: The parameter to sort the documents
             with, before matching.
+            @param descending <bool> [Optional]: Whether to sort from the largest value down. Default: False.
+            @param fields <list> [Optional]: The fields to return, the '_id' is returned as well. Default: all.
+            @param exclude <list> [Optional]: The fields to leave out of the document. Default: None.
             @returns <dict>: The document that matched the given filters
         """
 
         # Make sure that filters are correct
         filters = dict(filters)
 
-        # load data from memory if preLoad is enabled
-        if self.preLoad:
-            docs = self.data
+        # The table is read segment by segment and stops decrypting as soon as a
+        # match is found. Indexes narrow down the documents to check and, for a
+        # sort on an indexed field, hand them out already in order.
+        return next(
+            self._query(
+                filters, sortby, limit=1, descending=descending, fields=fields, exclude=exclude
+            ),
+            None,
+        )
 
-        # Get them from the drive otherwise
-        else:
-            with open(self.path, "rb") as d:
-                docs = json.loads(Fernet(self.key.encode()).decrypt(d.read()))
-
-        # If there is just one filter and it
-        # does not require a special search
-        if (
-            len(filters) == 1
-            and not sortby
-            and "dict" not in str(type(filters[list(filters.keys())[0]]))
-        ):
+    # Function to get back prevously saved data
+    # Same as previous but it returns all occurences of the documents instead of the first one
+    def get(
+        self,
+        filters: dict,
+        sortby: str = None,
+        limit: int = None,
+        offset: int = 0,
+        descending: bool = False,
+        workers: int = None,
+        fields: list = None,
+        exclude: list = None,
+    ):
+        """
+            This functions returns a list of all documents that match the filters
+            defined by the 'filters' dict.
+            @param filters <dict>: This dictionary defines all the filters. All the documents in the
+            table that match these filters are returned
+            @param sortby <str>[Optional]: The parameter, whose value should be used to sort the result.
+            Numbers sort before strings, and documents without the parameter come last, in
+            either order.
+            @param limit <int> [Optional]: The most documents to return. Default: all of them.
+            @param offset <int> [Optional]: The number of matching documents to skip first. Default: 0.
+            @param descending <bool> [Optional]: Whether to sort from the largest value down. Default: False.
+            @param workers <int> [Optional]: Scan the table in this many processes, for filters that
+            are slow to check like __re and __cf. Only tables of PARALLEL_THRESHOLD documents or
+            more that no index can narrow down are scanned this way, and __cf filters must be
+            functions defined at the top of a module. Default: the workers of the database, or 1.
+            @param fields <list> [Optional]: The fields to return of every document, plus the '_id'
+            unless it is excluded. Only these fields are copied into the result, which keeps it
+            small when the documents hold big values. Default: all fields.
+            @param exclude <list> [Optional]: The fields to leave out of every document. Default: None.
+            @returns <List>: Of all the documents that match the given filters
+        """
 
-            # We have an advantage here, we can sort the documents accroding to the only filter
-            # and then implement a Binary search algorithm for faster response
+        # Make sure that filters are correct
+        filters = dict(filters)
 
-            # This shortens our filters dict into one single variabe rather than a dictionary
-            key = list(filters.keys())[0]
-            value = filters[key]
+        # Make sure the page is correct
+        if (limit is not None and limit < 0) or offset < 0:
+            raise ValueError("The limit and offset of a query can't be negative.")
+
+        # Indexes are used when they can answer the filters or the sort,
+        # everything else is a linear search over the table
+        return list(
+            self._query(
+                filters,
+                sortby,
+                limit,
+                offset,
+                descending,
+                workers=workers,
+                fields=fields,
+                exclude=exclude,
+            )
+        )
 
-            # Sort the docs accroding to the filter
-            docs = merge_sort(docs, key)
+    # Function to tell how get would run a query
+    def explain(
+        self,
+        filters: dict = None,
+        sortby: str = None,
+        limit: int = None,
+        offset: int = 0,
+        descending: bool = False,
+        workers: int = None,
+    ):
+        """
+            This function tells how get would find the documents of a query, without
+            running it. The documents are found by one of these accesses:
+                "index lookup": an index over a filtered field gives the documents to read
+                "index scan": the documents are read in the order of the index over 'sortby'
+                "early-exit scan": the table is read until enough documents matched
+                "parallel scan": the table is matched in worker processes
+                "full scan": every document of the table is read
+                "memory scan": the documents are in memory, preloaded or in a batch
+            and the matches are sorted by "index", "top-n" (a heap of the first offset + limit
+            documents), "sort" or "none". The numbers are estimates. Filters over indexed
+            fields are counted in the index, the others are guessed to match the share of
+            the documents in FILTER_SELECTIVITY.
+            The parameters are the same as those of get.
+            @returns <dict>: The plan: the "access", the "index" used, the "sort", the "documents"
+            in the table, the "rows" checked against the filters, the "segments" decrypted,
+            the "matches", and the "cost" in documents decoded and compared.
+        """
 
-            # Implement a binary search algorithm on the sorted docs
-            return binary_search(docs, key, value)
+        # Make sure that filters are correct
+        filters = dict(filters or {})
+        compileFilters(filters)
 
-        else:
-            # Implement a sort if the user wants it
-            docs = merge_sort(docs, sortby) if sortby else docs
+        # Make sure the page is correct
+        if (limit is not None and limit < 0) or offset < 0:
+            raise ValueError("The limit and offset of a query can't be negative.")
+        stop = None if limit is None else offset + limit
 
-            # Implement a linear search algorithm because we can't sort the list according to all the filter parameters at once
-            for i in docs:
+        # Documents read, of which 'share' match, until 'stop' of them matched
+        def upTo(rows, share):
+            if stop is None or share <= 0:
+                return rows
+            return min(rows, math.ceil(stop / share))
 
-                # Let us assume it matches
-                matches = True
+        plan = {"access": "full scan", "index": None, "sort": "none"}
+        if sortby:
+            plan["sort"] = "sort" if stop is None else "top-n"
+
+        view = self._indexView()
+
+        # Preloaded tables, batches and tables in the old format hold no indexes to plan with
+        if view is None:
+            total = self.count()
+            share = 1.0
+            for value in filters.values():
+                share *= filterSelectivity(value)
+            if self.preLoad or self._inBatch():
+                plan["access"] = "memory scan"
+            rows = total if sortby else upTo(total, share)
+            plan.update(documents=total, rows=rows, segments=0, matches=round(total * share))
+            plan["cost"] = sortCost(plan, rows, stop)
+            return plan
+
+        with view:
+            manifest, indexes, logged = view.manifest, view.indexes, len(view.logged)
+            counts = [i["count"] for i in manifest["segments"]]
+            stored = sum(counts)
+            starts = list(itertools.accumulate([0] + counts[:-1]))
+
+            # The share of the documents matching every filter, and the most selective index
+            share, lookup = 1.0, None
+            for field, value in filters.items():
+                positions = indexLookup(indexes[field], value) if field in indexes else None
+                if positions is None:
+                    share *= filterSelectivity(value)
+                    continue
+                share *= len(positions) / stored if stored else 0
+                if lookup is None or len(positions) < lookup[1]:
+                    lookup = (field, len(positions))
+            matches = share * stored
+
+            positions, ordered = self._plan(manifest, indexes, filters, sortby, descending)
+            if positions is None:
+                parallel = self._parallelWorkers(manifest, filters, workers)
+                if parallel is not None:
+                    plan.update(access="parallel scan", workers=parallel)
+                    # Without a sort the workers stop once enough documents matched
+                    rows = stored if sortby else upTo(stored, share)
+                elif not sortby and stop is not None:
+                    plan["access"] = "early-exit scan"
+                    rows = upTo(stored, share)
+                else:
+                    rows = stored
+                # The table is read from its start
+                read = range(bisect.bisect_left(starts, rows)) if rows else range(0)
+            else:
+                if ordered:
+                    plan.update(access="index scan", index=sortby, sort="index")
+                else:
+                    plan.update(access="index lookup", index=lookup[0])
+                # Of the candidates given by the index, the matches of the other filters.
+                # Without a lookup the sort index walks the whole table.
+                rows = stored if lookup is None else len(positions)
+                if not sortby or ordered:
+                    rows = upTo(rows, matches / rows if rows else 0)
+                read = {
+                    bisect.bisect_right(starts, i) - 1 for i in itertools.islice(positions, rows)
+                }
+
+        # The documents of the write-ahead log are always checked
+        plan.update(
+            documents=stored + logged,
+            rows=rows + logged,
+            segments=len(read),
+            matches=round(matches + share * logged),
+        )
+        plan["cost"] = sortCost(plan, sum(counts[n] for n in read) + logged, stop)
+        return plan
 
-                # Loop through all the filters
-                for j in filters:
+    # Function to get a document by its id
+    def get_by_id(self, id: int):
+        """
+            This function returns the document with the given '_id'.
+            The manifest records the range of ids in every segment, so just the one
+            segment holding the document is decrypted, and the document is usually
+            found right at its offset in there.
+            @param id <int>: The '_id' of the document.
+            @returns <dict>: The document, or None if there is no such document
+        """
 
-                    try:
-                        # If one of the filters does not match the doc's value
-                        if not matchDocs(i[j], filters[j]):
+        # Queued changes are written first, so that they are read as well
+        self._readOwnWrites()
 
-                            # Mark it unmatched
-                            matches = False
+        # Inside a batch its copy of the table is searched
+        if self._activeBatch() is not None:
+            return next((i for i in self._query({"_id": id}) if i["_id"] == id), None)
 
-                            # And break from the loop
-                            break
+        # Documents are kept in the order of their ids
+        if self.preLoad:
+            self._refresh()
+            doc = binary_search(self.data, "_id", id)
+            return dict(doc) if doc else None
 
-                    # Its posiible that all documents don't have the keys given
-                    # in filter, in which case we'll have a KeyError
-                    except KeyError:
-                        matches = False
-                        break
+        with tableSnapshot(self, indexes=False) as view:
+            return self._getById(id, view)
 
-                # If the match is found then return this doc to the user
-                if matches:
-                    return i
+    # Find a document by its id in one version of the table
+    def _getById(self, id: int, view):
+        manifest = view.manifest
 
-    # Function to get back prevously saved data
-    # Same as previous but it returns all occurences of the documents instead of the first one
-    def get(self, filters: dict, sortby: str = None):
+        # Tables from before document ids have no id ranges yet
+        if isinstance(manifest, list) or "nextId" not in manifest:
+            return next(
+                (i for i in self._query({"_id": id}, snapshot=view) if i["_id"] == id), None
+            )
+
+        # Documents past the stored ids are still in the write-ahead log
+        if id >= manifest["nextId"]:
+            return next((dict(i) for i in view.logged if i["_id"] == id), None)
+
+        # Find the segment whose id range holds the id
+        segments = manifest["segments"]
+        n = bisect.bisect_left([i["last"] for i in segments], id)
+        if n == len(segments) or segments[n]["first"] > id:
+            return None
+
+        docs = self._readSegment(view.data, segments[n], manifest)
+
+        # Unless documents were removed from the segment, the id tells the offset
+        offset = id - segments[n]["first"]
+        if offset < len(docs) and docs[offset]["_id"] == id:
+            return dict(docs[offset])
+        doc = binary_search(docs, "_id", id)
+        return dict(doc) if doc else None
+
+    # Method to read one version of the table while it is being written
+    def snapshot(self):
         """
-            This functions returns a list of all documents that match the filters
-            defined by the 'filters' dict.
-            @param filters <dict>: This dictionary defines all the filters. All the documents in the
-            table that match these filters are returned
-            @param sortby <str>[Optional]: The parameter, whose value should be used to sort the result.
-            @returns <List>: Of all the documents that match the given filters
+            This method pins the table as it is right now. Every read of the snapshot sees
+            that same version of the table, however long it runs and whatever is written
+            to the table in the meantime, and neither the reads nor the writes wait:
+                with table.snapshot() as snap:
+                    total = sum(i["amount"] for i in snap.scan())
+                    big = snap.get({"amount": {"__gt": 1000}})
+            Writers never change the files of a version in place. They write new files and
+            switch the table to them at once, the snapshot keeps the old ones open.
+            A snapshot reads the table files, not a batch or the preloaded data.
+            @returns <tableSnapshot>: The snapshot. Close it, or use it in a with block, to
+            let go of the files it holds open.
+        """
+        # Queued changes are written first, so that they are part of the snapshot
+        self._readOwnWrites()
+        return tableSnapshot(self)
+
+    # Open a version of the table to work out a result from its manifest and indexes
+    # alone. Returns None when the documents have to be read anyway: inside a batch,
+    # with preloaded data or for a table in the old format.
+    def _indexView(self):
+        # Queued changes are written first, so that they are counted as well
+        self._readOwnWrites()
+        if self._inBatch() or self.preLoad:
+            return None
+
+        view = tableSnapshot(self, indexes=False)
+        if isinstance(view.manifest, list):
+            view.close()
+            return None
+        return view
+
+    # Function to count documents
+    def count(self, filters: dict = None):
+        """
+            This function returns the number of documents that match the filters. Where
+            it can, it does not read the documents: the manifest holds the number of
+            documents of the whole table, and an index over the one filtered field tells
+            how many documents hold the values asked for.
+            @param filters <dict> [Optional]: The filters the documents must match. Default: None, all documents.
+            @returns <int>: The number of matching documents
         """
 
         # Make sure that filters are correct
-        filters = dict(filters)
+        filters = dict(filters or {})
+        match = compileFilters(filters)
+
+        view = self._indexView() if len(filters) <= 1 else None
+        if view is not None:
+            with view:
+                stored = None
+                if not filters:
+                    stored = sum(i["count"] for i in view.manifest["segments"])
+                else:
+                    ((field, value),) = filters.items()
+                    if field in view.indexes:
+                        positions = indexLookup(view.indexes[field], value)
+                        stored = None if positions is None else len(positions)
+
+                # The write-ahead log is not indexed, so its documents are checked
+                if stored is not None:
+                    return stored + sum(1 for i in view.logged if match(i))
+
+        # Otherwise count the matches while the table is scanned
+        return sum(1 for i in self._query(filters, copy=False))
+
+    # Function to work out sums, averages and the like
+    def aggregate(self, filters: dict = None, group_by: str = None, metrics: dict = None):
+        """
+            This function works out metrics over the documents that match the filters, as
+            the table is scanned, without collecting the documents. The metrics are given by
+            name, each one "count" or a (function, field) tuple of one of these functions:
+                "count": the number of documents, or of the ones that have the field
+                "sum", "avg": the sum or average of the numbers in the field
+                "min", "max": the smallest or largest value of the field, ordered like sortby
+            Like this:
+                table.aggregate({"paid": True}, group_by="country", metrics={
+                    "orders": "count",
+                    "revenue": ("sum", "amount"),
+                    "biggest": ("max", "amount"),
+                })
+            Without filters, counts grouped by an indexed field and counts, minimums and
+            maximums of sorted indexed fields are read from the indexes.
+            @param filters <dict> [Optional]: The filters the documents must match. Default: None, all documents.
+            @param group_by <str> [Optional]: Work out the metrics for every value of this field
+                                                apart. Documents without it are grouped under None.
+                                                Default: None, over all the documents.
+            @param metrics <dict> [Optional]: The metrics, by name. Default: {"count": "count"}.
+            @returns <dict>: The metrics by name. With group_by, a list of them, one dict for
+            every value of the field, in order of the value, which is under the group_by key.
+        """
 
-        # load data from memory if preLoad is enabled
-        if self.preLoad:
-            docs = self.data
+        # Make sure that filters and metrics are correct
+        filters = dict(filters or {})
+        compileFilters(filters)
+        metrics = parseMetrics(metrics or {"count": "count"})
+
+        if not filters:
+            result = self._aggregateIndexed(group_by, metrics)
+            if result is not None:
+                return result
+
+        # Fold the matching documents into the metrics a chunk at a time
+        docs = self._query(filters, copy=False)
+        chunks = iter(lambda: list(itertools.islice(docs, EXPORT_BATCH)), [])
+        if group_by is None:
+            state = newMetrics(metrics)
+            for chunk in chunks:
+                foldMetrics(state, metrics, chunk)
+            return finishMetrics(state, metrics)
+
+        groups = {}
+        for chunk in chunks:
+            self._foldGroups(groups, group_by, metrics, chunk)
+        return self._finishGroups(groups, group_by, metrics)
+
+    # Fold a list of documents into the metrics of the groups they belong to
+    def _foldGroups(self, groups, group_by: str, metrics, docs):
+        buckets = {}
+        for doc in docs:
+            value = doc.get(group_by)
+            key = groupKey(value)
+            if key not in buckets:
+                buckets[key] = (value, [])
+            buckets[key][1].append(doc)
+
+        for key, (value, bucket) in buckets.items():
+            if key not in groups:
+                groups[key] = (value, newMetrics(metrics))
+            foldMetrics(groups[key][1], metrics, bucket)
+
+    # Work out the metrics of the whole table from its indexes, or None if they can't tell
+    def _aggregateIndexed(self, group_by: str, metrics):
+        view = self._indexView()
+        if view is None:
+            return None
+
+        with view:
+            indexes = view.indexes
+            stored = sum(i["count"] for i in view.manifest["segments"])
+
+            if group_by is not None:
+                # The index over the grouped field has the number of documents of every
+                # value, which is all that plain counts need
+                if group_by not in indexes or any(i[1:] != ("count", None) for i in metrics):
+                    return None
+
+                groups = {}
+                for value, count in indexGroups(indexes[group_by]):
+                    groups[groupKey(value)] = (value, [count] * len(metrics))
+                # Documents without the field are not in the index
+                missing = stored - indexSize(indexes[group_by])
+                if missing:
+                    state = groups.setdefault(groupKey(None), (None, newMetrics(metrics)))[1]
+                    state[:] = [i + missing for i in state]
+
+                # The write-ahead log is not indexed, so its documents are folded in
+                self._foldGroups(groups, group_by, metrics, view.logged)
+                return self._finishGroups(groups, group_by, metrics)
+
+            state = newMetrics(metrics)
+            for n, (name, function, field) in enumerate(metrics):
+                if field is None:
+                    state[n] = stored
+                elif field not in indexes:
+                    return None
+                elif function == "count":
+                    state[n] = indexSize(indexes[field])
+                # The first and last entries of a sorted index hold the smallest and largest values
+                elif function in ("min", "max") and indexes[field]["kind"] == "sorted":
+                    entries = indexes[field]["entries"]
+                    if entries:
+                        rank = entries[0][:2] if function == "min" else entries[-1][:2]
+                        state[n] = (rank, entryValue(rank))
+                else:
+                    return None
+
+            foldMetrics(state, metrics, view.logged)
+            return finishMetrics(state, metrics)
+
+    # The results of grouped metrics, in order of the values they are grouped by
+    def _finishGroups(self, groups, group_by: str, metrics):
+        return [
+            {group_by: value, **finishMetrics(state, metrics)}
+            for value, state in sorted(groups.values(), key=lambda g: sortKey(g[0]))
+        ]
+
+    # Function to get the values a field has
+    def distinct(self, field: str, filters: dict = None):
+        """
+            This function returns every value the field has in the documents that match the
+            filters, once each. Without filters the values of an indexed field are read
+            from its index.
+            @param field <str>: The field.
+            @param filters <dict> [Optional]: The filters the documents must match. Default: None, all documents.
+            @returns <list>: The values, in the order sortby would sort them in
+        """
 
-        # Get them from the drive otherwise
+        # Make sure that filters are correct
+        filters = dict(filters or {})
+        compileFilters(filters)
+
+        values = {}
+        view = None if filters else self._indexView()
+        if view is not None and field in view.indexes:
+            with view:
+                for value, count in indexGroups(view.indexes[field]):
+                    values[groupKey(value)] = value
+                # The write-ahead log is not indexed, so its documents are read
+                docs = view.logged
         else:
-            with open(self.path, "rb") as d:
-                docs = json.loads(Fernet(self.key.encode()).decrypt(d.read()))
-
-        # Implement a linear search algorithm because we can't sort the list according to all the filter parameters at once
-        output = []
-        for i in docs:
-            # Let us assme it matches
-            matches = True
-
-            # Loop through all the filters
-            for j in filters:
-                try:
-                    # If one of the filters does not match the doc's value
-                    if not matchDocs(i[j], filters[j]):
-                        # Mark it unmatched
-                        matches = False
-                        # And break from the loop
-                        break
+            if view is not None:
+                view.close()
+            docs = self._query(filters, copy=False)
+
+        for doc in docs:
+            value = doc.get(field, MISSING)
+            if value is not MISSING:
+                values.setdefault(groupKey(value), value)
+        return sorted(values.values(), key=sortKey)
+
+    # Function to walk through the table without loading all of it
+    def scan(
+        self, filters: dict = None, batch_size: int = None, fields: list = None, exclude: list = None
+    ):
+        """
+            This function yields the documents that match the filters one by one,
+            in table order. Unlike get, it never holds the whole table in memory:
+            the table is decrypted a batch of segments at a time, and every batch
+            is let go of before the next one is read.
+            @param filters <dict> [Optional]: The filters the documents must match. Default: None, all documents.
+            @param batch_size <int> [Optional]: The number of documents to decrypt at a time.
+                                                It is rounded up to whole segments. Default: one segment.
+            @param fields <list> [Optional]: The fields to return, as in get. Default: all fields.
+            @param exclude <list> [Optional]: The fields to leave out, as in get. Default: None.
+            @returns <generator>: Of the documents that match the given filters
+        """
 
-                # Its posiible that all documents don't have the keys given in filter, in which case we'll have a KeyError
-                except KeyError:
-                    matches = False
-                    break
+        # Make sure that filters are correct
+        filters = dict(filters or {})
 
-            # If the match is found then return this doc to the user
-            if matches:
-                output.append(i)
+        yield from self._query(filters, batchSize=batch_size, fields=fields, exclude=exclude)
 
-        if sortby:
-            # If there's a need to sort the result then do it
-            return merge_sort(output, sortby)
-        else:
-            return output
-    
     # Function to update the values
     def update_one(self, filters: dict, nValues: dict):
         """
@@ -462,34 +3221,21 @@ class table:
             @returns None.
         """
 
-        # First up get the data document
-        doc = self.get_one(filters)
-        # Create a copy of the document
-        nDoc = doc.copy()
-        # Update the new document
-        nDoc.update(nValues)
+        # The id of a document never changes
+        if "_id" in nValues:
+            raise ValueError("The `_id` of a document can't be updated.")
 
-        # Then delete this document and add the new one
+        # Later changes to the dicts given don't change the update
+        filters, nValues = dict(filters), dict(nValues)
+        self._checkValues(nValues)
+        change = lambda doc: {**doc, **nValues}
 
-        # First from the in-mem cache
-        if self.preLoad:
-            self.data.remove(doc)
-            self.data.append(nDoc)
+        # With write-behind the update is queued and written in the background
+        if self._enqueue(("rewrite", filters, change, 1)):
+            return
 
-        # Then form the data files
-        with open(self.path, "rb+") as f:
-            docs = json.loads(
-                Fernet(self.key.encode()).decrypt(f.read()).decode("utf-8")
-            )
-            # Remove the current document and add the new one
-            docs.remove(doc)
-            docs.append(nDoc)
-            # Empty the file now
-            f.truncate(0)
-            # Get the cursor at zero position
-            f.seek(0)
-            # Write the new data
-            f.write(Fernet(self.key.encode()).encrypt(json.dumps(docs).encode()))
+        # Update the first matching document in its segment
+        self._rewrite(filters, change, limit=1)
 
         # Done!
 
@@ -501,39 +3247,28 @@ class table:
             the filters.
             @param filters <dict> : The dictionary of filters.
             @param nValues <dict>: The dictionary to get the new values from.
-            @returns <int>: The number of documents updated.
+            @returns <int>: The number of documents updated, None with write-behind.
         """
 
-        # First up get the data documents
-        doc = self.get(filters)
-        # Create copies of the documents
-        nDoc = [i.copy() for i in doc]
-        # Update the new documents
-        [i.update(nValues) for i in nDoc]
-        # Then delete this document and add the new one
-        # First from the in-mem cache
-        if self.preLoad:
-            [self.data.remove(i) for i in doc]
-            self.data.extend(nDoc)
+        # The id of a document never changes
+        if "_id" in nValues:
+            raise ValueError("The `_id` of a document can't be updated.")
 
-        # Then form the data files
-        with open(self.path, "rb+") as f:
-            docs = json.loads(
-                Fernet(self.key.encode()).decrypt(f.read()).decode("utf-8")
-            )
-            # Remove the current document and add the new one
-            [docs.remove(j) for j in doc]
-            docs.extend(nDoc)
-            # Empty the file now
-            f.truncate(0)
-            # Get the cursor at zero position
-            f.seek(0)
-            # Write the new data
-            f.write(Fernet(self.key.encode()).encrypt(json.dumps(docs).encode()))
+        # Later changes to the dicts given don't change the update
+        filters, nValues = dict(filters), dict(nValues)
+        self._checkValues(nValues)
+        change = lambda doc: {**doc, **nValues}
+
+        # With write-behind the update is queued and written in the background
+        if self._enqueue(("rewrite", filters, change, None)):
+            return None
+
+        # Update the matching documents, rewriting only the segments they are in
+        changes = self._rewrite(filters, change)
 
         # Done!
 
-        return len(nDoc)
+        return len(changes)
 
     # Function to delete a single data document
     def remove_one(self, filters: dict):
@@ -545,26 +3280,12 @@ class table:
             @returns None
         """
 
-        # First up get the data document
-        doc = self.get_one(filters)
-        # Then delete this document
-        # First from the in-mem cache
-        if self.preLoad:
-            self.data.remove(doc)
+        # With write-behind the delete is queued and written in the background
+        if self._enqueue(("rewrite", dict(filters), lambda doc: None, 1)):
+            return
 
-        # Then form the data files
-        with open(self.path, "rb+") as f:
-            docs = json.loads(
-                Fernet(self.key.encode()).decrypt(f.read()).decode("utf-8")
-            )
-            # Remove the current document
-            docs.remove(doc)
-            # Empty the file now
-            f.truncate(0)
-            # Get the cursor at zero position
-            f.seek(0)
-            # Write the new data
-            f.write(Fernet(self.key.encode()).encrypt(json.dumps(docs).encode()))
+        # Delete the first matching document from its segment
+        self._rewrite(dict(filters), lambda doc: None, limit=1)
 
     # Function to delete all documents that match a criteria
     def remove(self, filters: dict):
@@ -573,66 +3294,178 @@ class table:
             the filters.
             WARNING: This task is irreversible
             @param filters <dict>: The filters, using which the documents to be deleted are decided.
-            @returns <int>: The number of documents deleted
+            @returns <int>: The number of documents deleted, None with write-behind
         """
 
-        # First up get the data documents
-        doc = self.get(filters)
-        # Then delete these documents
-        # First from the in-mem cache
-        if self.preLoad:
-            [self.data.remove(i) for i in doc]
-
-        # Then form the data files
-        with open(self.path, "rb+") as f:
-            docs = json.loads(
-                Fernet(self.key.encode()).decrypt(f.read()).decode("utf-8")
-            )
-
-            # Remove these documents
-            [docs.remove(j) for j in doc]
-
-            # Empty the file now
-            f.truncate(0)
-
-            # Get the cursor at zero position
-            f.seek(0)
+        # With write-behind the delete is queued and written in the background
+        if self._enqueue(("rewrite", dict(filters), lambda doc: None, None)):
+            return None
 
-            # Write the new data
-            f.write(Fernet(self.key.encode()).encrypt(json.dumps(docs).encode()))
+        # Delete the matching documents, rewriting only the segments they are in
+        changes = self._rewrite(dict(filters), lambda doc: None)
 
         # Done!
 
-        return len(doc)
+        return len(changes)
 
     # Function to delete this whole table
+    @writes
     def drop(self):
         """
             Delete this whole data table.
             WARNING: This task is irreversible.
         """
-        # Delete the table file
+        # Queued changes have no table to go to anymore
+        with self._queueCond:
+            if self._queue:
+                self._queue = []
+
+        # Delete the table file, its segments files, indexes and write-ahead log
         os.remove(self.path)
+        folder = os.path.dirname(self.path)
+        for i in [self.segPath, *glob.glob(f"{glob.escape(folder)}/{self.name}.*.segments")]:
+            if os.path.exists(i):
+                os.remove(i)
+            segmentCache.discard(i)
+        if os.path.exists(self.indexPath):
+            os.remove(self.indexPath)
+        self._resetIndexLog()
+        self._resetLog()
+        tableWrites[self.path] += 1
 
         # Update the parent database
         self.parent.tables.remove(self.name)
+        getattr(self.parent, "codecs", {}).pop(self.name, None)
+        getattr(self.parent, "compressions", {}).pop(self.name, None)
 
         # Update the metadata file
-        with open(
-            f"{self.parent.dbPath}/db/{self.parent.name}/metadata.json", "r+"
-        ) as f:
+        path = f"{self.parent.dbPath}/db/{self.parent.name}/metadata.json"
+        with open(path, "r") as f:
             # Load the file
             d = json.loads(f.read())
-            # Remove the current table
-            d["tables"].remove(self.name)
-            # Empty the file now
-            f.truncate(0)
-            # Get the cursor at zero position
-            f.seek(0)
-            # Write the new data
-            f.write(json.dumps(d))
-
-def create(name: str, dbPath: str = ".", safeMode: bool = True):
+        # Remove the current table
+        d["tables"].remove(self.name)
+        d.get("codecs", {}).pop(self.name, None)
+        d.get("compression", {}).pop(self.name, None)
+        # Write the new data in place of the old
+        replaceFile(path, json.dumps(d))
+
+class tableSnapshot:
+    def __init__(self, parent, indexes: bool = True):
+        """
+            One version of a table, see table.snapshot.
+            @param parent <table>: The table.
+            @param indexes <bool> [Optional]: Whether to read the indexes of the version right
+                                                away, rather than on the first query. Default: True.
+        """
+        self.parent = parent
+
+        while True:
+            # The log is read before the manifest. A checkpoint in between writes a
+            # manifest that holds the logged documents already, so they are left out.
+            log = parent._readLog()
+            self.manifest = parent._readManifest()
+
+            # The .segments file of the manifest is opened right away
+            self.data = None
+            if isinstance(self.manifest, dict) and self.manifest["segments"]:
+                try:
+                    self.data = parent._openSegments(self.manifest)
+                # The table was compacted in the meantime, read the new version
+                except FileNotFoundError:
+                    continue
+            break
+
+        self.logged = parent._liveLog(self.manifest, log)
+        self._indexes = None
+        if indexes:
+            self._indexes = parent._loadIndexes(self.manifest, rebuild=False)
+
+    # The indexes of the version, or no indexes if they were already changed
+    @property
+    def indexes(self):
+        if self._indexes is None:
+            self._indexes = self.parent._loadIndexes(self.manifest, rebuild=False)
+        return self._indexes
+
+    # Let go of the files of the version
+    def close(self):
+        if self.data is not None:
+            self.data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # The same as table.get_one, on this version of the table
+    def get_one(
+        self,
+        filters: dict,
+        sortby: str = None,
+        descending: bool = False,
+        fields: list = None,
+        exclude: list = None,
+    ):
+        return next(
+            self.parent._query(
+                dict(filters),
+                sortby,
+                1,
+                descending=descending,
+                snapshot=self,
+                fields=fields,
+                exclude=exclude,
+            ),
+            None,
+        )
+
+    # The same as table.get, on this version of the table
+    def get(
+        self,
+        filters: dict,
+        sortby: str = None,
+        limit: int = None,
+        offset: int = 0,
+        descending: bool = False,
+        fields: list = None,
+        exclude: list = None,
+    ):
+        # Make sure the page is correct
+        if (limit is not None and limit < 0) or offset < 0:
+            raise ValueError("The limit and offset of a query can't be negative.")
+
+        return list(
+            self.parent._query(
+                dict(filters),
+                sortby,
+                limit,
+                offset,
+                descending,
+                snapshot=self,
+                fields=fields,
+                exclude=exclude,
+            )
+        )
+
+    # The same as table.get_by_id, on this version of the table
+    def get_by_id(self, id: int):
+        return self.parent._getById(id, self)
+
+    # The same as table.scan, on this version of the table
+    def scan(
+        self, filters: dict = None, batch_size: int = None, fields: list = None, exclude: list = None
+    ):
+        yield from self.parent._query(
+            dict(filters or {}),
+            batchSize=batch_size,
+            snapshot=self,
+            fields=fields,
+            exclude=exclude,
+        )
+
+def create(name: str, dbPath: str = ".", safeMode: bool = True, cipher: str = "fernet"):
     """
         This method creates a database by the name of 'name'.
         If safeMode is not set to True, it raises DBExistsError
@@ -643,12 +3476,15 @@ def create(name: str, dbPath: str = ".", safeMode: bool = True):
         @param dbPath <str> [Optional]: The relative path the directory
                                         where the 'db' directory is located.
                                         Default: Current directory.
+        @param cipher <str> [Optional]: The encryption of the tables, "fernet" or the
+                                        faster "aesgcm". Default: "fernet".
         @returns: utils.database.db.db instance of the newly created
                 database
     """
 
     # Be sure of the data types of the params
     name, safeMode, dbPath = str(name), bool(safeMode), str(dbPath)
+    checkCipher(cipher)
 
     # Check if the given path is correct
     if "db" not in os.listdir(dbPath):
@@ -693,6 +3529,7 @@ def create(name: str, dbPath: str = ".", safeMode: bool = True):
                         "name": name,  # Name of the db
                         "tables": [],  # New databases are empty
                         "key": key,  # The encryption key for this db
+                        "cipher": cipher,  # The encryption backend of the tables
                     }
                 )
             )
@@ -727,11 +3564,28 @@ class db:
         @param preLoad <bool>  [Optional]: Whether to preload table names for faster table access. Defaults to True.\n
         @param dbPath <str> [Optional]: The path to the directory where the 'db' directory is located.
                                         Default: Current directory
+        @param durability <str> [Optional]: How the writes of the tables reach the drive, "commit",
+                                        "interval" or "os", see table.setDurability. Default: "commit".
+        @param syncInterval <int> [Optional]: The most ms a write waits to be flushed with "interval".
+                                        Default: 1000.
+        @param writeBehind <bool> [Optional]: Whether the tables queue their changes and write them
+                                        in the background, see table.setWriteBehind. Default: False.
+        @param workers <int> [Optional]: The processes big tables are scanned in, see table.get.
+                                        Default: 1.
     """
 
     # Initiation of our database
     def __init__(
-        self, name: str, dbPath: str = ".", safeMode: bool = True, preLoad: bool = True
+        self,
+        name: str,
+        dbPath: str = ".",
+        safeMode: bool = True,
+        preLoad: bool = True,
+        cipher: str = "fernet",
+        durability: str = "commit",
+        syncInterval: int = 1000,
+        writeBehind: bool = False,
+        workers: int = None,
     ):
 
         # Store the dbPath
@@ -758,7 +3612,7 @@ class db:
 
             # Create the db if safeMode is enabled
             if safeMode:
-                create(name, dbPath=dbPath)
+                create(name, dbPath=dbPath, cipher=cipher)
 
             # Otherwise display an error
             else:
@@ -773,6 +3627,22 @@ class db:
         self.safeMode = safeMode
         self.key = None  # These are just there till we
         self.tables = []  # load the metadata.
+        self.codecs = {}  # The codec of every table
+        self.compressions = {}  # The compression method and level of every table
+        self.backend = "fernet"  # The encryption backend of the tables
+
+        # The batches of the tables written inside db.batch by each thread, by table name
+        self._local = threading.local()
+
+        # How the tables write, see table.setDurability and table.setWriteBehind
+        checkDurability(durability, syncInterval)
+        self.durability = durability
+        self.syncInterval = syncInterval
+        self.writeBehind = bool(writeBehind)
+        # The processes big tables are scanned in, see table.get
+        self.workers = workers
+        # The table objects that queue their changes
+        self._writeBehind = weakref.WeakSet()
 
         # Get the preload data if it is enabled
         if preLoad:
@@ -792,6 +3662,19 @@ class db:
             # Save the data
             self.key = d["key"]
             self.tables = d["tables"]
+            # Databases from before codecs hold JSON tables only
+            self.codecs = d.get("codecs", {})
+            self.compressions = d.get("compression", {})
+            # Databases from before cipher backends use Fernet
+            self.backend = d.get("cipher", "fernet")
+
+    # The cipher of this database, made once for its key and backend
+    @property
+    def cipher(self):
+        # If key is not there then get it
+        if self.key is None:
+            self.get_meta()
+        return getCipher(self.key, self.backend)
 
     # Function to drop this database
     def drop(self):
@@ -805,16 +3688,37 @@ class db:
         # And we're done!
 
     # Function to create a new table
-    def createTable(self, name: str, safeMode: bool = True, preLoad: bool = False):
+    def createTable(
+        self,
+        name: str,
+        safeMode: bool = True,
+        preLoad: bool = False,
+        codec: str = "json",
+        compression: str = None,
+        level: int = None,
+    ):
         """
             Create a new data table in the current database.
             Raises GroupExistsError if table already exists and database is not in safe mode.
             @param name <str>: Name of the new table.
             @param safeMode <bool> [Optional]: Whether to use safeMode or not
             @param preLoad <bool> [Optional]: Whether to preLoad data or not
+            @param codec <str> [Optional]: The format the documents are stored in. "json", or
+                                            "marshal", a compact binary format that is a lot
+                                            faster to write and read. "msgpack" can be used as
+                                            well if the msgpack module is installed. An existing
+                                            table keeps its codec, see setCodec. Default: "json".
+            @param compression <str> [Optional]: Compress the documents with "zlib", "bz2" or
+                                            "lzma" before they are encrypted. Default: None.
+            @param level <int> [Optional]: The compression level, higher is smaller but slower.
+                                            Default: the default level of the method.
             @returns utils.database.tables.tables instance of the new table.
         """
 
+        # Make sure the codec and compression are correct
+        checkCodec(codec)
+        checkCompression(compression, level)
+
         # Check if the name is correct
         if re.match(r".*[+/\\\\,.^%!@#$&*(){}\[\]'\"<>\?\|= ].*", name):
             raise ValueError(
@@ -835,7 +3739,7 @@ class db:
 
             # Otherwise raise an error
             else:
-                raise table.GroupExistsError(f"The table {name} already exists.")
+                raise GroupExistsError(f"The table {name} already exists.")
 
         # Create it if its not there
         else:
@@ -844,21 +3748,133 @@ class db:
                 self.get_meta()
 
             # Create our file
-            with open(f"{self.dbPath}/db/{self.name}/{name}.tables", "x") as grp:
-                # Write an empty list into it for now
-                grp.write(Fernet(self.key).encrypt(b"[]").decode("utf-8"))
+            with open(f"{self.dbPath}/db/{self.name}/{name}.tables", "xb") as grp:
+                # Write the manifest of a table without any segments for now
+                grp.write(self.cipher.encrypt(json.dumps(emptyManifest()).encode()))
 
             # Add the table to our in-memory list of tables
             self.tables.append(name)
+            self.codecs[name] = codec
+            if compression is not None:
+                self.compressions[name] = [compression, level]
 
             # Now update our metadata file
-            f = open(f"{self.dbPath}/db/{self.name}/metadata.json", "w")
-            f.write(
-                json.dumps({"name": self.name, "key": self.key, "tables": self.tables})
-            )
+            self._writeMeta()
 
             return self.loadTable(name, safeMode=safeMode, preLoad=preLoad)
 
+    # This function saves the metadata about the database. For internal
+    # use only. Not to be used by users.
+    def _writeMeta(self):
+        replaceFile(
+            f"{self.dbPath}/db/{self.name}/metadata.json",
+            json.dumps(
+                {
+                    "name": self.name,
+                    "key": self.key,
+                    "tables": self.tables,
+                    "codecs": self.codecs,
+                    "compression": self.compressions,
+                    "cipher": self.backend,
+                }
+            ),
+        )
+
+    # Function to change the codec of a table
+    def setCodec(self, name: str, codec: str):
+        """
+            Convert a table to another codec. Every segment of the table is written again
+            in the new format. Tables read the segments of any codec, so the table can
+            be used as usual at any point of the conversion.
+            @param name <str>: Name of the table.
+            @param codec <str>: The new codec, see createTable.
+            @returns None
+        """
+
+        # Make sure the codec is correct
+        checkCodec(codec)
+
+        t = self.loadTable(name, safeMode=False)
+        t.codec = codec
+        self._convertTable(t)
+
+        # Now update our metadata file
+        self.codecs[name] = codec
+        self._writeMeta()
+
+    # Function to change the compression of a table
+    def setCompression(self, name: str, compression: str = None, level: int = None):
+        """
+            Compress a table with another method or level, or stop compressing it. Every
+            segment of the table is written again. Tables read segments compressed in any
+            way, so the table can be used as usual at any point of the conversion.
+            @param name <str>: Name of the table.
+            @param compression <str> [Optional]: "zlib", "bz2", "lzma" or None. Default: None.
+            @param level <int> [Optional]: The compression level. Default: the default level of the method.
+            @returns None
+        """
+
+        # Make sure the compression is correct
+        checkCompression(compression, level)
+
+        t = self.loadTable(name, safeMode=False)
+        t.compression = (compression, level)
+        self._convertTable(t)
+
+        # Now update our metadata file
+        if compression is None:
+            self.compressions.pop(name, None)
+        else:
+            self.compressions[name] = [compression, level]
+        self._writeMeta()
+
+    # Function to change the encryption backend of the database
+    def setCipher(self, backend: str):
+        """
+            Encrypt all the tables of this database with another backend, "fernet" or
+            "aesgcm". Every table is written again. Tables read files encrypted with
+            either backend, so they can be used as usual at any point of the conversion.
+            @param backend <str>: The new encryption backend.
+            @returns None
+        """
+
+        # Make sure the backend is correct
+        checkCipher(backend)
+
+        # New tables get the new backend from now on
+        self.backend = backend
+        self._writeMeta()
+
+        for i in self.tables:
+            t = self.loadTable(i, safeMode=False)
+            t.cipher = self.cipher
+            self._convertTable(t)
+
+    # Write every segment of a table again, in the current format of the table.
+    # For internal use only. Not to be used by users.
+    def _convertTable(self, t):
+        with t._lock.writing():
+            self._convertLocked(t)
+
+    # The work of _convertTable, while holding the write lock of the table
+    def _convertLocked(self, t):
+        # Fold the write-ahead log in so that its documents are converted as well
+        t.checkpoint()
+        manifest = t._loadManifest()
+        indexes = t._loadIndexes(manifest)
+
+        # The segments are written again one by one, the old ones are garbage
+        segments = manifest["segments"]
+        manifest["segments"] = []
+        for docs in t._iterStored(dict(manifest, segments=segments)):
+            manifest["segments"] += t._writeSegments(manifest, [docs])
+        manifest["garbage"] += sum(i["length"] for i in segments)
+        t._writeManifest(manifest)
+
+        # The documents did not move, so the indexes are still correct
+        if indexes:
+            t._saveIndexes(manifest, indexes)
+
     # This function is used to access a table
     def loadTable(self, name: str, safeMode: bool = True, preLoad: bool = False):
         """
@@ -880,7 +3896,7 @@ class db:
             # Otherwise
             else:
                 # Throw an error that it does not exist
-                raise table.TableNotFoundError(
+                raise TableNotFound(
                     f"The requested table {name} has no been created."
                 )
 
@@ -889,18 +3905,78 @@ class db:
             # Get the user the requested table
             return table(name, preLoad=preLoad, parent=self)
 
+    # Method to collect many changes over several tables and write them at once
+    @contextlib.contextmanager
+    def batch(self):
+        """
+            The same as table.batch, for every table of this database used inside it:
+                with mydb.batch():
+                    mydb["orders"].insert(item="pumpkin")
+                    mydb["stock"].update({"item": "pumpkin"}, {"count": 41})
+            Each table is written once, when the batch ends. If the block raises an
+            exception nothing of the batch is written to any table. Every table is locked
+            from its first use until the batch ends, so two batches using the same tables
+            should use them in the same order.
+            @returns <db>: This database
+        """
+
+        # Inside another batch the changes are simply part of that one
+        if getattr(self._local, "batches", None) is not None:
+            yield self
+            return
+
+        self._local.batches = {}
+        try:
+            yield self
+        # Nothing was written yet, so dropping the batches undoes them
+        except BaseException:
+            batches, self._local.batches = self._local.batches, None
+            for handle, state in batches.values():
+                handle._endBatch(state, flush=False)
+            raise
+
+        batches, self._local.batches = self._local.batches, None
+        pending = list(batches.values())
+        try:
+            while pending:
+                handle, state = pending.pop(0)
+                handle._endBatch(state)
+        # The tables after one that failed to be written are let go of unwritten
+        finally:
+            for handle, state in pending:
+                handle._endBatch(state, flush=False)
+
+    # Method to write the queued changes of all the tables now
+    def flush(self):
+        """
+            The same as table.flush, for every table of this database with write-behind.
+            @returns None
+        """
+        for i in list(self._writeBehind):
+            i.flush()
+        fileSyncer.flush()
+
     # Function to export our database for sharing
-    def export(self, path):
+    def export(self, path, compression: str = "zlib", level: int = None):
         """
             This function packages the current database into a single file and saves the
             file in the path provided as the param. This function can be used to create
             encrypted backups for the database.
             @param path <path>: This should be a relative or absolute path to the directory
             where the output package should be saved.
+            @param compression <str> [Optional]: Compress the package with "zlib", "bz2", "lzma"
+            or not at all with None. Default: "zlib".
+            @param level <int> [Optional]: The compression level. Default: the default level of the method.
             @returns key: The output file is encrypted. To use it again you should provide
             the key returned by this function
         """
 
+        # Make sure the compression is correct
+        checkCompression(compression, level)
+
+        # The queued changes of the tables are part of the package
+        self.flush()
+
         # Get the absolute path of the required directory
         path = os.path.abspath(path)
 
@@ -919,23 +3995,43 @@ class db:
         d = {
             "name": self.name,  # Name
             "key": self.key,  # Encryption key of the tables
-            "tables": [],  # The tables
+            "tables": self.tables,  # The tables
+            "codecs": self.codecs,  # The codecs of the tables
+            "compression": self.compressions,  # The compression of the tables
+            "cipher": self.backend,  # The encryption backend of the tables
         }
 
-        # Loop through all the tables
-        for i in self.tables:
-            # Open the table
-            with open(f"{self.dbPath}/db/{self.name}/{i}.tables", "r") as f:
-                # Add the table data to our export package
-                d["tables"].append({"name": i, "data": f.read().encode()})
-
         # Generate a key for export package
         out_key = Fernet.generate_key()
+        cipher = getCipher(out_key, self.backend)
+
+        # Generate and then write to the output file. The package is a series of
+        # encrypted records, so that every table is streamed into it a batch of
+        # documents at a time instead of being loaded whole.
+        package = f"{path}/{self.name}.amazedb"
+        with open(package, "xb") as out:
+            try:
+                out.write(EXPORT_MAGIC)
+                # The first record describes the database
+                out.write(packRecord(cipher.encrypt(json.dumps(d).encode())))
+
+                # Loop through all the tables
+                for i in self.tables:
+                    docs = table(i, self).scan()
+                    while True:
+                        batch = list(itertools.islice(docs, EXPORT_BATCH))
+                        if not batch:
+                            break
+                        # Compress and encrypt the data before writing
+                        record = json.dumps({"table": i, "data": batch}).encode()
+                        record = compressPayload(record, compression, level)
+                        out.write(packRecord(cipher.encrypt(record)))
 
-        # Generate and then write to the output file
-        with open(f"{path}/{self.name}.amazedb", "x") as out:
-            # Encrypt the data before writing
-            out.write(Fernet(out_key).encrypt(json.dumps(d).encode()).decode("utf-8"))
+            # A package cut short can't be imported, so none is left behind
+            except BaseException:
+                out.close()
+                os.remove(package)
+                raise
 
         # Return the encryption key
         return out_key
@@ -954,39 +4050,63 @@ class db:
         try:
 
             # Open the file
-            with open(path, "r") as f:
-
-                # Try to read the file
-                d = f.read().encode("utf-8")
-
-                # Decrypt the file
-                d = Fernet(key).decrypt(d)
+            with open(path, "rb") as f:
+
+                # Packages are a series of encrypted records. The first one
+                # describes the database, the others hold documents of a table
+                if f.read(len(EXPORT_MAGIC)) == EXPORT_MAGIC:
+                    records = (
+                        json.loads(decompressPayload(getCipher(key).decrypt(i)))
+                        for i in readRecords(f)
+                    )
+                    d = next(records)
 
-                # Load the data
-                d = json.loads(d)
+                # Older packages are a single encrypted document holding every table
+                else:
+                    f.seek(0)
+                    d = json.loads(getCipher(key).decrypt(f.read()))
+                    records = ({"table": i["name"], "data": i["data"]} for i in d["tables"])
+                    d["tables"] = [i["name"] for i in d["tables"]]
 
                 # Delete all existing tables
-                [table.tables(self, i).drop() for i in self.tables]
+                [table(i, self).drop() for i in list(self.tables)]
                 self.tables = []
 
+                # Edit the current encryption key and backend
+                self.key = d["key"]
+                self.backend = d.get("cipher", self.backend)
+
                 # Create new tables
+                manifests = {}
                 for i in d["tables"]:
+                    codec = d.get("codecs", {}).get(i, "json")
+                    compression, level = d.get("compression", {}).get(i, (None, None))
+                    new = self.createTable(i, codec=codec, compression=compression, level=level)
+                    manifests[i] = (new, emptyManifest())
+
+                # Write the documents into them, a batch at a time
+                for i in records:
+                    new, manifest = manifests[i["table"]]
+
+                    # Packages from before segmented storage hold the raw table file
+                    if isinstance(i["data"], str):
+                        # Save the data
+                        replaceFile(new.path, i["data"])
+                        manifests[i["table"]] = (new, None)
+                    else:
+                        # Documents from before document ids are numbered in order
+                        for doc in i["data"]:
+                            doc.setdefault("_id", manifest["nextId"])
+                            manifest["nextId"] = max(manifest["nextId"], doc["_id"] + 1)
+                        manifest["segments"] += new._writeSegments(manifest, new._chunk(i["data"]))
+
+                # Save the manifests of the new tables
+                for new, manifest in manifests.values():
+                    if manifest is not None:
+                        new._writeManifest(manifest)
 
-                    # Create a new file
-                    gr = open(f'{self.dbPath}/db/{self.name}/{i["name"]}.tables', "x")
-                    # Save the data
-                    gr.write(i["data"])
-                    # close
-                    gr.close()
-                    # Update the self.tables list
-                    self.tables.append(i["name"])
-
-                # Edit the current encryption key
-                self.key = d["key"]
                 # Update our metadata
-                md = open(f"{self.dbPath}/db/{self.name}/metadata.json", "w")
-                md.write(json.dumps({"name": self.name, "tables": self.tables}))
-                md.close()
+                self._writeMeta()
 
         # The provided file was not found
         except FileNotFoundError:
@@ -1002,86 +4122,881 @@ class db:
                 "Encountered a problem while importing {}: \n\t\t{}".format(path, exc)
             )
 
+# This function copies the result of a read, for every caller that shares it
+def copyResult(result):
+    if isinstance(result, list):
+        return [dict(i) if isinstance(i, dict) else i for i in result]
+    if isinstance(result, dict):
+        return dict(result)
+    return result
+
+# This function makes a coroutine that runs a method of the wrapped object in the
+# worker threads. Reads of a table are shared by callers asking for the same thing.
+def asyncMethod(name: str, read: bool = False):
+    async def method(self, *args, **kwargs):
+        if read:
+            return await self._read(name, args, kwargs)
+        return await self._write(name, args, kwargs)
+
+    method.__name__ = name
+    method.__doc__ = f"The same as {name}, as a coroutine."
+    return method
+
+class AsyncDB:
+    def __init__(self, name: str, dbPath: str = ".", workers: int = None, **options):
+        """
+            A database for asyncio programs. It has the methods of db as coroutines, which
+            run in a few worker threads so that decrypting and parsing the tables does not
+            hold up the event loop:
+                mydb = AsyncDB("shop")
+                orders = await mydb.loadTable("orders")
+                await orders.insert(item="pumpkin")
+                pumpkins = await orders.get({"item": "pumpkin"})
+            @param name <str>: Name of the database.
+            @param dbPath <str> [Optional]: The path to the directory where the 'db' directory is located.
+                                            Default: Current directory.
+            @param workers <int> [Optional]: The most threads reading and writing at once. Parsing
+                                            documents needs the CPU, so more threads than cores
+                                            only slow down the event loop. Default: the number
+                                            of cores, up to 4.
+            @param options: The other options of db, like safeMode, cipher or writeBehind.
+        """
+        # Opening the database just reads its small metadata file
+        self.db = db(name, dbPath=dbPath, **options)
+        if workers is None:
+            workers = min(4, os.cpu_count() or 1)
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix=f"PumpkinDB {name}"
+        )
+
+        # The reads running right now, by table, method and arguments
+        self._reads = {}
+        # The number of writes every table has seen. A read that starts after a write
+        # never shares the result of a read that started before it.
+        self._writes = collections.Counter()
+
+    # Run a function in the worker threads
+    async def _run(self, function, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, functools.partial(function, *args, **kwargs)
+        )
+
+    async def _write(self, name: str, args, kwargs):
+        return await self._run(getattr(self.db, name), *args, **kwargs)
+
+    # Method to access a table
+    async def loadTable(self, name: str, safeMode: bool = True, preLoad: bool = False):
+        """
+            The same as db.loadTable, as a coroutine.
+            @returns <AsyncTable>: The table.
+        """
+        return AsyncTable(await self._run(self.db.loadTable, name, safeMode, preLoad), self)
+
+    # Method to create a table
+    async def createTable(self, name: str, *args, **kwargs):
+        """
+            The same as db.createTable, as a coroutine.
+            @returns <AsyncTable>: The table.
+        """
+        return AsyncTable(await self._run(self.db.createTable, name, *args, **kwargs), self)
+
+    drop = asyncMethod("drop")
+    export = asyncMethod("export")
+    import_data = asyncMethod("import_data")
+    flush = asyncMethod("flush")
+    setCodec = asyncMethod("setCodec")
+    setCompression = asyncMethod("setCompression")
+    setCipher = asyncMethod("setCipher")
+
+    # Method to let go of the worker threads
+    async def close(self):
+        """
+            Write the queued changes of the tables and stop the worker threads.
+            @returns None
+        """
+        await self._run(self.db.flush)
+        self.executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+class AsyncTable:
+    def __init__(self, table, parent: AsyncDB):
+        """
+            A table for asyncio programs, see AsyncDB. It has the methods of table as
+            coroutines. Reads of the same thing from the same table that run at the same
+            time, say a burst of requests for the same page, are read from the drive once
+            and their result is shared.
+            @param table <table>: The table.
+            @param parent <AsyncDB>: The database of the table.
+        """
+        self.table = table
+        self.parent = parent
+        self.name = table.name
+
+    async def _read(self, name: str, args, kwargs):
+        parent = self.parent
+        key = (self.name, parent._writes[self.name], name, repr(args), repr(sorted(kwargs.items())))
+
+        # The same read is running already, share its result
+        future = parent._reads.get(key)
+        if future is not None:
+            result = await asyncio.shield(future)
+            # Every caller gets documents of its own to change
+            return await parent._run(copyResult, result)
+
+        future = asyncio.ensure_future(parent._run(getattr(self.table, name), *args, **kwargs))
+        parent._reads[key] = future
+        try:
+            # A caller that gives up does not stop the read for the others
+            return await asyncio.shield(future)
+        finally:
+            if parent._reads.get(key) is future:
+                del parent._reads[key]
+
+    async def _write(self, name: str, args, kwargs):
+        try:
+            return await self.parent._run(getattr(self.table, name), *args, **kwargs)
+        finally:
+            self.parent._writes[self.name] += 1
+
+    get = asyncMethod("get", read=True)
+    get_one = asyncMethod("get_one", read=True)
+    get_by_id = asyncMethod("get_by_id", read=True)
+    count = asyncMethod("count", read=True)
+    aggregate = asyncMethod("aggregate", read=True)
+    distinct = asyncMethod("distinct", read=True)
+
+    insert = asyncMethod("insert")
+    insert_many = asyncMethod("insert_many")
+    update = asyncMethod("update")
+    update_one = asyncMethod("update_one")
+    remove = asyncMethod("remove")
+    remove_one = asyncMethod("remove_one")
+    create_index = asyncMethod("create_index")
+    drop_index = asyncMethod("drop_index")
+    checkpoint = asyncMethod("checkpoint")
+    flush = asyncMethod("flush")
+    setWriteBehind = asyncMethod("setWriteBehind")
+    drop = asyncMethod("drop")
+
+    # Method to walk through the table without loading all of it
+    async def scan(
+        self, filters: dict = None, batch_size: int = None, fields: list = None, exclude: list = None
+    ):
+        """
+            The same as table.scan, as an async generator:
+                async for doc in orders.scan({"item": "pumpkin"}):
+                    ...
+            The documents are read in the worker threads, 'batch_size' of them at a time.
+        """
+        docs = self.table.scan(filters, batch_size, fields, exclude)
+        try:
+            while True:
+                batch = await self.parent._run(
+                    lambda: list(itertools.islice(docs, batch_size or EXPORT_BATCH))
+                )
+                if not batch:
+                    return
+                for doc in batch:
+                    yield doc
+        finally:
+            docs.close()
+
+    # Method to run any code on the table in the worker threads
+    async def run(self, function, *args, **kwargs):
+        """
+            Run function(table, *args, **kwargs) in the worker threads, for what has
+            no coroutine of its own, like a batch:
+                def restock(t):
+                    with t.batch():
+                        t.update({"item": "pumpkin"}, {"count": 40})
+                        t.insert(item="squash")
+                await orders.run(restock)
+            @returns: What the function returns.
+        """
+        try:
+            return await self.parent._run(function, self.table, *args, **kwargs)
+        finally:
+            self.parent._writes[self.name] += 1
+
+''' The SQL of the command line
+'''
+
+# The tokens of an SQL query: numbers, 'strings', names quoted with "" or `` because
+# they hold spaces or are keywords, words, and operators
+SQL_TOKENS = re.compile(
+    r"""\s*(?:
+        (?P<number>-?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)
+        |'(?P<string>(?:[^']|'')*)'
+        |"(?P<name>(?:[^"]|"")*)"
+        |`(?P<quoted>[^`]*)`
+        |(?P<word>[A-Za-z_][A-Za-z0-9_]*)
+        |(?P<op><=|>=|!=|<>|[=<>(),*;?])
+    )""",
+    re.VERBOSE,
+)
+
+# The words that stand for values in a query
+SQL_CONSTANTS = {"NULL": None, "TRUE": True, "FALSE": False}
+
+# The comparisons of a WHERE clause and the filters they turn into
+SQL_OPERATORS = {
+    "=": "__eq",
+    "!=": "__ne",
+    "<>": "__ne",
+    ">": "__gt",
+    "<": "__lt",
+    ">=": "__gte",
+    "<=": "__lte",
+}
+
+# The parsed statements of the queries run lately, by their text. Typing a query
+# again, or running it from a program in a loop, does not parse it again.
+statementCache = lruCache(maxBytes=1 << 20, maxEntries=256)
+
+# The statements of PREPARE, by name, for EXECUTE to run
+preparedStatements = {}
+
+# The words the parser takes in any case. A query is parsed the same way whatever
+# the case of these, so the statement cache stores them in upper case.
+SQL_KEYWORDS = frozenset(
+    [
+        "AND", "AS", "ASC", "BETWEEN", "BY", "CREATE", "DATABASE", "DEALLOCATE", "DELETE",
+        "DESC", "DISTINCT", "DROP", "EXECUTE", "EXPLAIN", "FROM", "GROUP", "HASH", "IN",
+        "INDEX", "INSERT", "INTO", "LIKE", "LIMIT", "OFFSET", "ON", "OR", "ORDER", "PREPARE",
+        "SELECT", "SET", "SORTED", "STATS", "TABLE", "UPDATE", "USE", "VALUES", "WHERE",
+    ]
+    + list(SQL_CONSTANTS)
+    + [function.upper() for function in AGGREGATES]
+)
+
+# The text of a query with its whitespace, outside of strings and quoted names, cut
+# down to single spaces and its keywords in upper case, so that the same query typed
+# a bit differently is found in the statement cache all the same
+SQL_QUOTED = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*"|`[^`]*`)""")
+SQL_WORD = re.compile(r"\b[A-Za-z_][A-Za-z0-9_]*")
+
+def normalizeSQL(query: str):
+    parts = SQL_QUOTED.split(query.strip())
+    # The quoted parts are the odd ones. Space next to them is kept, so that
+    # two strings are not joined into one.
+    for i in range(0, len(parts), 2):
+        part = parts[i]
+        words = " ".join(part.split())
+        if part[:1].isspace():
+            words = " " + words
+        if part[-1:].isspace() and words.strip():
+            words += " "
+        parts[i] = SQL_WORD.sub(lambda m: m[0].upper() if m[0].upper() in SQL_KEYWORDS else m[0], words)
+    return "".join(parts)
+
+# A ? in a prepared statement. EXECUTE gives the value it stands for,
+# which goes through 'convert' first if there is one.
+class sqlParam:
+    def __init__(self, index: int, convert=None):
+        self.index = index
+        self.convert = convert
+
+    def __repr__(self):
+        return "?"
+
+# This function fills the values given to EXECUTE into a prepared statement. The
+# statement itself is left as it is, for the next EXECUTE.
+def bindSQL(item, values):
+    if isinstance(item, sqlParam):
+        value = values[item.index]
+        return value if item.convert is None else item.convert(value)
+    if isinstance(item, dict):
+        return {key: bindSQL(value, values) for key, value in item.items()}
+    if isinstance(item, (list, tuple)):
+        return type(item)(bindSQL(i, values) for i in item)
+    # The IN conditions
+    if isinstance(item, functools.partial):
+        return functools.partial(item.func, *bindSQL(item.args, values))
+    return item
+
+# This function makes sure the LIMIT or OFFSET of a query is a number of documents
+def checkLimit(value):
+    if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+        raise ValueError(f"Expected a number of documents but found `{value}`.")
+    return value
+
+# This function makes sure the pattern of a LIKE condition is a string and turns it into a RegExp
+def checkLike(pattern):
+    if not isinstance(pattern, str):
+        raise ValueError(f"The pattern of a LIKE must be a string, not `{pattern}`.")
+    return likePattern(pattern)
+
+# This function splits an SQL query into (kind, value) tokens
+def tokenizeSQL(query: str):
+    tokens, position, end = [], 0, len(query.rstrip())
+    while position < end:
+        found = SQL_TOKENS.match(query, position)
+        if found is None:
+            raise ValueError(f"Unexpected `{query[position:].strip()[:10]}` in the query.")
+        position = found.end()
+        kind = found.lastgroup
+        value = found.group(kind)
+        if kind == "number":
+            value = float(value) if re.search(r"[.eE]", value) else int(value)
+        elif kind == "string":
+            value = value.replace("''", "'")
+        elif kind in ("name", "quoted"):
+            kind, value = "name", value.replace('""', '"')
+        tokens.append((kind, value))
+    return tokens
+
+# This function turns the pattern of a LIKE condition into a RegExp:
+# % stands for any text and _ for any one character
+def likePattern(pattern: str):
+    return "(?s)" + "".join(
+        ".*" if c == "%" else "." if c == "_" else re.escape(c) for c in pattern
+    ) + r"\Z"
+
+# This function adds a condition of a WHERE clause to the filters of a query
+def addFilter(filters: dict, field: str, op: str, value):
+    current = filters.get(field, MISSING)
+    if current is MISSING:
+        filters[field] = value if op == "__eq" else {op: value}
+    elif op != "__eq" and isinstance(current, dict) and op not in current:
+        current[op] = value
+    else:
+        raise ValueError(
+            f"The conditions on `{field}` can't be combined. A field is compared \
+            with = alone, or with each of the other operators once."
+        )
+
+class sqlParser:
+    def __init__(self, query: str):
+        """
+            Parses an SQL query into a statement, a dict of the operation and its
+            arguments in the form the methods of the tables take them:
+                SELECT * | COUNT(*) | field, SUM(field) AS name, ... FROM table
+                    [WHERE condition AND ...] [GROUP BY field]
+                    [ORDER BY field [ASC | DESC]] [LIMIT n [OFFSET n]]
+                SELECT DISTINCT field FROM table [WHERE ...] [ORDER BY ...] [LIMIT ...]
+                INSERT INTO table (field, ...) VALUES (value, ...), (value, ...), ...
+                INSERT INTO table FROM 'file.jsonl'
+                UPDATE table SET field = value, ... [WHERE ...]
+                DELETE FROM table [WHERE ...]
+                CREATE TABLE table [(field type, ...)]
+                CREATE [HASH | SORTED] INDEX ON table (field)
+                DROP TABLE table
+                DROP INDEX ON table (field)
+                USE [DATABASE] database
+                PREPARE name AS query
+                EXECUTE name [(value, ...)]
+                DEALLOCATE [PREPARE] name
+                STATS
+            A condition is a field compared with =, !=, <>, <, >, <=, >= to a value, or
+            'field LIKE pattern', 'field BETWEEN value AND value', 'field IN (value, ...)'.
+            Values are numbers, 'strings', TRUE, FALSE and NULL. EXPLAIN in front of a
+            SELECT, UPDATE or DELETE tells how it would be run instead of running it.
+            A query given to PREPARE may have a ? in place of any value, LIMIT and OFFSET
+            included. EXECUTE then runs it with the values given for them, in order.
+            @param query <str>: The query.
+        """
+        self.tokens = tokenizeSQL(query)
+        self.position = 0
+
+        # Whether a keyword was taken as the name of a table or field, like a field
+        # called `count`. The case of such a name matters, so the query is not cached
+        # under its text with the keywords in upper case.
+        self.keywordNames = False
+
+        # The number of ? parameters found so far
+        self.params = 0
+
+    # The token 'offset' tokens ahead, (None, None) past the end of the query
+    def peek(self, offset: int = 0):
+        position = self.position + offset
+        return self.tokens[position] if position < len(self.tokens) else (None, None)
+
+    # What the next token is, for the errors
+    def describe(self):
+        kind, value = self.peek()
+        return "the end of the query" if kind is None else f"`{value}`"
+
+    # Take the next token if it is one of the keywords or operators given
+    def accept(self, *words):
+        kind, value = self.peek()
+        if kind == "word" and value.upper() in words or kind == "op" and value in words:
+            self.position += 1
+            return value.upper()
+        return None
+
+    # The same as accept, but the token has to be there
+    def expect(self, *words):
+        found = self.accept(*words)
+        if found is None:
+            raise ValueError(f"Expected {' or '.join(words)} but found {self.describe()}.")
+        return found
+
+    # Take the name of a table or field
+    def name(self):
+        kind, value = self.peek()
+        if kind not in ("word", "name"):
+            raise ValueError(f"Expected a name but found {self.describe()}.")
+        if kind == "word" and value.upper() in SQL_KEYWORDS:
+            self.keywordNames = True
+        self.position += 1
+        return value
+
+    # Take a list of names or values in brackets
+    def bracketed(self, item):
+        self.expect("(")
+        items = [item()]
+        while self.accept(","):
+            items.append(item())
+        self.expect(")")
+        return items
+
+    # Take a value, or a ? parameter that stands for one
+    def value(self, convert=None):
+        kind, value = self.peek()
+        if (kind, value) == ("op", "?"):
+            self.position += 1
+            self.params += 1
+            return sqlParam(self.params - 1, convert)
+        if convert is not None:
+            return convert(self.value())
+        if kind in ("number", "string"):
+            self.position += 1
+            return value
+        if kind == "word" and value.upper() in SQL_CONSTANTS:
+            self.position += 1
+            return SQL_CONSTANTS[value.upper()]
+        raise ValueError(f"Expected a value but found {self.describe()}.")
+
+    # Parse the whole query
+    def statement(self):
+        if self.accept("PREPARE"):
+            statement = {"op": "prepare", "name": self.name()}
+            self.expect("AS")
+            statement["statement"] = self.query()
+            statement["statement"]["params"] = self.params
+        elif self.accept("EXECUTE"):
+            statement = {"op": "execute", "name": self.name(), "values": []}
+            if self.peek() == ("op", "("):
+                statement["values"] = self.bracketed(self.value)
+        elif self.accept("DEALLOCATE"):
+            self.accept("PREPARE")
+            statement = {"op": "deallocate", "name": self.name()}
+        elif self.accept("STATS"):
+            statement = {"op": "stats"}
+        else:
+            statement = self.query()
+
+        self.accept(";")
+        if self.peek()[0] is not None:
+            raise ValueError(f"Unexpected {self.describe()} after the end of the query.")
+        if self.params and statement["op"] != "prepare":
+            raise ValueError("Only a query given to PREPARE can have ? parameters.")
+        statement.setdefault("explain", False)
+        return statement
+
+    # Parse a query that works on the database
+    def query(self):
+        explain = self.accept("EXPLAIN") is not None
+        operation = self.expect("SELECT", "INSERT", "UPDATE", "DELETE", "CREATE", "DROP", "USE")
+        statement = getattr(self, operation.lower())()
+
+        if explain and statement["op"] not in ("select", "update", "delete"):
+            raise ValueError("Only SELECT, UPDATE and DELETE queries can be explained.")
+        statement["explain"] = explain
+        return statement
+
+    def select(self):
+        statement = {"op": "select", "distinct": self.accept("DISTINCT") is not None}
+        fields, metrics = None, {}
+        if not self.accept("*"):
+            fields = []
+            while True:
+                kind, value = self.peek()
+                # An aggregate, like COUNT(*) or SUM(amount)
+                if kind == "word" and value.lower() in AGGREGATES and self.peek(1) == ("op", "("):
+                    function = value.lower()
+                    self.position += 2
+                    field = None if function == "count" and self.accept("*") else self.name()
+                    self.expect(")")
+                    alias = self.name() if self.accept("AS") else f"{function}({field or '*'})"
+                    metrics[alias] = function if field is None else (function, field)
+                else:
+                    fields.append(self.name())
+                if not self.accept(","):
+                    break
+
+        self.expect("FROM")
+        statement["table"] = self.name()
+        statement["filters"] = self.where()
+
+        statement["group_by"] = None
+        if self.accept("GROUP"):
+            self.expect("BY")
+            statement["group_by"] = self.name()
+
+        statement.update(self.order())
+
+        # The fields of an aggregate are the metrics and the field grouped by
+        if statement["group_by"] is not None and not metrics:
+            raise ValueError("GROUP BY needs an aggregate, like COUNT(*).")
+        if metrics and set(fields) - {statement["group_by"]}:
+            raise ValueError("Only the field of the GROUP BY can be selected next to aggregates.")
+        if statement["distinct"] and (metrics or not fields or len(fields) != 1):
+            raise ValueError("SELECT DISTINCT takes just one field.")
+
+        statement["fields"], statement["metrics"] = fields, metrics
+        return statement
+
+    # Parse the ORDER BY and LIMIT of a query
+    def order(self):
+        order = {"sortby": None, "descending": False, "limit": None, "offset": 0}
+        if self.accept("ORDER"):
+            self.expect("BY")
+            order["sortby"] = self.name()
+            order["descending"] = self.accept("ASC", "DESC") == "DESC"
+        if self.accept("LIMIT"):
+            order["limit"] = self.value(checkLimit)
+            if self.accept("OFFSET"):
+                order["offset"] = self.value(checkLimit)
+        return order
+
+    # Parse the conditions of a WHERE clause into the filters of a query
+    def where(self):
+        filters = {}
+        if not self.accept("WHERE"):
+            return filters
+
+        while True:
+            field = self.name()
+            if self.accept("LIKE"):
+                addFilter(filters, field, "__re", self.value(checkLike))
+            elif self.accept("BETWEEN"):
+                addFilter(filters, field, "__gte", self.value())
+                self.expect("AND")
+                addFilter(filters, field, "__lte", self.value())
+            elif self.accept("IN"):
+                # A function of the standard library, so that parallel scans can send it
+                values = tuple(self.bracketed(self.value))
+                addFilter(filters, field, "__cf", functools.partial(operator.contains, values))
+            else:
+                op = self.expect(*SQL_OPERATORS)
+                addFilter(filters, field, SQL_OPERATORS[op], self.value())
+
+            if self.accept("OR"):
+                raise ValueError("OR is not supported, all the conditions of a query must match.")
+            if not self.accept("AND"):
+                return filters
+
+    def insert(self):
+        self.expect("INTO")
+        statement = {"op": "insert", "table": self.name()}
+
+        # Documents from a file, one JSON object on every line
+        if self.accept("FROM"):
+            statement["file"] = self.value()
+            return statement
+
+        fields = self.bracketed(self.name)
+        self.expect("VALUES")
+        statement["documents"] = []
+        while True:
+            values = self.bracketed(self.value)
+            if len(values) != len(fields):
+                raise ValueError(f"Expected {len(fields)} values but found {len(values)}.")
+            statement["documents"].append(dict(zip(fields, values)))
+            if not self.accept(","):
+                return statement
+
+    def update(self):
+        statement = {"op": "update", "table": self.name(), "values": {}}
+        self.expect("SET")
+        while True:
+            field = self.name()
+            self.expect("=")
+            statement["values"][field] = self.value()
+            if not self.accept(","):
+                break
+        statement["filters"] = self.where()
+        return statement
+
+    def delete(self):
+        self.expect("FROM")
+        return {"op": "delete", "table": self.name(), "filters": self.where()}
+
+    def create(self):
+        kind = self.accept("HASH", "SORTED")
+        if kind is not None or self.accept("INDEX"):
+            if kind is not None:
+                self.expect("INDEX")
+            self.expect("ON")
+            statement = {"op": "create index", "table": self.name(), "kind": (kind or "hash").lower()}
+            statement["field"] = self.bracketed(self.name)[0]
+            return statement
+
+        self.expect("TABLE")
+        statement = {"op": "create table", "table": self.name()}
+        # Tables have no schema, the fields and their types are only read past
+        if self.peek() == ("op", "("):
+            self.bracketed(lambda: [self.name(), self.name()])
+        return statement
+
+    def drop(self):
+        if self.accept("INDEX"):
+            self.expect("ON")
+            statement = {"op": "drop index", "table": self.name()}
+            statement["field"] = self.bracketed(self.name)[0]
+            return statement
+        self.expect("TABLE")
+        return {"op": "drop table", "table": self.name()}
+
+    def use(self):
+        self.accept("DATABASE")
+        return {"op": "use", "database": self.name()}
+
+# This function parses an SQL query, see sqlParser for what is understood. The statement
+# is shared with the next parse of the same query, so it must not be changed.
+def parseSQL(query: str):
+    key = normalizeSQL(query)
+    statement = statementCache.get(key)
+    if statement is None:
+        parser = sqlParser(query)
+        statement = parser.statement()
+        if not parser.keywordNames:
+            statementCache.put(key, statement, len(key))
+    return statement
+
+# Function to get how well the statement cache works
+def sqlStats():
+    """
+        This function tells how many queries were found in the cache of parsed statements,
+        and how many had to be parsed.
+        @returns <dict>: The "cached statements", the cache "hits" and "misses", the "hit rate"
+        and the number of "prepared statements".
+    """
+    lookups = statementCache.hits + statementCache.misses
+    return {
+        "cached statements": len(statementCache.entries),
+        "hits": statementCache.hits,
+        "misses": statementCache.misses,
+        "hit rate": round(statementCache.hits / lookups, 4) if lookups else 0.0,
+        "prepared statements": len(preparedStatements),
+    }
+
+# The number of lines of a JSON lines file read at a time by INSERT ... FROM
+LOAD_BATCH = 10000
+
+# This function reads the documents of a JSON lines file, a chunk of 'size' at a time.
+# Blank lines are skipped, every other line must hold a JSON object.
+def readJsonLines(path: str, size: int = LOAD_BATCH):
+    chunk = []
+    with open(path, "r", encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                doc = json.loads(line)
+            except ValueError as e:
+                raise ValueError(f"Line {number} of {path} is not valid JSON: {e}")
+            if not isinstance(doc, dict):
+                raise ValueError(f"Line {number} of {path} is not a JSON object.")
+            chunk.append(doc)
+            if len(chunk) == size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+# This function runs a parsed SQL statement on a database
+# @param progress <function> [Optional]: Called with the documents read so far and the
+# seconds it took, while INSERT ... FROM reads its file.
+# @returns: The documents of a SELECT, the plan of an EXPLAIN, the number
+# of documents changed by INSERT, UPDATE and DELETE, or True otherwise
+def executeSQL(database, statement: dict, progress=None):
+    op, name = statement["op"], statement.get("table")
+    if op == "create table":
+        database.createTable(name)
+        return True
+
+    t = database.loadTable(name, safeMode=False)
+    filters = statement.get("filters", {})
+
+    if statement.get("explain"):
+        order = {i: statement.get(i) for i in ("sortby", "limit", "descending")}
+        # Aggregates and DISTINCT are sorted and paged after the table is read
+        if op != "select" or statement["metrics"] or statement["distinct"]:
+            order = {}
+        return t.explain(filters, offset=statement.get("offset") or 0, **order)
+
+    if op == "drop table":
+        t.drop()
+        return True
+    if op == "create index":
+        t.create_index(statement["field"], statement["kind"])
+        return True
+    if op == "drop index":
+        t.drop_index(statement["field"])
+        return True
+    if op == "insert" and "file" in statement:
+        if not isinstance(statement["file"], str):
+            raise ValueError(f"Expected the path of a file but found `{statement['file']}`.")
+        # The whole file is read before any of it is written, so that a bad line
+        # leaves the table as it was, and is then written as a single record
+        docs, start = [], time.perf_counter()
+        for chunk in readJsonLines(statement["file"]):
+            docs.extend(chunk)
+            if progress is not None:
+                progress(len(docs), time.perf_counter() - start)
+        t.insert_many(*docs)
+        return len(docs)
+    if op == "insert":
+        t.insert_many(*statement["documents"])
+        return len(statement["documents"])
+    if op == "update":
+        return t.update(filters, statement["values"])
+    if op == "delete":
+        return t.remove(filters)
+
+    sortby, descending = statement["sortby"], statement["descending"]
+    limit, offset = statement["limit"], statement["offset"]
+    if not statement["metrics"] and not statement["distinct"]:
+        return t.get(filters, sortby, limit, offset, descending, fields=statement["fields"])
+
+    if statement["metrics"]:
+        rows = t.aggregate(filters, statement["group_by"], statement["metrics"])
+        if statement["group_by"] is None:
+            rows = [rows]
+    else:
+        field = statement["fields"][0]
+        rows = [{field: i} for i in t.distinct(field, filters)]
+    if sortby:
+        rows = sortDocs(rows, sortby, descending)
+    return rows[offset : None if limit is None else offset + limit]
+
+# This function prints documents as a table, one column for every field
+def printTable(rows, title: str = None):
+    columns = list(dict.fromkeys(field for row in rows for field in row))
+    show = lambda value: value if isinstance(value, str) else json.dumps(value, default=str)
+    cells = [[show(row[i]) if i in row else "" for i in columns] for row in rows]
+    widths = [max([len(str(i))] + [len(row[n]) for row in cells]) for n, i in enumerate(columns)]
+    line = "+" + "+".join("-" * (w + 2) for w in widths) + "+"
+
+    if title:
+        print(title)
+    print(line)
+    print("| " + " | ".join(str(i).ljust(w) for i, w in zip(columns, widths)) + " |")
+    print(line)
+    for row in cells:
+        print("| " + " | ".join(i.ljust(w) for i, w in zip(row, widths)) + " |")
+    print(line)
+
 def sysInfo():
-    sysinfo = PrettyTable(field_names=["KEY", "VALUE"])
-    sysinfo.add_row(["Operating system", platform.platform()])
-    sysinfo.add_row(["Machine type", platform.machine()])
-    sysinfo.add_row(["Machine architecture", platform.architecture()[1]+", "+platform.architecture()[0]])
-    sysinfo.add_row(["Platform processor", platform.platform()])
-    sysinfo.add_row(["Systems network name", platform.node()])
-    sysinfo.add_row(["Python build no.", platform.python_build()[0]])
-    sysinfo.add_row(["Python build date", platform.python_build()[1]])
-    sysinfo.add_row(["Python compiler", platform.python_compiler()])
-    sysinfo.add_row(["Python implementation", platform.python_implementation()])
-    sysinfo.add_row(["Python version", platform.python_version()])
-    sysinfo.align["KEY"] = "l"
-    sysinfo.align["VALUE"] = "l"
-    print(sysinfo.get_string(title="-:SYSTEM INFO:-"))
+    sysinfo = [
+        ["Operating system", platform.platform()],
+        ["Machine type", platform.machine()],
+        ["Machine architecture", platform.architecture()[1]+", "+platform.architecture()[0]],
+        ["Platform processor", platform.platform()],
+        ["Systems network name", platform.node()],
+        ["Python build no.", platform.python_build()[0]],
+        ["Python build date", platform.python_build()[1]],
+        ["Python compiler", platform.python_compiler()],
+        ["Python implementation", platform.python_implementation()],
+        ["Python version", platform.python_version()],
+    ]
+    printTable([{"KEY": key, "VALUE": value} for key, value in sysinfo], title="-:SYSTEM INFO:-")
 
 def queryProcessor(QUERY : str):
     global mydb
 
-    query_tokens = QUERY.split()
-    # Get the primary operation...
-    operationPrimary = query_tokens[0].upper()
+    # Parse the query, see sqlParser for the SQL understood
+    try:
+        statement = parseSQL(QUERY)
+    except ValueError as e:
+        print("\t[EXCEPTION] Malformed query!", e)
+        return None
+
+    # Show how well the statement cache works
+    if statement["op"] == "stats":
+        stats = sqlStats()
+        printTable([{"STAT": key, "VALUE": value} for key, value in stats.items()])
+        return stats
+
+    # Keep a query to run later with EXECUTE
+    if statement["op"] == "prepare":
+        preparedStatements[statement["name"]] = statement["statement"]
+        print("\t[INFO] Prepared", statement["name"])
+        return True
 
-    # Create or Use a database
-    if operationPrimary == "USE":
-        if query_tokens[1].upper() == "DATABASE":
-            try:
-                mydb = db(query_tokens[2])
-                print("\t[INFO] Connected to",  query_tokens[2])
-            except: print("\t[EXCEPTION] Failed to create/connect to", query_tokens[2])
-        else: print("\t[EXCEPTION] Malformed query!")
-    
-    # Create a table
-    elif operationPrimary == "CREATE":
-        if mydb != "":    
-            if query_tokens[1].upper() == "TABLE":
-                table_name = query_tokens[2]
-                table = mydb.createTable(table_name)
-                table = mydb.loadTable(table_name)
-                if len(query_tokens) <= 5: print("\t[EXCEPTION] Empty query data!")
-                
-                if len(query_tokens) > 5 and query_tokens[3] == "(" and query_tokens[-1] == ")":
-                    table_headers = [qt.upper() for qt in query_tokens[4:-2]]
-                    table_meta = [tuple(table_headers[x:x+2]) for x in range(0, len(table_headers), 2)]
-                    
-                    # Get header names
-                    header_dict = {}
-                    for tm in table_meta:
-                        header_dict.update({tm[0] : tm[1]})
-                    table.insert(header_dict)
-                    return True
-                else: print("\t[EXCEPTION] Malformed query!")
-            else: print("\t[EXCEPTION] Invalid option! \n\t(only thing we create is table.)")
-        else: print("\t[EXCEPTION] No database defined! \n\t(you can't live in a house which doesn't exist)")
-
-    elif operationPrimary == "INSERT":
-        if query_tokens[1].upper() == "INTO" and len(query_tokens) > 5:
-            table_name = query_tokens[2]
-            table = mydb.loadTable(table_name)
-            table.insert({})
-        result = None
-        return result
-    
-    elif operationPrimary == "SELECT":
-        result = None
-        return result
-    
-    elif operationPrimary == "UPDATE":
-        result = None
-        return result
-    
-    elif operationPrimary == "DELETE":
-        result = None
-        return result
-    
-    elif operationPrimary == "DROP":
-        result = None
-        return result
-    
-    # return result
+    if statement["op"] == "deallocate":
+        if preparedStatements.pop(statement["name"], None) is None:
+            print("\t[EXCEPTION] No prepared statement named", statement["name"])
+            return None
+        print("\t[INFO] Deallocated", statement["name"])
+        return True
+
+    # Run a prepared query with the values given for its ? parameters
+    if statement["op"] == "execute":
+        prepared = preparedStatements.get(statement["name"])
+        if prepared is None:
+            print("\t[EXCEPTION] No prepared statement named", statement["name"])
+            return None
+        values = statement["values"]
+        if len(values) != prepared["params"]:
+            print(f"\t[EXCEPTION] Expected {prepared['params']} values but found {len(values)}.")
+            return None
+        try:
+            statement = bindSQL(prepared, values)
+        except ValueError as e:
+            print("\t[EXCEPTION] Malformed query!", e)
+            return None
+
+    # Connect to a database, it is created if it is not there
+    if statement["op"] == "use":
+        try:
+            mydb = db(statement["database"])
+            print("\t[INFO] Connected to", statement["database"])
+            return True
+        except Exception as e:
+            print("\t[EXCEPTION] Failed to create/connect to", statement["database"], e)
+            return None
+
+    if mydb == "":
+        print("\t[EXCEPTION] No database defined! \n\t(you can't live in a house which doesn't exist)")
+        return None
+
+    # Big loads tell how far they got as they read their file
+    def progress(rows, seconds):
+        if rows >= LOAD_BATCH:
+            print(f"\t[INFO] {rows} document(s) read, {rows / max(seconds, 1e-9):.0f} rows/s")
+
+    start = time.perf_counter()
+    try:
+        result = executeSQL(mydb, statement, progress)
+    except Exception as e:
+        print(f"\t[EXCEPTION] {type(e).__name__}: {e}")
+        return None
+
+    # Show the plan of an EXPLAIN and the documents of a SELECT
+    if statement["explain"]:
+        printTable([{"PLAN": key, "VALUE": value} for key, value in result.items()])
+    elif statement["op"] == "select":
+        if result:
+            printTable(result)
+        print(f"\t[INFO] {len(result)} document(s)")
+    elif statement["op"] in ("insert", "update", "delete"):
+        done = {"insert": "inserted", "update": "updated", "delete": "deleted"}[statement["op"]]
+        print(f"\t[INFO] {'Queued' if result is None else result} document(s) {done}")
+        if statement["op"] == "insert" and result >= LOAD_BATCH:
+            seconds = time.perf_counter() - start
+            print(f"\t[INFO] Took {seconds:.2f}s, {result / max(seconds, 1e-9):.0f} rows/s")
+    else:
+        print("\t[INFO] Done")
+    return result
 
 def CLI():
     QUERY = "None"
@@ -1089,8 +5004,8 @@ def CLI():
     sysInfo()
     while(QUERY.upper() != "EXIT"):
         try:
-            QUERY = input("\n [QUERY]>> ")
-            if QUERY.strip() != "":
+            QUERY = input("\n [QUERY]>> ").strip()
+            if QUERY != "" and QUERY.upper() != "EXIT":
                 queryProcessor(QUERY)
             else: pass
         except(KeyboardInterrupt):
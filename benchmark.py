@@ -0,0 +1,271 @@
+''' Benchmarks for PumpkinDB.
+    Run them with: python benchmark.py
+    Options:
+        --sizes 1000 10000      The numbers of documents of the tables timed
+        --runs 100              The times every operation is run, fewer for the ones reading the whole table
+        --output results.json   Where to save the results
+        --compare baseline.json Flag the operations slower than in a saved run
+        --threshold 0.2         How much slower an operation may get before it is flagged
+        --ciphers               Compare the encryption backends instead
+'''
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+# PumpkinDB prints its banner when imported
+with contextlib.redirect_stdout(io.StringIO()):
+    import PumpkinDB
+
+from cryptography.fernet import Fernet
+
+# The sizes of the tables timed by default
+SIZES = (1000, 10000, 100000, 1000000)
+
+# The names of the cities of the documents
+CITIES = ("Pune", "Delhi", "Mumbai", "Chennai", "Kolkata", "Jaipur", "Surat", "Indore")
+
+# Function to time a function, returns the best of a few runs in seconds
+def best(function, runs: int = 5):
+    times = []
+    for i in range(runs):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+# Function to time every run of a function, returns their times in seconds.
+# 'setup' is run before every run, without being timed.
+def timings(function, runs: int, setup=None):
+    times = []
+    for i in range(runs):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return times
+
+# Function to get the p-th percentile of some times, by the nearest rank
+def percentile(times, p: float):
+    times = sorted(times)
+    return times[min(len(times) - 1, max(0, round(p / 100 * len(times)) - 1))]
+
+# Function to sum up the times of an operation
+def summary(times, docs: int = 1):
+    return {
+        "runs": len(times),
+        "docs": docs,  # Documents written or read by a run
+        "ops_per_sec": round(len(times) / sum(times), 2),
+        "p50_ms": round(percentile(times, 50) * 1000, 4),
+        "p99_ms": round(percentile(times, 99) * 1000, 4),
+    }
+
+# Function to make a document of the synthetic tables. About a tenth of the table
+# shares a 'group', and 'amount' is spread evenly up to a million.
+def makeDoc(rng, i: int, size: int):
+    return {
+        "name": f"user{i}",
+        "group": i % max(1, size // 10),
+        "amount": rng.randrange(1000000),
+        "city": rng.choice(CITIES),
+        "note": "".join(rng.choice("abcdefghijklmnopqrstuvwxyz ") for i in range(40)),
+    }
+
+# Function to fill a table with 'size' documents, and write them into its segments
+def buildTable(t, size: int, rng):
+    for start in range(0, size, 10000):
+        t.insert_many(*[makeDoc(rng, i, size) for i in range(start, min(size, start + 10000))])
+    t.checkpoint()
+
+# Function to time the operations of the tables on a table of 'size' documents
+def suite(size: int, runs: int = 100):
+    """
+        Times the table operations on a synthetic table of 'size' documents. The
+        operations that read the whole table, like get without an index, are run
+        fewer times on big tables. The reads find their segments decrypted in the
+        cache after the first run, like in a program that keeps using its tables.
+        @param size <int>: The documents of the table.
+        @param runs <int> [Optional]: The times every operation is run. Default: 100.
+        @returns <dict>: The summary of every operation, by name.
+    """
+    rng = random.Random(size)
+    scans = max(3, min(runs, 100000 // size))
+    groups = max(1, size // 10)
+    results = {}
+
+    with tempfile.TemporaryDirectory() as folder:
+        os.mkdir(f"{folder}/db")
+        mydb = PumpkinDB.db("bench", folder)
+        t = mydb.createTable("docs")
+        buildTable(t, size, rng)
+
+        # Reads, with filters on equality and on a range of 1% of the amounts
+        group = lambda: {"group": rng.randrange(groups)}
+        amounts = lambda: {"amount": {"__gte": rng.randrange(990000)}}
+        def span():
+            low = rng.randrange(990000)
+            return {"amount": {"__gte": low, "__lt": low + 10000}}
+
+        results["get_one_eq"] = summary(timings(lambda: t.get_one(group()), scans))
+        results["get_one_range"] = summary(timings(lambda: t.get_one(amounts()), runs))
+        results["get_eq"] = summary(timings(lambda: t.get(group()), scans))
+        results["get_range"] = summary(timings(lambda: t.get(span()), scans))
+
+        # Changes to the documents of a group at a time, about ten documents
+        values = lambda: {"amount": rng.randrange(1000000)}
+        results["update"] = summary(timings(lambda: t.update(group(), values()), scans))
+        removed = iter(rng.sample(range(groups), min(groups, scans)))
+        results["remove"] = summary(
+            timings(lambda: t.remove({"group": next(removed)}), min(groups, scans))
+        )
+
+        # The whole database to a package and back
+        path = f"{folder}/{mydb.name}.amazedb"
+        clean = lambda: os.path.exists(path) and os.remove(path)
+        keys = []
+        exports = timings(lambda: keys.append(mydb.export(folder)), 5, setup=clean)
+        results["export"] = summary(exports, size)
+        restore = PumpkinDB.db("restore", folder)
+        results["import_data"] = summary(timings(lambda: restore.import_data(path, keys[-1]), 5), size)
+
+        # Writes
+        results["insert"] = summary(timings(lambda: t.insert(makeDoc(rng, size, size)), runs))
+        batch = lambda: [makeDoc(rng, size, size) for i in range(1000)]
+        docs = []
+        results["insert_many"] = summary(
+            timings(lambda: t.insert_many(*docs[-1]), 10, setup=lambda: docs.append(batch())), 1000
+        )
+
+    return results
+
+# Function to time the operations on tables of every size
+def runSuite(sizes=SIZES, runs: int = 100):
+    results = {}
+    for size in sizes:
+        print(f"Timing a table of {size} documents...", flush=True)
+        results[str(size)] = suite(size, runs)
+        printResults({str(size): results[str(size)]})
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "runs": runs,
+        },
+        "results": results,
+    }
+
+# Function to print the results of a run
+def printResults(results):
+    print(f"{'size':>8} {'operation':14} {'ops/s':>12} {'p50 ms':>10} {'p99 ms':>10}")
+    for size, operations in results.items():
+        for name, i in operations.items():
+            print(
+                f"{size:>8} {name:14} {i['ops_per_sec']:>12.1f}"
+                f" {i['p50_ms']:>10.3f} {i['p99_ms']:>10.3f}"
+            )
+
+# Function to compare a run with a saved one
+def compare(baseline, current, threshold: float = 0.2):
+    """
+        Compares the median times of the operations of two runs of the suite. An
+        operation is flagged as a regression if its median time grew by more than
+        'threshold', as a share of its time in the baseline.
+        @param baseline <dict>: The saved run.
+        @param current <dict>: The new run.
+        @param threshold <float> [Optional]: The growth allowed. Default: 0.2, 20%.
+        @returns <list>: The (size, operation) of the regressions
+    """
+    regressions = []
+    print(f"{'size':>8} {'operation':14} {'baseline ms':>12} {'now ms':>10} {'change':>8}")
+    for size, operations in current["results"].items():
+        for name, i in operations.items():
+            old = baseline["results"].get(size, {}).get(name)
+            if old is None:
+                continue
+            change = i["p50_ms"] / old["p50_ms"] - 1 if old["p50_ms"] else 0.0
+            flag = ""
+            if change > threshold:
+                flag = "REGRESSION"
+                regressions.append((size, name))
+            elif change < -threshold:
+                flag = "faster"
+            print(
+                f"{size:>8} {name:14} {old['p50_ms']:>12.3f} {i['p50_ms']:>10.3f}"
+                f" {change:>+8.1%} {flag}"
+            )
+    return regressions
+
+# Function to compare the encryption backends
+def ciphers(sizes=(1 << 10, 64 << 10, 1 << 20), repeat: int = 20):
+    """
+        Measures how many MB/s each cipher backend encrypts and decrypts, for
+        payloads of a few sizes, and how big the encrypted blobs are.
+        @param sizes <tuple> [Optional]: Payload sizes in bytes.
+        @param repeat <int> [Optional]: Payloads encrypted per run.
+    """
+    key = Fernet.generate_key()
+    print(f"{'backend':8} {'payload':>9} {'encrypt':>12} {'decrypt':>12} {'blob size':>10}")
+
+    for size in sizes:
+        # A table segment is a JSON list of documents, about 40 bytes each
+        docs = [{"_id": i, "name": f"user{i}", "age": i % 90} for i in range(size // 30)]
+        payload = json.dumps(docs).encode()[:size]
+
+        for backend in PumpkinDB.CIPHERS:
+            cipher = PumpkinDB.getCipher(key, backend)
+            blob = cipher.encrypt(payload)
+
+            encrypt = best(lambda: [cipher.encrypt(payload) for i in range(repeat)])
+            decrypt = best(lambda: [cipher.decrypt(blob) for i in range(repeat)])
+
+            mb = size * repeat / 1e6
+            print(
+                f"{backend:8} {size:>9} {mb / encrypt:>9.1f}MB/s"
+                f" {mb / decrypt:>9.1f}MB/s {len(blob) / size:>9.2f}x"
+            )
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks for PumpkinDB.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    parser.add_argument("--runs", type=int, default=100)
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--compare", metavar="BASELINE")
+    parser.add_argument("--threshold", type=float, default=0.2)
+    parser.add_argument("--ciphers", action="store_true")
+    args = parser.parse_args(argv)
+
+    if args.ciphers:
+        ciphers()
+        return 0
+
+    # Read the baseline first, so that a bad path is found before the long run
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    results = runSuite(args.sizes, args.runs)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Saved the results to {args.output}")
+
+    if baseline is not None:
+        regressions = compare(baseline, results, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} operation(s) got slower than the baseline")
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
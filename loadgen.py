@@ -0,0 +1,548 @@
+''' A load generator for PumpkinDB, to see how a database holds up under many clients at once.
+    Run it with: python loadgen.py --workload A --threads 8 --duration 30
+    Options:
+        --workload A            One of the YCSB workloads A to F, see WORKLOADS
+        --mix read=0.9,insert=0.1
+                                The share of every operation, instead of those of the workload
+        --distribution zipfian  How the documents are picked: uniform, zipfian or latest
+        --threads 4             The clients, as threads of this process
+        --processes 4           The clients, as processes
+        --duration 10           The seconds the clients run for
+        --records 10000         The documents the table starts with
+        --durability commit     How the writes reach the drive, see table.setDurability
+        --write-behind          Queue the writes and write them in the background
+        --no-index              Leave out the index over the keys
+        --path DIR              Where to put the database. Default: a temporary directory
+        --output results.json   Save the results
+    Every client has a database object of its own. When the time is up the table is read
+    back in full: every document written must be there, once, unchanged, and hold every
+    update made to it. It exits with an error if anything was lost or broken.
+'''
+import argparse
+import concurrent.futures
+import contextlib
+import io
+import json
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import zlib
+
+# PumpkinDB prints its banner when imported
+with contextlib.redirect_stdout(io.StringIO()):
+    import PumpkinDB
+
+# The operations of the workloads:
+#   "read": get the document of a key
+#   "update": change a field of the document of a key
+#   "insert": add a document with a new key
+#   "scan": get the documents of up to 100 keys from a key on
+#   "rmw": read the document of a key, then change it
+OPERATIONS = ("read", "update", "insert", "scan", "rmw")
+
+# The core workloads of YCSB: the share of every operation, and how the keys are picked
+WORKLOADS = {
+    "A": ({"read": 0.5, "update": 0.5}, "zipfian"),  # Update heavy, like a session store
+    "B": ({"read": 0.95, "update": 0.05}, "zipfian"),  # Read mostly, like photo tags
+    "C": ({"read": 1.0}, "zipfian"),  # Read only, like a cache of user profiles
+    "D": ({"read": 0.95, "insert": 0.05}, "latest"),  # Read the latest, like status updates
+    "E": ({"scan": 0.95, "insert": 0.05}, "zipfian"),  # Short ranges, like threaded conversations
+    "F": ({"read": 0.5, "rmw": 0.5}, "zipfian"),  # Read-modify-write, like a user database
+}
+
+# The ways keys are picked
+DISTRIBUTIONS = ("uniform", "zipfian", "latest")
+
+# The fields of every document, besides its key
+FIELDS = 5
+
+# The most keys a scan reads
+SCAN_LENGTH = 100
+
+# The name of the database and table of the load
+NAME = "loadgen"
+
+class zipfian:
+    def __init__(self, items: int, theta: float = 0.99):
+        """
+            Picks numbers from 0 up to 'items' so that a few of them come up most of the
+            time, like the popular items of a real application. The algorithm of
+            Gray et al, "Quickly generating billion-record synthetic databases", as in YCSB.
+            @param items <int>: The numbers to pick from.
+            @param theta <float> [Optional]: How skewed the picks are. Default: 0.99, as in YCSB.
+        """
+        self.items = items
+        self.theta = theta
+        self.zetan = sum(1 / i ** theta for i in range(1, items + 1))
+        self.zeta2 = 1 + 0.5 ** theta
+        self.alpha = 1 / (1 - theta)
+        # With one or two numbers the first two cases of next pick them all
+        self.eta = 0.0
+        if items > 2:
+            self.eta = (1 - (2 / items) ** (1 - theta)) / (1 - self.zeta2 / self.zetan)
+
+    def next(self, rng):
+        u = rng.random()
+        uz = u * self.zetan
+        if uz < 1:
+            return 0
+        if uz < self.zeta2:
+            return 1
+        return min(self.items - 1, int(self.items * (self.eta * u - self.eta + 1) ** self.alpha))
+
+# Function to spread the popular numbers of a zipfian over all the keys, with
+# the FNV-1a hash, so that they don't all sit at the start of the table
+def scramble(number: int, items: int):
+    h = 0xCBF29CE484222325
+    for byte in number.to_bytes(8, "little"):
+        h = ((h ^ byte) * 0x100000001B3) & 0xFFFFFFFFFFFFFFFF
+    return h % items
+
+# Function to make a field value that carries its own checksum
+def sealed(rng):
+    text = "".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for i in range(16))
+    return f"{text}:{zlib.crc32(text.encode()):08x}"
+
+# Function to check a field value made by sealed
+def intact(value):
+    if not isinstance(value, str) or ":" not in value:
+        return False
+    text, crc = value.rsplit(":", 1)
+    return f"{zlib.crc32(text.encode()):08x}" == crc
+
+# Function to make the document of a key
+def makeDoc(rng, key: int):
+    doc = {"n": key}
+    for i in range(FIELDS):
+        doc[f"f{i}"] = sealed(rng)
+    return doc
+
+# Function to check the fields of a document, returns the broken ones
+def brokenFields(doc):
+    return [f"f{i}" for i in range(FIELDS) if not intact(doc.get(f"f{i}"))]
+
+class histogram:
+    def __init__(self):
+        """
+            A histogram of latencies, in buckets a quarter of a power of two wide, so
+            that the percentiles are within about 20% of the exact ones however long
+            the load runs.
+        """
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds: float):
+        bucket = math.floor(math.log2(max(seconds * 1e6, 1e-3)) * 4)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def merge(self, other):
+        for bucket, count in other.buckets.items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    # The latency, in ms, that 'p' percent of the operations took at most
+    def percentile(self, p: float):
+        rank = math.ceil(p / 100 * self.count)
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(2 ** ((bucket + 1) / 4) / 1000, self.max * 1000)
+        return self.max * 1000
+
+    # The operations in every power of two of microseconds
+    def octaves(self):
+        octaves = {}
+        for bucket, count in self.buckets.items():
+            octaves[bucket // 4] = octaves.get(bucket // 4, 0) + count
+        return dict(sorted(octaves.items()))
+
+    def toDict(self):
+        return {"buckets": self.buckets, "count": self.count, "total": self.total, "max": self.max}
+
+    @classmethod
+    def fromDict(cls, d):
+        h = cls()
+        h.buckets = {int(k): v for k, v in d["buckets"].items()}
+        h.count, h.total, h.max = d["count"], d["total"], d["max"]
+        return h
+
+# Function to read the share of every operation from --mix, like "read=0.9,insert=0.1"
+def parseMix(text: str):
+    mix = {}
+    for part in text.split(","):
+        name, _, share = part.partition("=")
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise ValueError(f"The operation `{name}` is not valid. Must be one of {', '.join(OPERATIONS)}")
+        mix[name] = float(share)
+    if sum(mix.values()) <= 0:
+        raise ValueError("The shares of the operations must add up to more than 0.")
+    return mix
+
+# Function to open the database of the load, the same way in every client
+def openTable(config):
+    mydb = PumpkinDB.db(
+        NAME,
+        config["path"],
+        durability=config["durability"],
+        writeBehind=config["writeBehind"],
+    )
+    return mydb, mydb.loadTable(NAME)
+
+# Function to fill the table with the documents the load starts with
+def load(config):
+    rng = random.Random(0)
+    mydb, t = openTable(config)
+    records = config["records"]
+    for start in range(0, records, 10000):
+        t.insert_many(*[makeDoc(rng, i) for i in range(start, min(records, start + 10000))])
+    if config["index"]:
+        t.create_index("n", "sorted")
+    mydb.flush()
+    t.checkpoint()
+
+# Function to run one client of the load, until the time is up
+def client(config, worker: int):
+    """
+        Runs the operations of the mix on the table until the time is up, and keeps
+        track of what was written, so that it can be checked afterwards.
+        @param config <dict>: The settings of the load.
+        @param worker <int>: The number of this client.
+        @returns <dict>: The "histograms" and "errors" of every operation, the reads
+        that found nothing ("missing"), the documents read with broken fields ("corrupt"),
+        the "updates" made to every key, the keys "inserted" and the "locks" waited for
+    """
+    rng = random.Random(worker + 1)
+    mydb, t = openTable(config)
+    locks = lockWait()
+    records, workers = config["records"], config["workers"]
+    names, shares = zip(*config["mix"].items())
+    keys = zipfian(records) if config["distribution"] != "uniform" else None
+
+    histograms = {i: histogram() for i in names}
+    errors = {i: 0 for i in names}
+    firstErrors = []
+    missing, corrupt = 0, []
+    updates, inserted = {}, []
+    counter = f"w{worker}"
+
+    # Pick the key of an operation
+    def pick():
+        if config["distribution"] == "uniform":
+            return rng.randrange(records)
+        if config["distribution"] == "latest":
+            # The newest keys are the most popular, the ones of this client are known to be there
+            newest = records + len(inserted) * workers
+            return max(0, newest - 1 - keys.next(rng))
+        return scramble(keys.next(rng), records)
+
+    # Check a document read
+    def check(key, doc):
+        nonlocal missing
+        if doc is None:
+            # The documents the table started with are never deleted
+            if key < records:
+                corrupt.append(f"Document {key} is gone")
+            missing += 1
+            return
+        broken = brokenFields(doc)
+        if broken:
+            corrupt.append(f"Document {key} has broken fields {broken}")
+
+    # Change the key, counting the changes this client made to it
+    def change(key):
+        key = key % records
+        values = {f"f{rng.randrange(FIELDS)}": sealed(rng), counter: updates.get(key, 0) + 1}
+        t.update_one({"n": key}, values)
+        updates[key] = updates.get(key, 0) + 1
+
+    deadline = time.perf_counter() + config["duration"]
+    while time.perf_counter() < deadline:
+        op = rng.choices(names, shares)[0]
+        key = pick()
+        start = time.perf_counter()
+        try:
+            if op == "read":
+                check(key, t.get_one({"n": key}))
+            elif op == "update":
+                change(key)
+            elif op == "insert":
+                key = records + worker + len(inserted) * workers
+                t.insert(makeDoc(rng, key))
+                inserted.append(key)
+            elif op == "scan":
+                for doc in t.get({"n": {"__gte": key, "__lt": key + rng.randint(1, SCAN_LENGTH)}}):
+                    check(doc["n"], doc)
+            else:
+                check(key % records, t.get_one({"n": key % records}))
+                change(key)
+        except Exception as e:
+            errors[op] += 1
+            if len(firstErrors) < 5:
+                firstErrors.append(f"{op}: {type(e).__name__}: {e}")
+            continue
+        histograms[op].add(time.perf_counter() - start)
+
+    # The queued writes are part of the load
+    try:
+        mydb.flush()
+    except Exception as e:
+        firstErrors.append(f"flush: {type(e).__name__}: {e}")
+
+    return {
+        "histograms": {i: h.toDict() for i, h in histograms.items()},
+        "errors": errors,
+        "firstErrors": firstErrors,
+        "missing": missing,
+        "corrupt": corrupt[:20],
+        "corruptCount": len(corrupt),
+        "updates": {str(k): v for k, v in updates.items()},
+        "inserted": inserted,
+        "locks": {i: v - locks[i] for i, v in lockWait().items()},
+    }
+
+# Function to add up the lock waits of the table in this process
+def lockWait():
+    stats = PumpkinDB.lockStats()
+    return {
+        "acquired": sum(i["acquired"] for i in stats.values()),
+        "waited": sum(i["waited"] for i in stats.values()),
+    }
+
+# Function to read the whole table back and check it against what the clients wrote
+def verify(config, results):
+    """
+        Reads every document of the table with a new database object, and checks that
+        the documents the table started with and the ones inserted are all there once,
+        that their fields are unchanged, and that they hold the last update of every
+        client. An update that is not there was lost.
+        @returns <dict>: The "documents" read, and the lists of "lost" writes and "broken" documents
+    """
+    lost, broken = [], []
+    seen, ids = {}, set()
+    try:
+        mydb, t = openTable(config)
+        docs = list(t.scan())
+    except Exception as e:
+        return {"documents": 0, "lost": [], "broken": [f"Can't read the table: {type(e).__name__}: {e}"]}
+
+    for doc in docs:
+        if doc["_id"] in ids:
+            broken.append(f"The _id {doc['_id']} is used twice")
+        ids.add(doc["_id"])
+        key = doc.get("n")
+        if key in seen:
+            broken.append(f"Document {key} is there twice")
+        seen[key] = doc
+        fields = brokenFields(doc)
+        if fields:
+            broken.append(f"Document {key} has broken fields {fields}")
+
+    expected = set(range(config["records"]))
+    for worker, result in enumerate(results):
+        expected.update(result["inserted"])
+        counter = f"w{worker}"
+        for key, count in result["updates"].items():
+            doc = seen.get(int(key))
+            if doc is not None and doc.get(counter, 0) != count:
+                lost.append(f"Document {key} holds update {doc.get(counter, 0)} of client {worker}, not {count}")
+
+    for key in sorted(expected - set(seen)):
+        lost.append(f"Document {key} is missing")
+    return {"documents": len(docs), "lost": lost, "broken": broken}
+
+# Function to run the whole load and work out its results
+def run(config):
+    load(config)
+
+    # The locks taken while loading the table are not part of the load
+    before = lockWait()
+    start = time.perf_counter()
+    if config["processes"]:
+        pool = concurrent.futures.ProcessPoolExecutor(config["workers"])
+    else:
+        pool = concurrent.futures.ThreadPoolExecutor(config["workers"])
+    with pool:
+        futures = [pool.submit(client, config, i) for i in range(config["workers"])]
+        results = [i.result() for i in futures]
+    elapsed = time.perf_counter() - start
+
+    # Threads share the locks of this process, processes have their own
+    if config["processes"]:
+        locks = {
+            "acquired": sum(i["locks"]["acquired"] for i in results),
+            "waited": sum(i["locks"]["waited"] for i in results),
+        }
+    else:
+        after = lockWait()
+        locks = {i: after[i] - before[i] for i in after}
+
+    histograms = {}
+    for result in results:
+        for op, h in result["histograms"].items():
+            histograms.setdefault(op, histogram()).merge(histogram.fromDict(h))
+
+    operations = {}
+    for op, h in histograms.items():
+        operations[op] = {
+            "count": h.count,
+            "errors": sum(i["errors"][op] for i in results),
+            "ops_per_sec": round(h.count / elapsed, 2),
+            "mean_ms": round(h.total / h.count * 1000, 4) if h.count else 0.0,
+            "p50_ms": round(h.percentile(50), 4),
+            "p95_ms": round(h.percentile(95), 4),
+            "p99_ms": round(h.percentile(99), 4),
+            "p999_ms": round(h.percentile(99.9), 4),
+            "max_ms": round(h.max * 1000, 4),
+            "histogram": {f"<{2 ** (i + 1)}us": n for i, n in h.octaves().items()},
+        }
+
+    check = verify(config, results)
+    corrupt = [j for i in results for j in i["corrupt"]]
+    return {
+        "config": {i: v for i, v in config.items() if i != "path"},
+        "seconds": round(elapsed, 3),
+        "throughput": round(sum(h.count for h in histograms.values()) / elapsed, 2),
+        "operations": operations,
+        "locks": {
+            "acquired": locks["acquired"],
+            "waited_sec": round(locks["waited"], 4),
+            "mean_wait_ms": round(locks["waited"] / locks["acquired"] * 1000, 4) if locks["acquired"] else 0.0,
+            # The share of the clients' time spent waiting for the lock
+            "share": round(locks["waited"] / (elapsed * config["workers"]), 4),
+        },
+        "missing_reads": sum(i["missing"] for i in results),
+        "errors": [j for i in results for j in i["firstErrors"]],
+        "corrupt_reads": sum(i["corruptCount"] for i in results),
+        "corrupt": corrupt[:20],
+        "documents": check["documents"],
+        "lost": check["lost"][:20],
+        "lost_count": len(check["lost"]),
+        "broken": check["broken"][:20],
+        "broken_count": len(check["broken"]),
+    }
+
+# Function to print the results of a load
+def report(results):
+    config = results["config"]
+    kind = "processes" if config["processes"] else "threads"
+    print(
+        f"{config['workers']} {kind}, {results['seconds']}s, mix {config['mix']},"
+        f" {config['distribution']} keys, {config['records']} documents to start with"
+    )
+    print(f"Throughput: {results['throughput']:.1f} ops/s")
+    print(
+        f"{'operation':10} {'count':>8} {'errors':>7} {'ops/s':>10} {'mean ms':>9}"
+        f" {'p50':>9} {'p95':>9} {'p99':>9} {'p99.9':>9} {'max':>9}"
+    )
+    for op, i in results["operations"].items():
+        print(
+            f"{op:10} {i['count']:>8} {i['errors']:>7} {i['ops_per_sec']:>10.1f} {i['mean_ms']:>9.3f}"
+            f" {i['p50_ms']:>9.3f} {i['p95_ms']:>9.3f} {i['p99_ms']:>9.3f}"
+            f" {i['p999_ms']:>9.3f} {i['max_ms']:>9.3f}"
+        )
+
+    # The latencies of every operation, a bar for every power of two of microseconds
+    for op, i in results["operations"].items():
+        if not i["count"]:
+            continue
+        print(f"\n{op} latencies:")
+        most = max(i["histogram"].values())
+        for bucket, n in i["histogram"].items():
+            print(f"  {bucket:>12} {n:>8} {'#' * max(1, round(40 * n / most))}")
+
+    locks = results["locks"]
+    print(
+        f"\nLock waits: {locks['acquired']} locks taken, {locks['waited_sec']:.3f}s waited,"
+        f" {locks['mean_wait_ms']:.3f}ms each, {locks['share']:.1%} of the clients' time"
+    )
+    print(f"Reads of keys not inserted yet: {results['missing_reads']}")
+    for i in results["errors"]:
+        print(f"  Error: {i}")
+
+    print(f"Documents in the table: {results['documents']}")
+    problems = (
+        [("Corrupt read", i) for i in results["corrupt"]]
+        + [("Lost write", i) for i in results["lost"]]
+        + [("Broken document", i) for i in results["broken"]]
+    )
+    for kind, i in problems:
+        print(f"  {kind}: {i}")
+    print(
+        f"Corrupt reads: {results['corrupt_reads']}, lost writes: {results['lost_count']},"
+        f" broken documents: {results['broken_count']}"
+    )
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="A load generator for PumpkinDB.")
+    parser.add_argument("--workload", choices=sorted(WORKLOADS), default="A")
+    parser.add_argument("--mix")
+    parser.add_argument("--distribution", choices=DISTRIBUTIONS)
+    clients = parser.add_mutually_exclusive_group()
+    clients.add_argument("--threads", type=int)
+    clients.add_argument("--processes", type=int)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--records", type=int, default=10000)
+    parser.add_argument("--durability", choices=PumpkinDB.DURABILITY, default="commit")
+    parser.add_argument("--write-behind", action="store_true")
+    parser.add_argument("--no-index", action="store_true")
+    parser.add_argument("--path")
+    parser.add_argument("--output")
+    args = parser.parse_args(argv)
+
+    mix, distribution = WORKLOADS[args.workload]
+    if args.mix:
+        try:
+            mix = parseMix(args.mix)
+        except ValueError as e:
+            parser.error(str(e))
+    if args.records < 1:
+        parser.error("The table has to start with at least one document.")
+
+    # A fresh database in a directory of its own, unless one is given
+    folder = args.path or tempfile.mkdtemp(prefix="pumpkin-load-")
+    os.makedirs(f"{folder}/db", exist_ok=True)
+    if os.path.exists(f"{folder}/db/{NAME}"):
+        parser.error(f"There is a {NAME} database in {folder} already.")
+
+    config = {
+        "path": folder,
+        "mix": mix,
+        "distribution": args.distribution or distribution,
+        "workers": args.processes or args.threads or 4,
+        "processes": bool(args.processes),
+        "duration": args.duration,
+        "records": args.records,
+        "durability": args.durability,
+        "writeBehind": args.write_behind,
+        "index": not args.no_index,
+    }
+
+    try:
+        results = run(config)
+    finally:
+        if args.path is None:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    report(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved the results to {args.output}")
+
+    return 1 if results["lost_count"] or results["broken_count"] or results["corrupt_reads"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,15 @@
+import os
+import sys
+
+import pytest
+
+# The tests import PumpkinDB from the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import PumpkinDB
+
+# A database in a temporary directory
+@pytest.fixture
+def database(tmp_path):
+    os.mkdir(tmp_path / "db")
+    return PumpkinDB.db("test", tmp_path)
@@ -0,0 +1,64 @@
+import pytest
+
+DOCS = [
+    {"ok": True, "x": 2.0},
+    {"ok": False, "x": 3.5},
+    {"ok": True, "x": 2.0},
+    {"x": 1},
+    {"ok": False, "x": 3.5, "y": 4},
+]
+
+def fill(database):
+    t = database.createTable("items")
+    t.insert_many(*DOCS)
+    t.checkpoint()
+    # One document stays in the write-ahead log
+    t.insert({"ok": True, "x": 2.0})
+    return t
+
+# Every metric and grouping of a table, to compare with and without indexes
+def results(t):
+    return {
+        "distinct": [t.distinct(i) for i in ("ok", "x")],
+        "groups": [t.aggregate(group_by=i) for i in ("ok", "x")],
+        "metrics": t.aggregate(
+            metrics={
+                "n": "count", "sum": ("sum", "x"), "min": ("min", "x"),
+                "max": ("max", "x"), "avg": ("avg", "x"),
+            }
+        ),
+        "filtered": t.aggregate({"ok": True}, group_by="x", metrics={"n": "count"}),
+        "count": t.count(),
+    }
+
+@pytest.mark.parametrize("kind", ["hash", "sorted"])
+def test_indexes_keep_the_values(database, kind):
+    t = fill(database)
+    before = results(t)
+    assert before["distinct"] == [[False, True], [1, 2.0, 3.5]]
+    assert [type(i) for i in before["distinct"][0]] == [bool, bool]
+    assert before["groups"][0] == [
+        {"ok": False, "count": 2},
+        {"ok": True, "count": 3},
+        {"ok": None, "count": 1},
+    ]
+    assert before["metrics"] == {"n": 6, "sum": 14.0, "min": 1, "max": 3.5, "avg": 14.0 / 6}
+
+    t.create_index("ok", kind)
+    t.create_index("x", kind)
+    after = results(t)
+    assert after == before
+    assert [type(i) for i in after["distinct"][0]] == [bool, bool]
+    assert [type(i) for i in after["distinct"][1]] == [int, float, float]
+
+    # Removing documents keeps the values of the groups left
+    t.remove({"x": 1})
+    assert t.distinct("ok") == [False, True]
+    assert t.aggregate(group_by="x") == [{"x": 2.0, "count": 3}, {"x": 3.5, "count": 2}]
+
+def test_distinct_and_aggregate_filters(database):
+    t = fill(database)
+    assert t.distinct("x", {"ok": False}) == [3.5]
+    assert t.aggregate({"x": {"__gt": 2}}, metrics={"n": "count"}) == {"n": 2}
+    with pytest.raises(Exception):
+        t.aggregate({"x": {"__bad": 1}})
@@ -0,0 +1,62 @@
+import pytest
+
+import PumpkinDB
+
+# The values of a field of every document of a table, read by a table object of its own
+def stored(tmp_path, name, field="n"):
+    return sorted(i[field] for i in PumpkinDB.db("test", tmp_path).loadTable(name).get({}))
+
+def test_batch_is_written_when_it_ends(database, tmp_path):
+    t = database.createTable("docs")
+    t.insert_many(*[{"n": i} for i in range(10)])
+    t.checkpoint()
+
+    with t.batch():
+        t.insert({"n": 10})
+        t.update({"n": 0}, {"n": 100})
+        t.remove({"n": 5})
+        # Reads inside the batch see its changes, others do not yet
+        assert sorted(i["n"] for i in t.get({})) == [1, 2, 3, 4, 6, 7, 8, 9, 10, 100]
+        assert stored(tmp_path, "docs") == list(range(10))
+
+        # A batch inside the batch is part of it
+        with t.batch():
+            t.insert({"n": 11})
+
+    assert stored(tmp_path, "docs") == [1, 2, 3, 4, 6, 7, 8, 9, 10, 11, 100]
+
+def test_failed_batch_writes_nothing(database, tmp_path):
+    t = database.createTable("docs")
+    t.insert_many(*[{"n": i} for i in range(10)])
+
+    with pytest.raises(RuntimeError):
+        with t.batch():
+            t.insert({"n": 10})
+            t.update({}, {"n": -1})
+            raise RuntimeError("stop")
+
+    assert stored(tmp_path, "docs") == list(range(10))
+    assert sorted(i["n"] for i in t.get({})) == list(range(10))
+
+    # The table is not left locked and the next document gets the next _id
+    t.insert({"n": 10})
+    assert t.get({"n": 10})[0]["_id"] == 10
+
+def test_database_batch(database, tmp_path):
+    database.createTable("orders")
+    database.createTable("stock").insert({"item": "pumpkin", "n": 42})
+
+    with database.batch():
+        database["orders"].insert({"item": "pumpkin", "n": 1})
+        database["stock"].update({"item": "pumpkin"}, {"n": 41})
+    assert stored(tmp_path, "orders") == [1]
+    assert stored(tmp_path, "stock") == [41]
+
+    # Neither table is written if the block fails
+    with pytest.raises(ValueError):
+        with database.batch():
+            database["orders"].insert({"item": "pumpkin", "n": 2})
+            database["stock"].update({"item": "pumpkin"}, {"n": 40})
+            raise ValueError("sold out")
+    assert stored(tmp_path, "orders") == [1]
+    assert stored(tmp_path, "stock") == [41]
@@ -0,0 +1,15 @@
+import pytest
+
+@pytest.mark.parametrize("value", [b"bytes", {1, 2}, {(1, 2): "tuple key"}])
+def test_marshal_rejects_what_json_cant_store(database, tmp_path, value):
+    t = database.createTable("docs", codec="marshal")
+    t.insert({"n": 1})
+    with pytest.raises(TypeError):
+        t.insert({"value": value})
+    with pytest.raises(TypeError):
+        t.update({"n": 1}, {"value": value})
+
+    # Nothing was stored, so indexes, sorts and exports still work
+    t.create_index("value", "sorted")
+    assert t.get({}, sortby="value") == [{"n": 1, "_id": 0}]
+    database.export(tmp_path)
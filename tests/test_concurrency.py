@@ -0,0 +1,57 @@
+import multiprocessing
+import threading
+
+import pytest
+
+import PumpkinDB
+
+# Documents every client inserts
+ROWS = 150
+
+# A small log, so that the clients checkpoint the table while the others insert
+LOG_LIMIT = 2048
+
+# Insert documents into the table from a database object of this client
+def insertRows(path, client: int, rows: int = ROWS):
+    t = PumpkinDB.db("test", path, durability="os").loadTable("docs")
+    t.logLimit = LOG_LIMIT
+    for i in range(rows):
+        t.insert({"client": client, "n": i})
+
+# Every document inserted must be in the table once, with an _id of its own
+def checkRows(t, clients: int):
+    docs = t.get({})
+    assert len(docs) == clients * ROWS
+    assert len({i["_id"] for i in docs}) == len(docs)
+    assert {(i["client"], i["n"]) for i in docs} == {
+        (c, n) for c in range(clients) for n in range(ROWS)
+    }
+
+def test_threads_insert(database, tmp_path):
+    t = database.createTable("docs")
+    threads = [threading.Thread(target=insertRows, args=(tmp_path, i)) for i in range(4)]
+    for i in threads:
+        i.start()
+    for i in threads:
+        i.join()
+    checkRows(t, 4)
+
+@pytest.mark.parametrize("method", ["fork", "spawn"])
+def test_processes_insert(database, tmp_path, method):
+    if method not in multiprocessing.get_all_start_methods():
+        pytest.skip(f"No {method} on this platform")
+
+    # The lock of the table is taken, and its lock file opened, before the processes
+    # start, so forked ones get a copy of it
+    t = database.createTable("docs")
+    t.insert({"client": -1, "n": -1})
+    t.remove({"client": -1})
+
+    context = multiprocessing.get_context(method)
+    processes = [context.Process(target=insertRows, args=(tmp_path, i)) for i in range(4)]
+    for i in processes:
+        i.start()
+    for i in processes:
+        i.join()
+    assert [i.exitcode for i in processes] == [0] * 4
+    checkRows(t, 4)
@@ -0,0 +1,60 @@
+import os
+import random
+
+import PumpkinDB
+
+# The indexes a table object reads from the files must be the ones built from scratch
+def checkIndexes(database):
+    t = database.loadTable("docs")
+    manifest = t._readManifest()
+    indexes = t._loadIndexes(manifest, rebuild=False)
+    assert set(indexes) == {"k", "v"}
+    for field, index in indexes.items():
+        assert index == t._buildIndex(manifest, field, index["kind"])
+
+def test_index_journal(database, monkeypatch):
+    # Journal every change, however small the indexes are
+    monkeypatch.setattr(PumpkinDB, "INDEX_LOG_LIMIT", 1 << 30)
+    rng = random.Random(1)
+    t = database.createTable("docs")
+    t.segmentSize = 10
+    t.insert_many(*[{"k": i % 7, "v": rng.randrange(50)} for i in range(100)])
+    t.checkpoint()
+    t.create_index("k")
+    t.create_index("v", "sorted")
+
+    for step in range(60):
+        n = rng.randrange(5)
+        if n == 0:
+            t.update({"k": rng.randrange(7)}, {"v": rng.randrange(50)})
+        elif n == 1:
+            t.remove_one({"v": {"__lt": rng.randrange(50)}})
+        elif n == 2:
+            t.insert({"k": rng.randrange(7), "v": rng.randrange(50)})
+            t.checkpoint()
+        elif n == 3:
+            with t.batch():
+                t.remove({"k": rng.randrange(7), "v": {"__gte": 25}})
+                t.insert({"k": rng.randrange(7)})
+        else:
+            t.update_one({"v": rng.randrange(50)}, {"k": "changed"})
+        checkIndexes(database)
+
+    assert os.path.exists(t.indexLogPath)
+    assert len(t.get({"k": 3})) == sum(1 for i in t.get({}) if i.get("k") == 3)
+
+def test_index_journal_folded(database, monkeypatch):
+    monkeypatch.setattr(PumpkinDB, "INDEX_LOG_LIMIT", 0)
+    t = database.createTable("docs")
+    t.insert_many(*[{"k": i, "v": i} for i in range(20)])
+    t.checkpoint()
+    t.create_index("k")
+    t.create_index("v", "sorted")
+
+    # Once the journal outgrows a quarter of the indexes they are written in full
+    journaled = []
+    for i in range(10):
+        t.remove({"k": i})
+        journaled.append(os.path.exists(t.indexLogPath))
+        checkIndexes(database)
+    assert True in journaled and False in journaled
@@ -0,0 +1,33 @@
+import PumpkinDB
+
+# Checkpoint the table as if the process crashed right after writing the manifest,
+# before the folded write-ahead log was removed
+def crashedCheckpoint(t, monkeypatch):
+    with monkeypatch.context() as m:
+        m.setattr(PumpkinDB.table, "_resetLog", lambda self: None)
+        t.checkpoint()
+
+def test_insert_after_crashed_checkpoint(database, monkeypatch):
+    t = database.createTable("docs")
+    t.insert({"n": 0})
+    crashedCheckpoint(t, monkeypatch)
+
+    # The left over log is ignored, the insert after it must not be
+    t = database.loadTable("docs")
+    t.insert({"n": 1})
+    assert t.count() == 2
+    t.checkpoint()
+    assert sorted(i["n"] for i in t.get({})) == [0, 1]
+    assert [i["_id"] for i in t.get({})] == [0, 1]
+
+def test_cached_id_after_crashed_checkpoint(database, monkeypatch):
+    t = database.createTable("docs")
+    t.insert({"n": 0})
+
+    # Another table object checkpoints and crashes, this one still has the
+    # log it wrote to in its cache of the next free id
+    crashedCheckpoint(database.loadTable("docs"), monkeypatch)
+    t.insert({"n": 1})
+    assert t.count() == 2
+    t.checkpoint()
+    assert [(i["n"], i["_id"]) for i in t.get({})] == [(0, 0), (1, 1)]
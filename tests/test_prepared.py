@@ -0,0 +1,70 @@
+import pytest
+import PumpkinDB
+
+# Every test starts with an empty statement cache and no prepared statements
+@pytest.fixture
+def cli(database, monkeypatch):
+    monkeypatch.setattr(PumpkinDB, "statementCache", PumpkinDB.lruCache(maxBytes=1 << 20, maxEntries=256))
+    monkeypatch.setattr(PumpkinDB, "preparedStatements", {})
+    monkeypatch.setattr(PumpkinDB, "mydb", database)
+    database.createTable("people").insert_many(
+        {"name": "ann", "age": 31}, {"name": "bob", "age": 25}, {"name": "cat", "age": 40}
+    )
+    return PumpkinDB.queryProcessor
+
+# The values of one field of the documents found, without their _id
+def values(rows, field="name"):
+    return None if rows is None else [i.get(field) for i in rows]
+
+def test_prepare_and_execute(cli):
+    assert cli("PREPARE older AS SELECT name FROM people WHERE age > ? ORDER BY age LIMIT ?")
+    assert values(cli("EXECUTE older (30, 5)")) == ["ann", "cat"]
+    assert values(cli("EXECUTE older (24, 1)")) == ["bob"]
+
+    # The prepared statement is left as it was by EXECUTE
+    assert PumpkinDB.preparedStatements["older"]["params"] == 2
+    assert values(cli("EXECUTE older (30, 1)")) == ["ann"]
+
+    # Wrong values are refused and nothing is run
+    assert cli("EXECUTE older (30)") is None
+    assert cli("EXECUTE older (30, 'all')") is None
+    assert cli("SELECT * FROM people WHERE age > ?") is None
+
+    assert cli("DEALLOCATE PREPARE older")
+    assert cli("EXECUTE older (30, 5)") is None
+    assert cli("DEALLOCATE older") is None
+
+def test_prepared_update(cli, database):
+    assert cli("PREPARE birthday AS UPDATE people SET age = ? WHERE name = ?")
+    assert cli("EXECUTE birthday (32, 'ann')") == 1
+    assert database.loadTable("people").get({"name": "ann"})[0]["age"] == 32
+
+def test_stats_count_cache_hits(cli):
+    query = "SELECT name FROM people WHERE name = 'ann'"
+    for _ in range(3):
+        assert values(cli(query)) == ["ann"]
+    stats = cli("STATS")
+    assert stats["hits"] == 2
+    assert stats["misses"] == 2
+    assert stats["cached statements"] == 2
+
+    assert cli("PREPARE one AS SELECT * FROM people LIMIT 1")
+    assert PumpkinDB.sqlStats()["prepared statements"] == 1
+
+# The same query typed with its keywords in another case or spaced differently is one
+# entry of the cache, strings and names keep their case
+def test_cache_ignores_keyword_case(cli):
+    assert values(cli("SELECT name FROM people WHERE name = 'ann'")) == ["ann"]
+    assert cli("select  name\nfrom people where NAME = 'ann'") == []
+    assert values(cli("select name from people where name = 'ann'")) == ["ann"]
+    assert cli("Select name From people Where name = 'ANN'") == []
+    assert PumpkinDB.sqlStats()["hits"] == 1
+    assert len(PumpkinDB.statementCache.entries) == 3
+
+# A field named like a keyword keeps its case, and such a query is not cached
+def test_keyword_names_keep_their_case(cli, database):
+    database.loadTable("people").insert({"name": "dan", "count": 1, "COUNT": 2})
+    assert values(cli("SELECT count FROM people WHERE name = 'dan'"), "count") == [1]
+    assert values(cli("SELECT COUNT FROM people WHERE name = 'dan'"), "COUNT") == [2]
+    assert values(cli("SELECT count FROM people WHERE name = 'dan'"), "count") == [1]
+    assert len(PumpkinDB.statementCache.entries) == 0
@@ -0,0 +1,15 @@
+import pytest
+
+# Documents without the sort field come last, in either order, with or without an index
+@pytest.mark.parametrize("index", [False, True])
+@pytest.mark.parametrize("descending", [False, True])
+def test_missing_sort_field_comes_last(database, index, descending):
+    t = database.createTable("docs")
+    t.insert_many({"v": 2}, {"w": 0}, {"v": 1}, {"w": 1}, {"v": 3})
+    t.checkpoint()
+    if index:
+        t.create_index("v", "sorted")
+
+    values = [i.get("v") for i in t.get({}, sortby="v", descending=descending)]
+    assert values == ([3, 2, 1] if descending else [1, 2, 3]) + [None, None]
+    assert t.get({}, sortby="v", descending=descending, limit=1)[0]["v"] == (3 if descending else 1)
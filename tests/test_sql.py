@@ -0,0 +1,118 @@
+import functools
+
+import pytest
+
+import PumpkinDB
+
+# Parse and run one query on the database
+def run(database, query):
+    return PumpkinDB.executeSQL(database, PumpkinDB.parseSQL(query))
+
+# The values of one field of the documents found
+def values(rows, field="name"):
+    return [i.get(field) for i in rows]
+
+@pytest.fixture
+def people(database):
+    assert run(database, "CREATE TABLE people (name TEXT, age INT)")
+    database.loadTable("people").insert_many(
+        {"name": "ann", "age": 31, "city": "oslo"},
+        {"name": "bob", "age": 25, "city": "rome"},
+        {"name": "cat", "age": 40, "city": "oslo"},
+        {"name": "dan", "age": 19},
+    )
+    return database
+
+def test_select(people):
+    assert values(run(people, "SELECT * FROM people ORDER BY age")) == ["dan", "bob", "ann", "cat"]
+    assert values(run(people, "SELECT name FROM people WHERE city = 'oslo' ORDER BY age DESC")) == ["cat", "ann"]
+    assert values(run(people, "SELECT * FROM people WHERE age >= 25 AND age < 40 ORDER BY name")) == ["ann", "bob"]
+    assert values(run(people, "SELECT * FROM people WHERE age BETWEEN 20 AND 35 ORDER BY age")) == ["bob", "ann"]
+    assert values(run(people, "SELECT * FROM people WHERE name IN ('bob', 'dan') ORDER BY name")) == ["bob", "dan"]
+    assert values(run(people, "SELECT * FROM people WHERE name LIKE 'c%'")) == ["cat"]
+    assert values(run(people, "SELECT * FROM people ORDER BY age LIMIT 2 OFFSET 1")) == ["bob", "ann"]
+
+    # Only the fields asked for, and the _id, are returned
+    assert run(people, "SELECT name FROM people WHERE name = 'bob'") == [{"_id": 1, "name": "bob"}]
+
+def test_aggregates(people):
+    assert run(people, "SELECT COUNT(*) FROM people") == [{"count(*)": 4}]
+    rows = run(people, "SELECT city, COUNT(*) AS n, MAX(age) FROM people WHERE city != NULL GROUP BY city ORDER BY city")
+    assert rows == [{"city": "oslo", "n": 2, "max(age)": 40}, {"city": "rome", "n": 1, "max(age)": 25}]
+    assert values(run(people, "SELECT DISTINCT city FROM people WHERE age > 20 ORDER BY city"), "city") == ["oslo", "rome"]
+
+def test_update_and_delete(people):
+    assert run(people, "UPDATE people SET city = 'paris', age = 26 WHERE name = 'bob'") == 1
+    assert run(people, "SELECT * FROM people WHERE name = 'bob'")[0]["city"] == "paris"
+    assert run(people, "DELETE FROM people WHERE age < 30") == 2
+    assert values(run(people, "SELECT * FROM people ORDER BY name")) == ["ann", "cat"]
+    assert run(people, "DROP TABLE people")
+    people.get_meta()
+    assert "people" not in people.tables
+
+def test_explain(people):
+    t = people.loadTable("people")
+    assert run(people, "EXPLAIN SELECT * FROM people WHERE name = 'ann'")["access"] != "index lookup"
+    assert run(people, "CREATE HASH INDEX ON people (name)")
+    plan = run(people, "EXPLAIN SELECT * FROM people WHERE name = 'ann'")
+    assert plan["access"] == "index lookup" and plan["index"] == "name"
+    assert run(people, "CREATE SORTED INDEX ON people (age)")
+    assert run(people, "EXPLAIN SELECT * FROM people ORDER BY age LIMIT 1")["access"] == "index scan"
+
+    # Explaining a change leaves the table as it was
+    run(people, "EXPLAIN DELETE FROM people WHERE name = 'ann'")
+    assert len(t.get({})) == 4
+    assert run(people, "DROP INDEX ON people (name)")
+    assert run(people, "EXPLAIN SELECT * FROM people WHERE name = 'ann'")["access"] != "index lookup"
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        "SELECT FROM people",
+        "SELECT * FROM people WHERE age > 1 OR age < 0",
+        "SELECT * FROM people LIMIT 'all'",
+        "SELECT name, age FROM people GROUP BY name",
+        "EXPLAIN CREATE TABLE other",
+        "SELECT * FROM people extra",
+        "SELECT * FROM people WHERE name = 'ann",
+    ],
+)
+def test_malformed_queries(query):
+    with pytest.raises(ValueError):
+        PumpkinDB.parseSQL(query)
+
+def test_insert_values(database):
+    run(database, "CREATE TABLE people")
+    query = "INSERT INTO people (name, age) VALUES ('ann', 31), ('bob', NULL), ('it''s', 2.5)"
+    assert run(database, query) == 3
+    assert run(database, "SELECT * FROM people ORDER BY _id") == [
+        {"_id": 0, "name": "ann", "age": 31},
+        {"_id": 1, "name": "bob", "age": None},
+        {"_id": 2, "name": "it's", "age": 2.5},
+    ]
+    with pytest.raises(ValueError):
+        PumpkinDB.parseSQL("INSERT INTO people (name, age) VALUES ('cat', 1), ('dan')")
+
+def test_insert_from_file(database, tmp_path, monkeypatch):
+    run(database, "CREATE TABLE people")
+    path = tmp_path / "people.jsonl"
+    path.write_text("".join(f'{{"n": {i}}}\n' for i in range(25)) + "\n")
+
+    # The file is read in chunks, and written at once
+    monkeypatch.setattr(PumpkinDB, "readJsonLines", functools.partial(PumpkinDB.readJsonLines, size=10))
+    seen = []
+    statement = PumpkinDB.parseSQL(f"INSERT INTO people FROM '{path}'")
+    assert PumpkinDB.executeSQL(database, statement, lambda rows, seconds: seen.append(rows)) == 25
+    assert seen == [10, 20, 25]
+    assert values(run(database, "SELECT * FROM people ORDER BY n"), "n") == list(range(25))
+
+@pytest.mark.parametrize("line", ["{bad", "[1, 2]"])
+def test_bad_file_inserts_nothing(database, tmp_path, line):
+    run(database, "CREATE TABLE people")
+    run(database, "INSERT INTO people (n) VALUES (0)")
+    path = tmp_path / "people.jsonl"
+    path.write_text('{"n": 1}\n{"n": 2}\n' + line + "\n")
+
+    with pytest.raises(ValueError, match="Line 3"):
+        run(database, f"INSERT INTO people FROM '{path}'")
+    assert values(run(database, "SELECT * FROM people"), "n") == [0]
@@ -0,0 +1,65 @@
+import pytest
+
+import PumpkinDB
+
+# The values of a field of every document of a table, read by a database object of its own
+def stored(tmp_path, name, field="n"):
+    return sorted(i[field] for i in PumpkinDB.db("test", tmp_path).loadTable(name).get({}))
+
+def test_reads_see_queued_writes(database, tmp_path):
+    t = database.createTable("docs")
+    t.insert_many(*[{"n": i} for i in range(5)])
+    # Nothing is written in the background while the test runs
+    t.setWriteBehind(interval=60000, size=1000)
+
+    t.insert({"n": 5})
+    t.insert_many({"n": 6}, {"n": 7})
+    assert t.update({"n": 0}, {"n": 100}) is None
+    assert t.remove({"n": 1}) is None
+    assert stored(tmp_path, "docs") == [0, 1, 2, 3, 4]
+
+    # The table object that queued the changes sees them, and they are written by then
+    assert sorted(i["n"] for i in t.get({})) == [2, 3, 4, 5, 6, 7, 100]
+    assert stored(tmp_path, "docs") == [2, 3, 4, 5, 6, 7, 100]
+
+    t.insert({"n": 8})
+    t.flush()
+    assert stored(tmp_path, "docs") == [2, 3, 4, 5, 6, 7, 8, 100]
+
+    # Turning write-behind off writes what is left in the queue
+    t.update({"n": 8}, {"n": 9})
+    t.setWriteBehind(False)
+    assert stored(tmp_path, "docs") == [2, 3, 4, 5, 6, 7, 9, 100]
+    assert t.remove({"n": 9}) == 1
+
+def test_database_write_behind(tmp_path):
+    (tmp_path / "db").mkdir()
+    database = PumpkinDB.db("test", tmp_path, writeBehind=True)
+    database.createTable("docs")
+    t = database["docs"]
+    t.setWriteBehind(interval=60000)
+
+    t.insert_many({"n": 1}, {"n": 2})
+    assert stored(tmp_path, "docs") == []
+    database.flush()
+    assert stored(tmp_path, "docs") == [1, 2]
+
+    # Bad changes are refused when they are queued, not by the background thread
+    with pytest.raises(PumpkinDB.InvalidRegExpError):
+        t.update({"n": {"__re": "("}}, {"n": 3})
+
+def test_bad_settings_are_refused(database):
+    t = database.createTable("docs")
+    with pytest.raises(ValueError):
+        t.setDurability("never")
+    with pytest.raises(ValueError):
+        t.setDurability("interval", 0)
+    with pytest.raises(ValueError):
+        t.setWriteBehind(interval=0)
+    with pytest.raises(ValueError):
+        PumpkinDB.db("test", database.dbPath, durability="sometimes")
+
+    t.setDurability("os")
+    t.insert({"n": 1})
+    t.flush()
+    assert t.get({})[0]["n"] == 1